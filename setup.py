@@ -34,6 +34,9 @@ setup(
         'properties>=0.4.0',
         'vectormath',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
     author='Seequent',
     author_email='support@steno3d.com',
     description='Steno3D Python client library',
@@ -0,0 +1,431 @@
+"""aio.py contains asyncio counterparts of the steno3d upload and
+download functions (Python 3.6+)
+
+Requests are made with aiohttp if it is installed, with
+`pip install steno3d[async]`; otherwise they are made with requests on
+a pool of threads. Serialization and building resources use the same
+code as the blocking functions.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from json import dumps, loads
+from time import time
+from uuid import uuid4
+
+import requests
+
+from .client import Comms, RetryPolicy, _file_content, _file_size
+from .prepare import release_prepared
+from .project import Project, _child_uids, _class_and_uid, _file_urls
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+DEFAULT_CONCURRENCY = 100
+CHUNK_SIZE = 64*1024
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:
+    # Python 3.6
+    _running_loop = asyncio.get_event_loop
+
+
+class _Response(object):
+    """Response read by aiohttp, with the parts of the requests.Response
+    interface that steno3d uses
+    """
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    def json(self):
+        return loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def __iter__(self):
+        return self.iter_content()
+
+
+def _needs_chunks(files):
+    """True if any file will be transferred in chunks"""
+    if Comms.chunk_threshold is None:
+        return False
+    return any(
+        _file_size(getattr(fileprop, 'file', fileprop)) > Comms.chunk_threshold
+        for fileprop in (files or {}).values()
+    )
+
+
+def _form(data, files):
+    """Build the aiohttp form for the data and files of a request"""
+    form = aiohttp.FormData()
+    for key, value in (data or {}).items():
+        form.add_field(key, '{}'.format(value))
+    for name, fileprop in (files or {}).items():
+        fileobj = getattr(fileprop, 'file', fileprop)
+        if hasattr(fileprop, 'dtype'):
+            form.add_field(name + 'Type', fileprop.dtype,
+                           filename=name + 'Type')
+        if getattr(fileobj, 'array_encoding', None):
+            form.add_field(name + 'Encoding', fileobj.array_encoding,
+                           filename=name + 'Encoding')
+        if getattr(fileobj, 'patch', None):
+            form.add_field(name + 'Patch', dumps(fileobj.patch),
+                           filename=name + 'Patch')
+        # Buffers are sent in place rather than copied into bytes
+        form.add_field(name, _file_content(fileobj),
+                       filename=getattr(fileobj, 'name', name))
+    return form
+
+
+class AsyncTransport(object):
+    """Non-blocking transport for steno3d requests
+
+    At most `concurrency` requests are in flight at once, and failed
+    requests are retried according to Comms.retry_policy. Requests sent
+    on threads use a session of the transport, with `concurrency`
+    pooled connections and the cookies of Comms.session. A transport
+    may be shared between coroutines and should be closed when it is
+    no longer needed, or used as an async context manager.
+
+    Optional arguments:
+        concurrency - Maximum number of requests in flight (Default: 100)
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        if concurrency < 1:
+            raise ValueError('concurrency must be a positive integer')
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._session = None
+        self._requests = requests.Session()
+        self._requests.cookies = Comms.session.cookies
+        Comms._mount_adapters(self._requests, concurrency)
+        if aiohttp is None:
+            self._executor = ThreadPoolExecutor(concurrency)
+        else:
+            self._executor = ThreadPoolExecutor(4)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """Close the sessions and thread pool"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._requests.close()
+        self._executor.shutdown(wait=False)
+
+    @property
+    def _limit(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking function on the transport's thread pool"""
+        loop = _running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+
+    async def communicate(self, method, url, data=None, files=None,
+                          monitor=None):
+        """Counterpart of Comms.post, Comms.put and Comms.get
+
+        method is 'post', 'put' or 'get' and url is relative to
+        Comms.base_url. Files that must be transferred in chunks are
+        sent with the blocking Comms on the thread pool. monitor is
+        called with the bytes sent as the body streams, except when
+        sending with aiohttp.
+        """
+        async with self._limit:
+            if aiohttp is None or _needs_chunks(files):
+                return await self.run(
+                    Comms._communicate, getattr(self._requests, method),
+                    url, data, files, monitor,
+                )
+            try:
+                resp, attempts = await self._send(
+                    method,
+                    Comms.base_url + url,
+                    body=partial(_form, data, files) if method != 'get'
+                    else None,
+                    headers=Comms._headers(),
+                )
+            finally:
+                for key in files or {}:
+                    files[key].file.close()
+            return Comms._response(resp, attempts)
+
+    async def fetch(self, url, headers=None):
+        """GET an absolute url and return the response with its content"""
+        async with self._limit:
+            if aiohttp is None:
+                resp, _ = await self.run(
+                    Comms._send, self._requests.get, url,
+                    headers=headers, timeout=120,
+                )
+                return resp
+            resp, _ = await self._send('get', url, headers=headers)
+            return resp
+
+    async def _send(self, method, url, body=None, headers=None,
+                    timeout=120):
+        """Counterpart of Comms._send using aiohttp
+
+        body is a function that builds the request body, since aiohttp
+        forms cannot be sent more than once.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('Idempotency-Key', uuid4().hex)
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            )
+        policy = Comms.retry_policy or RetryPolicy(max_retries=0)
+        idempotent = method != 'post' or Comms.idempotency_keys
+        attempts = []
+        attempt = 0
+        while True:
+            start = time()
+            resp, error = None, None
+            try:
+                async with self._session.request(
+                        method.upper(),
+                        url,
+                        data=None if body is None else body(),
+                        headers=headers,
+                ) as response:
+                    resp = _Response(response.status, await response.read(),
+                                     response.headers.copy())
+            except asyncio.TimeoutError as err:
+                error = requests.Timeout(repr(err))
+            except aiohttp.ClientError as err:
+                error = requests.ConnectionError(repr(err))
+            attempts += [{
+                'status_code': getattr(resp, 'status_code', None),
+                'error': None if error is None else repr(error),
+                'elapsed': time() - start,
+            }]
+            if not policy.should_retry(attempt, resp, error, idempotent):
+                break
+            await asyncio.sleep(policy.delay(attempt, resp))
+            attempt += 1
+        if error is not None:
+            raise error
+        return resp, attempts
+
+
+def _logged_in(verbose):
+    if Comms.user.logged_in:
+        return True
+    if verbose:
+        print("Please login: 'steno3d.login()'")
+    return False
+
+
+async def _upload_resource(res, transport, kwargs):
+    """Upload one resource whose children are already uploaded"""
+    request = await transport.run(res._upload_request, **kwargs)
+    if request['method'] is not None:
+        try:
+            resp = await transport.communicate(
+                request['method'], request['url'], request['data'],
+                request['files'], res._upload_monitor(request, **kwargs),
+            )
+            res._upload_response(resp, request['url'], request['data'],
+                                 request['files'])
+        except Exception:
+            res._restore_dirty(request)
+            raise
+    res._upload_complete(request, **kwargs)
+
+
+async def _upload_resources(project, transport, kwargs):
+    """Upload the resources of a project concurrently
+
+    Each resource is uploaded as soon as its meshes, data and textures
+    are uploaded. All failures are raised together as an UploadError.
+    """
+    errors = []
+    leaves = {}
+
+    async def guarded(item):
+        try:
+            await _upload_resource(item, transport, kwargs)
+        except Exception as err:
+            errors.append((item, err))
+            return False
+        return True
+
+    async def upload_composite(res, children):
+        if all(await asyncio.gather(*children)):
+            await guarded(res)
+
+    composites = []
+    for res in project.resources:
+        children = []
+        for child in res._dirty_children():
+            if id(child) not in leaves:
+                leaves[id(child)] = asyncio.ensure_future(guarded(child))
+            children += [leaves[id(child)]]
+        composites += [upload_composite(res, children)]
+    await asyncio.gather(*composites)
+    if errors:
+        raise project._upload_error(errors)
+
+
+async def upload_project(project, **kwargs):
+    """Upload a project without blocking the event loop
+
+    See Project.upload_async for the available arguments.
+    """
+    verbose = kwargs.get('verbose', True)
+    if not _logged_in(verbose):
+        return None
+    kwargs.pop('workers', None)
+    kwargs.pop('sync', None)
+    concurrency = kwargs.pop('concurrency', DEFAULT_CONCURRENCY)
+    transport = kwargs.pop('transport', None)
+    owned = transport is None
+    if owned:
+        transport = AsyncTransport(concurrency)
+    try:
+        kwargs = await transport.run(project._start_upload, **kwargs)
+        try:
+            assert await transport.run(project.validate)
+            if 'resources' in project._dirty:
+                await _upload_resources(project, transport, kwargs)
+            await _upload_resource(project, transport, kwargs)
+        finally:
+            release_prepared(project._leaves())
+            if 'upload_cache' in kwargs:
+                kwargs['upload_cache'].save()
+        url = project._api_uid_location
+        resp = await transport.communicate('put', url, {}, {})
+        project._upload_response(resp, url, {}, {})
+        return project._finish_upload(**kwargs)
+    finally:
+        if owned:
+            await transport.close()
+
+
+async def project_by_uid(uid, copy=None, verbose=True, **kwargs):
+    """Download a project without blocking the event loop
+
+    The json of the project and its resources, and all arrays and
+    images, are fetched concurrently, then the project is built by
+    Project._build from the prefetched responses on the transport's
+    thread pool.
+
+    Optional arguments:
+        copy        - If True, the project is downloaded as a copy
+                      (Default: True unless you own the project)
+        verbose     - Print download status (Default: True)
+        concurrency - Maximum number of requests in flight (Default: 100)
+        transport   - AsyncTransport to share between calls
+    """
+    if not _logged_in(verbose):
+        return None
+    transport = kwargs.get('transport', None)
+    owned = transport is None
+    if owned:
+        transport = AsyncTransport(
+            kwargs.get('concurrency', DEFAULT_CONCURRENCY)
+        )
+    prefetched = {}
+
+    async def fetch(url, headers=None):
+        resp = await transport.fetch(url, headers)
+        prefetched[url] = resp
+        return resp
+
+    async def fetch_json(cls, uid, using=None):
+        resp = await fetch(Comms.base_url + cls._json_location(uid, using),
+                           Comms._headers())
+        if resp.status_code != 200:
+            return None
+        try:
+            return resp.json()
+        except ValueError:
+            return None
+
+    try:
+        proj_json = await fetch_json(Project, uid)
+        if proj_json is not None:
+            using = 'ProjectSteno3D:{}'.format(uid)
+            res_uids = [_class_and_uid(long_uid)
+                        for long_uid in proj_json.get('resourceUids', [])]
+            res_jsons = await asyncio.gather(*[
+                fetch_json(cls, res_uid, using) for cls, res_uid in res_uids
+            ])
+            child_uids = _child_uids(res_jsons)
+            child_jsons = await asyncio.gather(*[
+                fetch_json(cls, child_uid, using)
+                for cls, child_uid in child_uids
+            ])
+            urls = set()
+            for (cls, _), child_json in zip(child_uids, child_jsons):
+                if child_json is not None:
+                    urls.update(_file_urls(cls, child_json))
+            await asyncio.gather(*[fetch(url) for url in urls])
+        # Building makes blocking requests for anything that could not
+        # be prefetched, so it runs on the transport's thread pool
+        return await transport.run(Project._build, uid, copy,
+                                   verbose=verbose, prefetched=prefetched)
+    finally:
+        if owned:
+            await transport.close()
+
+
+async def query(url, queue=10, verbose=True, transport=None):
+    """Asynchronously iterate over the projects returned by a query
+
+    Pages of `queue` projects are requested as they are needed.
+    """
+    owned = transport is None
+    if owned:
+        transport = AsyncTransport(1)
+    try:
+        cursor = ''
+        more = True
+        if verbose:
+            print('Fetching projects from the database ...')
+        while more:
+            resp = await transport.communicate(
+                'get', '{url}?brief=True&num={n}&cursor={c}'.format(
+                    url=url, n=queue, c=cursor
+                )
+            )
+            rjson = resp['json']
+            cursor = rjson['cursor']
+            more = rjson['more']
+            for proj in rjson['data']:
+                yield proj
+            if verbose and more:
+                print('Fetching more projects from the database ...')
+    finally:
+        if owned:
+            await transport.close()
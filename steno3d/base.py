@@ -7,14 +7,109 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from json import dumps
 from pprint import pformat
+from threading import Lock, Timer
+from time import time
 from six import string_types
 
 import properties
 
+from .cache import payload_digest
 from .client import Comms, needs_login, pause, plot
-from .props import HasSteno3DProps
+from .progress import UploadProgress
+from .props import (HasSteno3DProps, download_kwargs, encode_files,
+                    patch_files, transfer_nbytes)
+
+
+SYNC_QUIET_PERIOD = 0.5
+
+
+class SyncQueue(object):
+    """Queue that coalesces changes to synced resources into batches
+
+    Each changed resource is queued once, however many of its properties
+    change. Queued resources are uploaded together on a background
+    thread after quiet_period seconds without further changes, or when
+    the outermost batch() block exits. A quiet_period of 0 uploads every
+    change immediately.
+
+    Each upload with sync=True creates a queue for the resources it
+    uploads, so the quiet period and batches of one project do not
+    affect others.
+    """
+
+    def __init__(self, quiet_period=SYNC_QUIET_PERIOD):
+        self.quiet_period = quiet_period
+        self._pending = OrderedDict()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._timer = None
+        self._batch_depth = 0
+
+    def schedule(self, res):
+        """Queue a resource with changes to upload"""
+        with self._lock:
+            self._pending[id(res)] = res
+            if self._batch_depth > 0:
+                return
+            self._cancel_timer()
+            if self.quiet_period > 0:
+                self._timer = Timer(self.quiet_period, self.flush)
+                self._timer.start()
+                return
+        self.flush()
+
+    @contextmanager
+    def batch(self):
+        """Defer uploads until the outermost batch block exits"""
+        with self._lock:
+            self._batch_depth += 1
+            self._cancel_timer()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                done = self._batch_depth == 0
+            if done:
+                self.flush()
+
+    def flush(self):
+        """Upload all queued changes now
+
+        Meshes, data and textures are uploaded before the resources
+        that contain them, and resources before projects.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._cancel_timer()
+                pending = list(self._pending.values())
+                self._pending = OrderedDict()
+            progress = UploadProgress(
+                UserContent._progress_report,
+                [res for res in pending if res._is_leaf],
+                len([res for res in pending if not res._is_leaf]),
+            )
+            for res in sorted(pending, key=self._upload_order):
+                if getattr(res, '_sync', False):
+                    res._upload(sync=True, sync_queue=self,
+                                upload_progress=progress)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    @staticmethod
+    def _upload_order(res):
+        if res._is_leaf:
+            return 0
+        if isinstance(res, CompositeResource):
+            return 1
+        return 2
 
 
 class classproperty(property):
@@ -37,10 +132,7 @@ class UserContent(HasSteno3DProps):
     )
     _sync = False
     _upload_data = None
-    _upload_size = 0
-    _upload_count = 0
-    _upload_total_size = 0
-    _upload_total_count = 0
+    _sync_queue = SyncQueue()
 
     @classproperty
     @classmethod
@@ -63,50 +155,24 @@ class UserContent(HasSteno3DProps):
     def _upload(self, **kwargs):
         if getattr(self, '_uploading', False):
             return
+        request = None
         try:
             verbose = kwargs.get('verbose', True)
-            sync = kwargs.get('sync', False)
             self._uploading = True
             pause()
             assert self.validate()
             self._upload_dirty(**kwargs)
-            if getattr(self, '_upload_data', None) is None:
-                self._post(
-                    self._get_dirty_data(force=True),
-                    self._get_dirty_files(force=True)
-                )
-            else:
-                dirty_data = self._get_dirty_data()
-                dirty_files = self._get_dirty_files()
-                if len(dirty_data) > 0 or len(dirty_files) > 0:
-                    self._put(dirty_data, dirty_files)
-            self._mark_clean(recurse=False)
-            self._sync = sync
-            progress_callback = kwargs.get('progress_callback', None)
-            if verbose and progress_callback is None:
-                progress_callback = self._progress_report
-            if progress_callback is not None:
-                if (
-                        isinstance(self, BaseResource) and
-                        not isinstance(self, CompositeResource)
-                ):
-                    UserContent._upload_size += self._nbytes()
-                else:
-                    UserContent._upload_count += 1
-                progress = 0.9 * (
-                    UserContent._upload_size /
-                    UserContent._upload_total_size
-                ) + 0.1 * (
-                    UserContent._upload_count /
-                    UserContent._upload_total_count
-                )
-                message = 'Uploading: {cls} {title}'.format(
-                    cls=self._resource_class,
-                    title=self.title
-                )
-                progress_callback({'progress': progress, 'message': message})
+            request = self._upload_request(**kwargs)
+            monitor = self._upload_monitor(request, **kwargs)
+            if request['method'] == 'post':
+                self._post(request['data'], request['files'], monitor)
+            elif request['method'] == 'put':
+                self._put(request['data'], request['files'], monitor)
+            self._upload_complete(request, **kwargs)
 
         except Exception as err:
+            if request is not None:
+                self._restore_dirty(request)
             if self._sync and verbose:
                 print('Upload failed, turning off syncing. To restart '
                       'syncing, upload() again.')
@@ -116,6 +182,233 @@ class UserContent(HasSteno3DProps):
         finally:
             self._uploading = False
 
+    @property
+    def _is_leaf(self):
+        """True for meshes, data and textures"""
+        return (
+            isinstance(self, BaseResource) and
+            not isinstance(self, CompositeResource)
+        )
+
+    def _upload_request(self, **kwargs):
+        """Prepare the request that uploads changes to this resource
+
+        Returns a dictionary with the request 'method' ('post', 'put', or
+        None if nothing needs to be sent), 'url', 'data' and 'files', the
+        'raw_bytes' and 'wire_bytes' of the files, the 'changed_bytes' of
+        arrays since they were last uploaded and their 'block_digests',
+        and the upload cache 'digest' of new meshes, data and textures.
+        Changed arrays are sent as patches if Comms.array_patching is set.
+
+        The changes included in the request are cleared as it is built
+        and recorded as 'sent', so changes made while it is in flight
+        are kept for the next upload.
+        """
+        self._request_attempts = []
+        if getattr(self, '_upload_cached', False) and self._dirty:
+            # Cached resources may be shared with other projects, so
+            # changes are uploaded as a new resource
+            self._upload_data = None
+            self._upload_cached = False
+        upload_cache = kwargs.get('upload_cache', None)
+        compression = kwargs.get('compression', None)
+        request = {
+            'start_time': time(),
+            'method': None,
+            'url': None,
+            'data': {},
+            'files': {},
+            'raw_bytes': 0,
+            'wire_bytes': 0,
+            'changed_bytes': 0,
+            'block_digests': {},
+            'digest': None,
+            'upload_cache': upload_cache,
+        }
+        if getattr(self, '_upload_data', None) is None:
+            request['method'] = 'post'
+            request['url'] = 'api/' + self._model_api_location
+            request['data'] = self._get_dirty_data(force=True)
+            files, request['block_digests'], request['changed_bytes'] = (
+                patch_files(self._get_dirty_files(force=True))
+            )
+            request['files'] = encode_files(files, compression)
+        else:
+            dirty_data = self._get_dirty_data()
+            files, request['block_digests'], request['changed_bytes'] = (
+                patch_files(self._get_dirty_files(),
+                            getattr(self, '_block_digests', None),
+                            Comms.array_patching)
+            )
+            dirty_files = encode_files(files, compression)
+            if len(dirty_data) == 0 and len(dirty_files) == 0:
+                request['sent'] = self._take_dirty()
+                return request
+            request['method'] = 'put'
+            request['url'] = self._api_uid_location
+            request['data'] = dirty_data
+            request['files'] = dirty_files
+        request['raw_bytes'], request['wire_bytes'] = transfer_nbytes(
+            request['files']
+        )
+        if (
+                request['method'] == 'post' and
+                upload_cache is not None and
+                self._is_leaf
+        ):
+            digest = payload_digest(self._resource_class, request['data'],
+                                    request['files'])
+            cached = upload_cache.get(digest)
+            if cached is not None and not self._cached_exists(cached):
+                # The cached resource was deleted on the server
+                upload_cache.remove(digest)
+                cached = None
+            if cached is None:
+                request['digest'] = digest
+            else:
+                for key in request['files']:
+                    request['files'][key].file.close()
+                self._upload_data = cached
+                self._upload_cached = True
+                request['method'] = None
+                request['wire_bytes'] = 0
+        request['sent'] = self._take_dirty()
+        return request
+
+    def _take_dirty(self):
+        """Clear the changes of this resource and of the binders and
+        options sent with it
+
+        Returns (object, names) pairs of the changed properties cleared,
+        for _restore_dirty.
+        """
+        taken = []
+        for links in list(self._dirty_links.values()):
+            for child in list(links.values()):
+                if not isinstance(child, UserContent):
+                    taken += [(child, child._dirty_props)]
+        taken += [(self, self._dirty_props)]
+        for obj, _ in taken:
+            obj._dirty_props = set()
+            obj._update_dirty()
+        return taken
+
+    @staticmethod
+    def _restore_dirty(request):
+        """Mark the changes of a failed request dirty again"""
+        for obj, names in request.get('sent', []):
+            obj._dirty_props.update(names)
+            obj._update_dirty()
+
+    def _cached_exists(self, cached):
+        """Check that a resource found in the upload cache still exists
+        on the server
+        """
+        resp = Comms.get('api/{mapi}/{uid}'.format(
+            mapi=self._model_api_location, uid=cached['uid']
+        ))
+        return not 400 <= resp['status_code'] < 500
+
+    def _plan_request(self, **kwargs):
+        """Describe the request _upload_request would prepare without
+        sending it or modifying the resource
+
+        Returns None if nothing would be sent. Otherwise returns a
+        dictionary with the 'resource', the 'method' ('post', 'put', or
+        'reference' for content found in the upload cache), the 'url',
+        'files' mapping each file name to its 'dtype', 'raw_bytes' and
+        on-the-wire 'bytes', and the 'changed_bytes' of arrays since they
+        were last uploaded.
+        """
+        new = getattr(self, '_upload_data', None) is None or (
+            getattr(self, '_upload_cached', False) and len(self._dirty) > 0
+        )
+        pending_references = False
+        try:
+            data = self._get_dirty_data(force=new)
+        except ValueError:
+            # References resources that are not uploaded yet
+            data = {}
+            pending_references = True
+        files, _, changed_bytes = patch_files(
+            self._get_dirty_files(force=new),
+            None if new else getattr(self, '_block_digests', None),
+            Comms.array_patching and not new,
+        )
+        files = encode_files(files, kwargs.get('compression', None))
+        cached_children = self._cached_child_props()
+        plan = {
+            'resource': self,
+            'method': 'post' if new else 'put',
+            'url': ('api/' + self._model_api_location if new
+                    else self._api_uid_location),
+            'files': {},
+            'changed_bytes': changed_bytes,
+        }
+        upload_cache = kwargs.get('upload_cache', None)
+        if new and upload_cache is not None and self._is_leaf:
+            digest = payload_digest(self._resource_class, data, files)
+            if digest in upload_cache:
+                plan['method'] = 'reference'
+        for name, fileprop in files.items():
+            raw_bytes, wire_bytes = transfer_nbytes({name: fileprop})
+            plan['files'][name] = {
+                'dtype': getattr(fileprop, 'dtype', None),
+                'raw_bytes': raw_bytes,
+                'bytes': wire_bytes,
+            }
+            fileprop.file.close()
+        if (
+                not new and not data and not files and
+                not pending_references and not cached_children
+        ):
+            return None
+        return plan
+
+    def _cached_child_props(self):
+        """Names of properties that reference cached children which will
+        be posted again, so their new uids must be sent
+        """
+        return set()
+
+    def _upload_monitor(self, request, **kwargs):
+        """Function that records bytes sent for request, if tracked"""
+        progress = kwargs.get('upload_progress', None)
+        if progress is None or request['method'] is None:
+            return None
+        return progress.monitor(self, request)
+
+    def _upload_complete(self, request, **kwargs):
+        """Record a finished upload request and report progress
+
+        Synced resources changed while the request was in flight are
+        queued again.
+        """
+        if request['digest'] is not None:
+            request['upload_cache'].put(request['digest'], self._upload_data)
+        if request['block_digests']:
+            block_digests = dict(getattr(self, '_block_digests', None) or {})
+            block_digests.update(request['block_digests'])
+            self._block_digests = block_digests
+        self._sync = (
+            kwargs.get('sync', False) and
+            not getattr(self, '_upload_cached', False)
+        )
+        if self._sync and 'sync_queue' in kwargs:
+            self._sync_queue = kwargs['sync_queue']
+        if self._sync and self._dirty:
+            self._sync_queue.schedule(self)
+        progress = kwargs.get('upload_progress', None)
+        if progress is not None:
+            progress.complete(self, request)
+
+    @property
+    def _progress_message(self):
+        return 'Uploading: {cls} {title}'.format(
+            cls=self._resource_class,
+            title=self.title
+        )
+
     @staticmethod
     def _progress_report(status):
         print('\rTotal progress: {:>3}% - {}'.format(
@@ -140,26 +433,45 @@ class UserContent(HasSteno3DProps):
     @properties.observer(properties.everything)
     def _on_property_change(self, change):
         if getattr(self, '_sync', False):
-            self._upload(sync=self._sync)
+            self._sync_queue.schedule(self)
 
-    def _post(self, datadict=None, files=None):
+    def batch(self):
+        """Context manager that defers syncing changes to the resources
+        uploaded with this one until the block exits, then uploads them
+        together
+        """
+        return self._sync_queue.batch()
+
+    def _post(self, datadict=None, files=None, monitor=None):
         self._client_upload(Comms.post, 'api/' + self._model_api_location,
-                            datadict, files)
+                            datadict, files, monitor)
+
+    @property
+    def _api_uid_location(self):
+        return 'api/{mapi}/{uid}'.format(mapi=self._model_api_location,
+                                         uid=self._upload_data['uid'])
 
-    def _put(self, datadict=None, files=None):
+    def _put(self, datadict=None, files=None, monitor=None):
         pause()
-        api_uid = 'api/{mapi}/{uid}'.format(mapi=self._model_api_location,
-                                            uid=self._upload_data['uid'])
-        self._client_upload(Comms.put, api_uid, datadict, files)
+        self._client_upload(Comms.put, self._api_uid_location,
+                            datadict, files, monitor)
 
     def _client_upload(self, request_fcn, url,
-                       datadict=None, files=None):
+                       datadict=None, files=None, monitor=None):
         req = request_fcn(
             url,
             data=datadict if datadict else tuple(),
             files=files if files else tuple(),
+            monitor=monitor,
         )
+        self._upload_response(req, url, datadict, files)
+
+    def _upload_response(self, req, url, datadict=None, files=None):
+        """Store the response to an upload request or raise UploadError"""
+        self._request_attempts = getattr(self, '_request_attempts', [])
         if isinstance(req, list):
+            for rq in req:
+                self._request_attempts += rq.get('attempts', [])
             for rq in req:
                 if rq['status_code'] != 200:
                     try:
@@ -181,6 +493,7 @@ class UserContent(HasSteno3DProps):
                     )
             self._upload_data = [rq['json'] for rq in req]
         else:
+            self._request_attempts += req.get('attempts', [])
             if req['status_code'] != 200:
                 raise UploadError(
                     'Upload failed: {location}'.format(
@@ -192,6 +505,9 @@ class UserContent(HasSteno3DProps):
                     ) +
                     '\nresponse: {response}'.format(
                         response=req['json'],
+                    ) +
+                    '\nattempts: {attempts}'.format(
+                        attempts=len(req.get('attempts', [])) or 1,
                     )
                 )
             self._upload_data = req['json']
@@ -205,14 +521,20 @@ class UserContent(HasSteno3DProps):
         return json
 
     @classmethod
-    def _json_from_uid(cls, uid, using=None):
-        if not isinstance(uid, string_types) or len(uid) != 20:
-            raise ValueError('{}: invalid uid'.format(uid))
-        resp = Comms.get('api/{mapi}/{uid}{using}'.format(
+    def _json_location(cls, uid, using=None):
+        """api location of the json for a resource uid"""
+        return 'api/{mapi}/{uid}{using}'.format(
             mapi=cls._model_api_location,
             uid=uid,
             using='?using={}'.format(using) if using else '',
-        ))
+        )
+
+    @classmethod
+    def _json_from_uid(cls, uid, using=None, prefetched=None, cache=None):
+        if not isinstance(uid, string_types) or len(uid) != 20:
+            raise ValueError('{}: invalid uid'.format(uid))
+        resp = Comms.get(cls._json_location(uid, using),
+                         prefetched=prefetched, cache=cache)
         if resp['status_code'] != 200:
             raise ValueError('{uid}: {cls} query failed'.format(
                 uid=uid,
@@ -231,7 +553,12 @@ class UserContent(HasSteno3DProps):
                 cls=cls._resource_class
             ), end=': ')
         if isinstance(src, string_types):
-            json = cls._json_from_uid(src, using=kwargs.get('using', None))
+            json = cls._json_from_uid(
+                src,
+                using=kwargs.get('using', None),
+                prefetched=kwargs.get('prefetched', None),
+                cache=kwargs.get('cache', None),
+            )
         else:
             json = src
         title = '' if json['title'] is None else json['title']
@@ -265,8 +592,11 @@ class BaseResource(UserContent):
 
 
     def _validate_file_size(self, name, arr):
-        if Comms.user.logged_in:
-            file_limit = Comms.user.file_size_limit
+        if not Comms.user.logged_in:
+            return True
+        file_limit = Comms.user.file_size_limit
+
+        def check_size():
             if self._nbytes(arr) > file_limit:
                 raise FileSizeLimitExceeded(
                     '{name} file size ({file} bytes) exceeds limit: '
@@ -274,11 +604,17 @@ class BaseResource(UserContent):
                                          file=self._nbytes(arr),
                                          lim=file_limit)
                 )
+        if arr is not None and arr is self._backend.get(name, None):
+            return self._cached_check('file_size:' + name, (name,),
+                                      check_size, key=file_limit)
+        check_size()
         return True
 
 
 class CompositeResource(BaseResource):
     """A composite resource that stores references to lower-level objects."""
+    _backref_props = ('project',)
+
     project = properties.List(
         doc='Project containing the resource',
         prop=UserContent,
@@ -305,7 +641,7 @@ class CompositeResource(BaseResource):
     @properties.validator
     def _validate_proj(self):
         for proj in self.project:
-            if self not in proj.resources:
+            if not proj._contains_resource(self):
                 raise ValueError('Project/resource pointers misaligned: '
                                  'Ensure that projects contain all the '
                                  'resources that point to them.')
@@ -323,6 +659,35 @@ class CompositeResource(BaseResource):
 
 
 
+    def add_data(self, data):
+        """Add one or a list of data binders in a single update
+
+        Binders may be given as dictionaries with 'location' and 'data'.
+        """
+        self._add_items('data', data)
+
+    def remove_data(self, data):
+        """Remove one or a list of data binders, or the data they
+        contain, in a single update
+        """
+        self._remove_items('data', data, lambda binder: binder.data)
+
+    def _add_items(self, name, items):
+        if not isinstance(items, (list, tuple)):
+            items = [items]
+        setattr(self, name, getattr(self, name) + list(items))
+
+    def _remove_items(self, name, items, contents=None):
+        if not isinstance(items, (list, tuple)):
+            items = [items]
+        removed = set(id(item) for item in items)
+        setattr(self, name, [
+            item for item in getattr(self, name)
+            if id(item) not in removed and (
+                contents is None or id(contents(item)) not in removed
+            )
+        ])
+
     def _get_dirty_data(self, force=False):
         datadict = super(CompositeResource, self)._get_dirty_data(force)
         dirty = self._dirty_props
@@ -345,14 +710,39 @@ class CompositeResource(BaseResource):
             ])
         return datadict
 
-    def _upload_dirty(self, **kwargs):
-        dirty = self._dirty
+    def _dirty_children(self, mark=True):
+        """Meshes, data and textures that must upload before this resource
+
+        Properties that reference cached children which will be posted
+        again are marked dirty, unless mark is False.
+        """
+        cached = self._cached_child_props()
+        if mark:
+            for name in cached:
+                self._add_dirty_prop(name)
+        dirty = self._dirty.union(cached)
+        children = []
         if 'mesh' in dirty:
-            self.mesh._upload(**kwargs)
+            children += [self.mesh]
         if 'data' in dirty:
-            [d.data._upload(**kwargs) for d in self.data]
+            children += [d.data for d in self.data]
         if 'textures' in dirty:
-            [t._upload(**kwargs) for t in self.textures]
+            children += self.textures
+        return children
+
+    def _cached_child_props(self):
+        children = [('mesh', self.mesh)]
+        children += [('data', d.data) for d in self.data]
+        children += [('textures', t) for t in getattr(self, 'textures', [])]
+        return set(
+            name for name, child in children
+            if getattr(child, '_upload_cached', False) and child._dirty
+        )
+
+    def _upload_dirty(self, **kwargs):
+        if kwargs.get('children_uploaded', False):
+            return
+        [child._upload(**kwargs) for child in self._dirty_children()]
 
     @properties.observer('project')
     def _fix_proj_res(self, change):
@@ -362,14 +752,18 @@ class CompositeResource(BaseResource):
             before = []
         if after in (None, properties.undefined):
             after = []
+        before_ids = set(id(proj) for proj in before)
+        after_ids = set(id(proj) for proj in after)
         for proj in after:
-            if proj not in before and self not in proj.resources:
-                proj.resources += [self]
+            if (
+                    id(proj) not in before_ids and
+                    not proj._contains_resource(self)
+            ):
+                proj.add_resources(self)
         for proj in before:
-            if proj not in after and self in proj.resources:
-                proj.resources = [r for r in proj.resources
-                                  if r is not self]
-        if len(set(after)) != len(after):
+            if id(proj) not in after_ids and proj._contains_resource(self):
+                proj.remove_resources(self)
+        if len(after_ids) != len(after):
             post_post = []
             for p in after:
                 if p not in post_post:
@@ -416,7 +810,8 @@ class CompositeResource(BaseResource):
         mesh_class = UserContent._REGISTRY[mesh_string]
 
         res.mesh = mesh_class._build(mesh_uid, copy, tab_level + '    ',
-                                     using=kwargs.get('using', None))
+                                     using=kwargs.get('using', None),
+                                     **download_kwargs(kwargs))
 
         if 'textures' in json:
             res.textures = []
@@ -428,6 +823,7 @@ class CompositeResource(BaseResource):
                 res.textures += [tex_class._build(
                     tex_uid, copy, tab_level + '    ',
                     using=kwargs.get('using', None),
+                    **download_kwargs(kwargs)
                 )]
 
         if 'data' in json:
@@ -442,6 +838,7 @@ class CompositeResource(BaseResource):
                     data=data_class._build(
                         data_uid, copy, tab_level + '    ',
                         using=kwargs.get('using', None),
+                        **download_kwargs(kwargs)
                     )
                 )]
 
@@ -502,8 +899,11 @@ class BaseMesh(BaseResource):
 
     @properties.validator
     def _validate_mesh(self):
-        if Comms.user.logged_in:
-            file_limit = Comms.user.file_size_limit
+        if not Comms.user.logged_in:
+            return True
+        file_limit = Comms.user.file_size_limit
+
+        def check_size():
             if self._nbytes() > file_limit:
                 raise FileSizeLimitExceeded(
                     '{name} size ({file} bytes) exceeds limit: '
@@ -511,7 +911,8 @@ class BaseMesh(BaseResource):
                                          file=self._nbytes(),
                                          lim=file_limit)
                 )
-        return True
+        return self._cached_check('mesh_size', tuple(self._props),
+                                  check_size, key=file_limit)
 
 class BaseData(BaseResource):
     """Base class for all data resources. These can be contained within
@@ -0,0 +1,408 @@
+"""cache.py contains local caches that let the steno3d client avoid
+re-sending or re-downloading content the server already has
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from hashlib import sha256
+from json import dump, dumps, load, loads
+from os import makedirs, path, remove
+from threading import RLock
+from uuid import uuid4
+
+import numpy as np
+
+from .client import Comms
+
+try:
+    from os import replace
+except ImportError:
+    from os import rename as replace
+
+
+CACHE_DIRECTORY = path.sep.join([path.expanduser('~'), '.steno3d_client'])
+UPLOAD_CACHE_FILE = 'upload_cache.json'
+UPLOAD_CACHE_ENTRIES = 10000
+DOWNLOAD_CACHE_DIRECTORY = path.sep.join([CACHE_DIRECTORY, 'downloads'])
+DOWNLOAD_CACHE_INDEX = 'index.json'
+DOWNLOAD_CACHE_BYTES = 2 << 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _update_with_file(hasher, fileobj):
+    """Feed the contents of a serialized file into hasher"""
+    if hasattr(fileobj, 'buffer'):
+        hasher.update(fileobj.buffer)
+        return
+    fileobj.seek(0)
+    hasher.update(fileobj.read())
+    fileobj.seek(0)
+
+
+def payload_digest(resource_class, datadict, files):
+    """Digest of everything that would be sent to create a resource"""
+    hasher = sha256()
+    hasher.update(resource_class.encode('utf-8'))
+    hasher.update(dumps(datadict, sort_keys=True).encode('utf-8'))
+    for name in sorted(files):
+        fileprop = files[name]
+        hasher.update(name.encode('utf-8'))
+        if hasattr(fileprop, 'dtype'):
+            hasher.update(fileprop.dtype.encode('utf-8'))
+            fileprop = fileprop.file
+        _update_with_file(hasher, fileprop)
+    return hasher.hexdigest()
+
+
+class UploadCache(object):
+    """Content-addressed cache of previously uploaded resources
+
+    Maps a digest of the serialized payload of a mesh, data array or
+    texture to the uid of the server resource created from it, so
+    identical content is referenced instead of uploaded again. Entries
+    are namespaced by endpoint and user, evicted least-recently-used
+    beyond max_entries, and saved as JSON next to the credentials file.
+
+    Optional arguments:
+        filename    - Cache file location
+                      (Default: ~/.steno3d_client/upload_cache.json)
+        max_entries - Maximum number of cached resources (Default: 10000)
+    """
+
+    def __init__(self, filename=None, max_entries=UPLOAD_CACHE_ENTRIES):
+        if filename is None:
+            filename = path.sep.join([CACHE_DIRECTORY, UPLOAD_CACHE_FILE])
+        self.filename = path.realpath(path.expanduser(filename))
+        self.max_entries = max_entries
+        self._entries = None
+        self._lock = RLock()
+
+    @staticmethod
+    def _namespace():
+        return '{url}|{user}'.format(url=Comms.base_url,
+                                     user=Comms.user.username)
+
+    @property
+    def entries(self):
+        """Ordered mapping of namespaced digests to resource json"""
+        with self._lock:
+            if self._entries is None:
+                self._entries = OrderedDict()
+                if path.isfile(self.filename):
+                    try:
+                        with open(self.filename, 'r') as cache_file:
+                            self._entries.update(load(cache_file))
+                    except ValueError:
+                        pass
+            return self._entries
+
+    def get(self, digest):
+        """Return the cached resource json for digest, or None"""
+        key = '{}|{}'.format(self._namespace(), digest)
+        with self._lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def __contains__(self, digest):
+        key = '{}|{}'.format(self._namespace(), digest)
+        with self._lock:
+            return key in self.entries
+
+    def put(self, digest, json):
+        """Record the uploaded resource json for digest"""
+        key = '{}|{}'.format(self._namespace(), digest)
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = {
+                'uid': json['uid'],
+                'longUid': json['longUid'],
+            }
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def remove(self, digest):
+        """Forget the resource recorded for digest"""
+        key = '{}|{}'.format(self._namespace(), digest)
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries for every endpoint and user"""
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def save(self):
+        """Write the cache to disk"""
+        with self._lock:
+            if self._entries is None:
+                return
+            directory = path.dirname(self.filename)
+            if not path.isdir(directory):
+                makedirs(directory)
+            partial = '{}.{}'.format(self.filename, uuid4().hex)
+            with open(partial, 'w') as cache_file:
+                dump(list(self._entries.items()), cache_file)
+            replace(partial, self.filename)
+
+
+class CachedResponse(object):
+    """Response served from a DownloadCache file, with the parts of the
+    requests.Response interface that steno3d uses
+
+    not_modified is True if the server confirmed the cached copy with a
+    304 response, so the body was not transferred again. The body is
+    read from the cached file when it is used, unless it was read into
+    memory with load().
+    """
+
+    def __init__(self, filename, headers, not_modified=False):
+        self.status_code = 200
+        self.filename = filename
+        self.headers = headers
+        self.not_modified = not_modified
+        self._content = None
+
+    def load(self):
+        """Read the body into memory, so the response can still be used
+        after the cached file is evicted
+        """
+        if self._content is None:
+            with open(self.filename, 'rb') as cached:
+                self._content = cached.read()
+        return self
+
+    @property
+    def content(self):
+        if self._content is not None:
+            return self._content
+        with open(self.filename, 'rb') as cached:
+            return cached.read()
+
+    def json(self):
+        return loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        if self._content is not None:
+            for start in range(0, len(self._content), chunk_size):
+                yield self._content[start:start + chunk_size]
+            return
+        with open(self.filename, 'rb') as cached:
+            while True:
+                chunk = cached.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def __iter__(self):
+        return self.iter_content()
+
+    def read_buffer(self):
+        """Read the cached body into a numpy buffer in one pass
+
+        The file is not kept open, so it can be evicted while the
+        array is in use.
+        """
+        if self._content is not None:
+            return np.frombuffer(self._content, dtype=np.uint8).copy()
+        return np.fromfile(self.filename, dtype=np.uint8)
+
+    def close(self):
+        pass
+
+
+class DownloadCache(object):
+    """Persistent cache of downloaded resource json, arrays and images
+
+    Responses are stored by url, namespaced by endpoint and user, if the
+    server sends an ETag or Last-Modified header with them. Cached
+    copies are revalidated with conditional requests, and a 304
+    response serves the body from disk without transferring it again.
+    Bodies are evicted least-recently-used once their total size
+    exceeds max_bytes; the most recent body is always kept. The index
+    is saved with save().
+
+    Optional arguments:
+        directory - Cache location
+                    (Default: ~/.steno3d_client/downloads)
+        max_bytes - Maximum total size of cached bodies (Default: 2 GiB)
+    """
+
+    def __init__(self, directory=None, max_bytes=DOWNLOAD_CACHE_BYTES):
+        if directory is None:
+            directory = DOWNLOAD_CACHE_DIRECTORY
+        self.directory = path.realpath(path.expanduser(directory))
+        self.max_bytes = max_bytes
+        self._entries = None
+        self._nbytes = 0
+        self._lock = RLock()
+
+    @property
+    def entries(self):
+        """Ordered mapping of cache keys to the url, validators, headers
+        and size of cached bodies
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = OrderedDict()
+                filename = path.join(self.directory, DOWNLOAD_CACHE_INDEX)
+                if path.isfile(filename):
+                    try:
+                        with open(filename, 'r') as index_file:
+                            self._entries.update(load(index_file))
+                    except ValueError:
+                        pass
+                self._nbytes = sum(
+                    entry['size'] for entry in self._entries.values()
+                )
+                self._evict()
+            return self._entries
+
+    @property
+    def nbytes(self):
+        """Total size of the cached bodies"""
+        with self._lock:
+            self.entries
+            return self._nbytes
+
+    @staticmethod
+    def _key(url):
+        return sha256('{url}|{user}|{target}'.format(
+            url=Comms.base_url,
+            user=Comms.user.username,
+            target=url,
+        ).encode('utf-8')).hexdigest()
+
+    def fetch(self, request_fcn, url, **kwargs):
+        """Make a GET request through the cache
+
+        Returns the response and the request attempts, as Comms._send.
+        Cached or newly stored bodies are returned as CachedResponse.
+        """
+        key = self._key(url)
+        filename = path.join(self.directory, key)
+        with self._lock:
+            entry = self.entries.get(key, None)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None and path.isfile(filename):
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        else:
+            entry = None
+        kwargs['stream'] = True
+        resp, attempts = Comms._send(request_fcn, url, headers=headers,
+                                     **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            resp.close()
+            with self._lock:
+                if self.entries.pop(key, None) is not None:
+                    self.entries[key] = entry
+            return CachedResponse(filename, entry['headers'], True), attempts
+        etag = resp.headers.get('ETag', None)
+        last_modified = resp.headers.get('Last-Modified', None)
+        if resp.status_code != 200 or not (etag or last_modified):
+            return resp, attempts
+        entry = self._store(key, url, resp, etag, last_modified)
+        return CachedResponse(filename, entry['headers']), attempts
+
+    def _store(self, key, url, resp, etag, last_modified):
+        """Write a response body to the cache"""
+        if not path.isdir(self.directory):
+            try:
+                makedirs(self.directory)
+            except OSError:
+                if not path.isdir(self.directory):
+                    raise
+        filename = path.join(self.directory, key)
+        partial = '{}.{}'.format(filename, uuid4().hex)
+        size = 0
+        try:
+            with open(partial, 'wb') as cached:
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    cached.write(chunk)
+                    size += len(chunk)
+            replace(partial, filename)
+        except Exception:
+            if path.isfile(partial):
+                remove(partial)
+            raise
+        headers = {'Content-Length': str(size)}
+        if etag:
+            headers['ETag'] = etag
+        if last_modified:
+            headers['Last-Modified'] = last_modified
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': size,
+            'headers': headers,
+        }
+        with self._lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self._nbytes -= previous['size']
+            self.entries[key] = entry
+            self._nbytes += size
+            self._evict()
+        return entry
+
+    def _evict(self):
+        """Remove least-recently-used bodies beyond max_bytes
+
+        Bodies that cannot be removed, such as files still open on
+        Windows, stay in the index and in the size of the cache, so
+        they are removed by a later eviction.
+        """
+        with self._lock:
+            kept = []
+            kept_bytes = 0
+            while (
+                    self._nbytes - kept_bytes > self.max_bytes and
+                    len(self._entries) > 1
+            ):
+                key, entry = self._entries.popitem(last=False)
+                filename = path.join(self.directory, key)
+                try:
+                    remove(filename)
+                except OSError:
+                    if path.exists(filename):
+                        kept += [(key, entry)]
+                        kept_bytes += entry['size']
+                        continue
+                self._nbytes -= entry['size']
+            if kept:
+                self._entries = OrderedDict(
+                    kept + list(self._entries.items())
+                )
+
+    def clear(self):
+        """Remove all cached bodies for every endpoint and user"""
+        with self._lock:
+            for key in self.entries:
+                try:
+                    remove(path.join(self.directory, key))
+                except OSError:
+                    pass
+            self._entries = OrderedDict()
+            self._nbytes = 0
+
+    def save(self):
+        """Write the cache index to disk"""
+        with self._lock:
+            if self._entries is None:
+                return
+            if not path.isdir(self.directory):
+                makedirs(self.directory)
+            filename = path.join(self.directory, DOWNLOAD_CACHE_INDEX)
+            partial = '{}.{}'.format(filename, uuid4().hex)
+            with open(partial, 'w') as index_file:
+                dump(list(self._entries.items()), index_file)
+            replace(partial, filename)
@@ -7,23 +7,42 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from contextlib import contextmanager
 from functools import wraps
-from os import mkdir
+from hashlib import sha256
+from json import dump, dumps, load
+from multiprocessing.pool import ThreadPool
+from os import makedirs, mkdir
 from os import path
-from time import sleep
+from random import uniform
+from threading import Condition, Lock
+from time import sleep, time
+from uuid import uuid4
 
 import requests
-from six import string_types
+from requests.adapters import HTTPAdapter
+from six import integer_types, string_types, text_type
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
 from six.moves import input
 from six.moves.urllib.parse import urlparse
 
 from .user import User
 
+try:
+    from os import replace
+except ImportError:
+    from os import rename as replace
+
 
 __version__ = '0.3.12'
 
 PRODUCTION_BASE_URL = 'https://steno3d.com/'
 SLEEP_TIME = .75
+DEFAULT_POOL_SIZE = 10
+CHUNK_SIZE = 4*1024*1024
+UPLOAD_JOURNAL = path.sep.join([path.expanduser('~'), '.steno3d_client',
+                                'upload_journal.json'])
 
 DEVKEY_PROMPT = "If you have a Steno3D developer key, please enter it here > "
 
@@ -138,6 +157,174 @@ def pause():
         sleep(SLEEP_TIME)
 
 
+class WorkerPool(object):
+    """Bounded pool of worker threads that tracks outstanding tasks
+
+    Tasks may submit further tasks to the pool while they run. join()
+    blocks until every submitted task has finished and returns the
+    (item, exception) pairs for the tasks that failed, in the order
+    they failed.
+    """
+
+    def __init__(self, workers):
+        self._pool = ThreadPool(workers)
+        self._condition = Condition()
+        self._outstanding = 0
+        self.errors = []
+
+    def submit(self, func, item):
+        """Schedule func(item) on the pool"""
+        with self._condition:
+            self._outstanding += 1
+        self._pool.apply_async(self._run, (func, item))
+
+    def _run(self, func, item):
+        try:
+            func(item)
+        except Exception as err:
+            with self._condition:
+                self.errors.append((item, err))
+        finally:
+            with self._condition:
+                self._outstanding -= 1
+                if self._outstanding == 0:
+                    self._condition.notify_all()
+
+    def join(self):
+        """Wait for all tasks, shut down the pool and return errors"""
+        with self._condition:
+            while self._outstanding > 0:
+                self._condition.wait()
+        self._pool.close()
+        self._pool.join()
+        return self.errors
+
+
+class MultipartStream(object):
+    """Multipart form body that is read in place from its parts
+
+    Array buffers are streamed without being copied into one body, and
+    the number of newly sent bytes is passed to monitor as the body is
+    read. Bytes re-read after seeking back for a retry are not reported
+    again.
+    """
+
+    def __init__(self, fields, monitor=None):
+        boundary = choose_boundary()
+        parts = []
+        for name, value, filename in fields:
+            if isinstance(value, text_type):
+                value = value.encode('utf-8')
+            field = RequestField(name=name, data=value, filename=filename)
+            field.make_multipart()
+            parts += [
+                '--{}\r\n'.format(boundary).encode('utf-8') +
+                field.render_headers().encode('utf-8'),
+                memoryview(value),
+                b'\r\n',
+            ]
+        parts += ['--{}--\r\n'.format(boundary).encode('utf-8')]
+        self.content_type = 'multipart/form-data; boundary={}'.format(
+            boundary
+        )
+        self._parts = [memoryview(part) for part in parts]
+        self._length = sum(len(part) for part in self._parts)
+        self._monitor = monitor
+        self._reported = 0
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise ValueError('MultipartStream can only seek to the start')
+        self._position = 0
+        self._index = 0
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._position
+        chunks = []
+        remaining = size
+        while remaining > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            chunk = part[self._offset:self._offset + remaining]
+            chunks += [chunk]
+            remaining -= len(chunk)
+            self._offset += len(chunk)
+            if self._offset >= len(part):
+                self._index += 1
+                self._offset = 0
+        self._position += size - remaining
+        if self._monitor is not None and self._position > self._reported:
+            self._monitor(self._position - self._reported)
+            self._reported = self._position
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunk.tobytes() for chunk in chunks)
+
+
+class RetryPolicy(object):
+    """Policy for retrying requests that fail transiently
+
+    Requests that raise a connection error or time out, or that return
+    one of retry_statuses, are retried after an exponentially growing
+    delay with full jitter: attempt n waits a random time between 0 and
+    min(max_backoff, backoff * 2**n) seconds, or longer if the server
+    sends a Retry-After header. Requests that are not idempotent may
+    have been processed by the server when these failures occur, so
+    they are only retried if they could not connect.
+
+    Optional arguments:
+        max_retries    - Number of retries after the first attempt
+                         (Default: 3)
+        backoff        - Base delay in seconds (Default: 0.5)
+        max_backoff    - Maximum delay in seconds (Default: 30)
+        retry_statuses - HTTP status codes that are retried
+                         (Default: 500, 502, 503, 504)
+    """
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30.,
+                 retry_statuses=(500, 502, 503, 504)):
+        if not isinstance(max_retries, integer_types) or max_retries < 0:
+            raise ValueError('max_retries must be a non-negative integer')
+        if backoff < 0 or max_backoff < 0:
+            raise ValueError('backoff must be non-negative')
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def should_retry(self, attempt, response=None, error=None,
+                     idempotent=True):
+        """Return True if a failed attempt (counted from 0) is retried"""
+        if attempt >= self.max_retries:
+            return False
+        if not idempotent:
+            return isinstance(error, requests.ConnectTimeout)
+        if error is not None:
+            return isinstance(error, (requests.ConnectionError,
+                                      requests.Timeout))
+        return response.status_code in self.retry_statuses
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before retrying after attempt"""
+        delay = uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', None)
+        try:
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+
 class _Comms(object):
     """Comms controls the interaction between the python client and the
     Steno3D website.
@@ -147,6 +334,108 @@ class _Comms(object):
         self.user = User()
         self._base_url = PRODUCTION_BASE_URL
         self._hard_devel_key = None
+        self._pool_size = DEFAULT_POOL_SIZE
+        self._pool_reserved = []
+        self._mounted_pool_size = None
+        self._session = None
+        self._session_lock = Lock()
+        self.chunk_threshold = None
+        self.chunk_size = CHUNK_SIZE
+        self.journal_file = UPLOAD_JOURNAL
+        self._journal_lock = Lock()
+        self.array_encodings = set()
+        self.array_patching = False
+        self.idempotency_keys = False
+        self.retry_policy = RetryPolicy()
+
+    @property
+    def session(self):
+        """Persistent HTTP session shared by all requests
+
+        The session keeps connections alive between requests, stores
+        cookies returned by the server, and is safe to share between
+        upload worker threads.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    self._mounted_pool_size = self._mount_adapters(
+                        session, self._pool_target()
+                    )
+                    self._session = session
+        return self._session
+
+    @property
+    def pool_size(self):
+        """Maximum number of connections kept open per host"""
+        return self._pool_size
+
+    @pool_size.setter
+    def pool_size(self, value):
+        if not isinstance(value, integer_types) or value < 1:
+            raise ValueError('pool_size must be a positive integer')
+        self._pool_size = value
+        self._resize_pool()
+
+    @contextmanager
+    def _reserve_pool(self, size):
+        """Keep at least size connections open per host within the block
+
+        Once the block exits, the pool returns to pool_size or to the
+        largest size still reserved by another block.
+        """
+        if not size:
+            yield
+            return
+        with self._session_lock:
+            self._pool_reserved += [size]
+        self._resize_pool()
+        try:
+            yield
+        finally:
+            with self._session_lock:
+                self._pool_reserved.remove(size)
+            self._resize_pool()
+
+    def _pool_target(self):
+        return max([self._pool_size] + self._pool_reserved)
+
+    def _resize_pool(self):
+        """Remount the session adapters if the pool size changed"""
+        with self._session_lock:
+            size = self._pool_target()
+            if self._session is None or size == self._mounted_pool_size:
+                return
+            self._mounted_pool_size = self._mount_adapters(
+                self._session, size
+            )
+
+    def _mount_adapters(self, session, pool_size=None):
+        """Mount adapters pooling pool_size connections on a session
+
+        Adapters replaced on the session are closed. Returns the pool
+        size mounted.
+        """
+        pool_size = pool_size or self.pool_size
+        replaced = set(session.adapters.values())
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        for old in replaced - set(session.adapters.values()):
+            # Requests in flight finish on their connections, which are
+            # then discarded instead of returned to the closed pool
+            old.close()
+        return pool_size
+
+    def _close_session(self):
+        """Close pooled connections and discard session cookies"""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._mounted_pool_size = None
 
     @property
     def host(self):
@@ -292,7 +581,7 @@ class _Comms(object):
     def _version_ok(self, verbose=True):
         """Check current Steno3D client version in the database"""
         try:
-            resp = requests.post(
+            resp = self.session.post(
                 self.base_url + 'api/client/steno3dpy',
                 dict(version=__version__),
                 timeout=120,
@@ -303,6 +592,11 @@ class _Comms(object):
             return False
         if resp.status_code == 200:
             resp_json = resp.json()
+            self.array_encodings = set(resp_json.get('encodings', []))
+            self.array_patching = bool(resp_json.get('patches', False))
+            self.idempotency_keys = bool(
+                resp_json.get('idempotency', False)
+            )
             your_ver_str = resp_json['your_version']
             your_ver = [int(v) for v in your_ver_str.split('.')]
             curr_ver_str = resp_json['current_version']
@@ -349,7 +643,7 @@ class _Comms(object):
                 print(BAD_API_KEY.format(base_url=self.base_url))
             return
         try:
-            resp = requests.get(
+            resp = self.session.get(
                 self.base_url + 'api/me',
                 headers={'sshKey': devel_key,
                          'client': 'steno3dpy:{}'.format(__version__)},
@@ -366,7 +660,6 @@ class _Comms(object):
             return
         self.user.login_with_json(resp.json())
         self.user.set_key(devel_key)
-        self._cookies = dict(resp.cookies)
         if verbose:
             print(
                 'Welcome to Steno3D! You are logged in as @{name}'.format(
@@ -389,67 +682,305 @@ class _Comms(object):
                 print('Logging out of steno3d...')
             headers = {'sshKey': Comms.user.devel_key,
                        'client': 'steno3dpy:{}'.format(__version__)}
-            requests.get(
+            self.session.get(
                 Comms.base_url + 'signout',
                 headers=headers,
-                cookies=Comms._cookies,
                 timeout=120,
             )
 
             if verbose:
                 print('Goodbye, @{}.'.format(self.user.username))
+        self._close_session()
         self._base_url = PRODUCTION_BASE_URL
         self.user.logout()
 
     @staticmethod
-    def post(url, data=None, files=None):
+    def post(url, data=None, files=None, monitor=None):
         """Post data and files to the steno3d online endpoint"""
-        return _Comms._communicate(requests.post, url, data, files)
+        return _Comms._communicate(Comms.session.post, url, data, files,
+                                   monitor)
 
     @staticmethod
-    def put(url, data=None, files=None):
+    def put(url, data=None, files=None, monitor=None):
         """Put data and files to the steno3d online endpoint"""
-        return _Comms._communicate(requests.put, url, data, files)
+        return _Comms._communicate(Comms.session.put, url, data, files,
+                                   monitor)
 
     @staticmethod
-    def get(url):
-        """Make a get request from a steno3d online endpoint"""
-        return _Comms._communicate(requests.get, url, None, None)
+    def get(url, prefetched=None, cache=None):
+        """Make a get request from a steno3d online endpoint
+
+        Optional prefetched responses and DownloadCache are used as by
+        Comms._send.
+        """
+        return _Comms._communicate(Comms.session.get, url, None, None,
+                                   prefetched=prefetched, cache=cache)
 
     @staticmethod
-    def _communicate(request_fcn, url, data, files):
-        """Post data and files to the steno3d online endpoint"""
-        data = {} if data is None else data
-        files = {} if files is None else files
-        filedict = {}
-        for filename in files:
-            if hasattr(files[filename], 'dtype'):
-                filedict[filename] = files[filename].file
-                filedict[filename + 'Type'] = files[filename].dtype
-            else:
-                filedict[filename] = files[filename]
+    def _headers():
         headers = {'sshKey': Comms.user.devel_key,
                    'client': 'steno3dpy:{}'.format(__version__)}
         if getattr(Comms, 'extra_headers', None):
             headers.update(Comms.extra_headers)
-        req = request_fcn(
-            Comms.base_url + url,
-            data=data,
-            files=filedict,
-            headers=headers,
-            cookies=Comms._cookies,
-            timeout=120,
-        )
-        if req.status_code < 210:
-            Comms._cookies.update(req.cookies)
-        for key in files:
-            files[key].file.close()
+        return headers
 
+    @staticmethod
+    def _response(req, attempts=None):
         try:
             resp = req.json()
         except ValueError:
             resp = req
-        return {"status_code": req.status_code, "json": resp}
+        response = {"status_code": req.status_code, "json": resp}
+        if attempts is not None:
+            response['attempts'] = attempts
+        return response
+
+    def _send(self, request_fcn, url, files=None, prefetched=None,
+              cache=None, **kwargs):
+        """Make a request, retrying according to Comms.retry_policy
+
+        Every attempt of the request carries the same Idempotency-Key
+        header so the server can recognize a retried POST whose first
+        attempt succeeded but whose response was lost. POSTs are only
+        retried after such failures if the server advertised support
+        for the header, recorded in Comms.idempotency_keys. Files are
+        rewound before each attempt. Returns the final response and a list with
+        the 'status_code', 'error' and 'elapsed' seconds of each attempt;
+        if the final attempt raised, the error is re-raised.
+
+        Responses already fetched may be given as prefetched, by url;
+        requests for those urls without data or files then return the
+        prefetched response. If a DownloadCache is given as cache, GET
+        requests go through it.
+        """
+        if not files and not kwargs.get('data') and url in (prefetched or {}):
+            return prefetched[url], []
+        if (
+                cache is not None and
+                request_fcn == self.session.get and
+                not files
+        ):
+            return cache.fetch(request_fcn, url, **kwargs)
+        body = kwargs.get('data', None)
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.setdefault('Idempotency-Key', uuid4().hex)
+        policy = self.retry_policy or RetryPolicy(max_retries=0)
+        idempotent = (
+            getattr(request_fcn, '__name__', None) != 'post' or
+            self.idempotency_keys
+        )
+        attempts = []
+        attempt = 0
+        while True:
+            for fileobj in list((files or {}).values()) + [body]:
+                if hasattr(fileobj, 'seek'):
+                    fileobj.seek(0)
+            start = time()
+            resp, error = None, None
+            try:
+                resp = request_fcn(url, files=files, headers=headers,
+                                   **kwargs)
+            except requests.RequestException as err:
+                error = err
+            attempts += [{
+                'status_code': getattr(resp, 'status_code', None),
+                'error': None if error is None else repr(error),
+                'elapsed': time() - start,
+            }]
+            if not policy.should_retry(attempt, resp, error, idempotent):
+                break
+            sleep(policy.delay(attempt, resp))
+            attempt += 1
+        if error is not None:
+            raise error
+        return resp, attempts
+
+    @staticmethod
+    def _communicate(request_fcn, url, data, files, monitor=None,
+                     **kwargs):
+        """Post data and files to the steno3d online endpoint
+
+        If Comms.chunk_threshold is set, files larger than the threshold
+        are first transferred in chunks and referenced by upload id.
+        Files are streamed as a MultipartStream; if given, monitor is
+        called with the number of bytes sent as the body is read. Other
+        keyword arguments are passed to Comms._send.
+        """
+        data = dict(data) if data else {}
+        files = {} if files is None else files
+        fields = []
+        upload_keys = []
+        for filename in files:
+            if hasattr(files[filename], 'dtype'):
+                fileobj = files[filename].file
+                fields += [(filename + 'Type', files[filename].dtype,
+                            filename + 'Type')]
+            else:
+                fileobj = files[filename]
+            if getattr(fileobj, 'array_encoding', None):
+                fields += [(filename + 'Encoding', fileobj.array_encoding,
+                            filename + 'Encoding')]
+            if getattr(fileobj, 'patch', None):
+                fields += [(filename + 'Patch', dumps(fileobj.patch),
+                            filename + 'Patch')]
+            if (
+                    Comms.chunk_threshold is not None and
+                    _file_size(fileobj) > Comms.chunk_threshold
+            ):
+                key, upload_id, failed = Comms._upload_chunked(fileobj,
+                                                               monitor)
+                if failed is not None:
+                    for name in files:
+                        files[name].file.close()
+                    return failed
+                upload_keys += [key]
+                data[filename + 'Upload'] = upload_id
+            else:
+                fileobj.seek(0)
+                fields += [(filename, _file_content(fileobj),
+                            getattr(fileobj, 'name', None) or filename)]
+        headers = _Comms._headers()
+        if fields:
+            fields = [(name, '{}'.format(value), None)
+                      for name, value in data.items()] + fields
+            data = MultipartStream(fields, monitor)
+            headers['Content-Type'] = data.content_type
+        try:
+            req, attempts = Comms._send(
+                request_fcn,
+                Comms.base_url + url,
+                data=data,
+                headers=headers,
+                timeout=120,
+                **kwargs
+            )
+        finally:
+            for key in files:
+                files[key].file.close()
+        if req.status_code == 200 and upload_keys:
+            Comms._update_journal(upload_keys, None)
+        return _Comms._response(req, attempts)
+
+    def _upload_chunked(self, fileobj, monitor=None):
+        """Transfer a file in chunks of Comms.chunk_size bytes
+
+        Chunked uploads use the following requests:
+
+        - POST api/upload/chunked with 'size' and 'digest' starts an
+          upload and returns its 'uploadId'
+        - GET api/upload/chunked/<uploadId> returns the acknowledged
+          'offset'
+        - PUT api/upload/chunked/<uploadId> with 'offset' and a 'chunk'
+          file appends the chunk and returns the new 'offset'
+
+        Upload ids are recorded in a journal keyed by file digest, so an
+        interrupted upload resumes from the last acknowledged chunk.
+        Returns the journal key, the upload id, and the failed response
+        if the transfer could not be completed.
+        """
+        size = _file_size(fileobj)
+        hasher = sha256()
+        fileobj.seek(0)
+        hasher.update(fileobj.read())
+        digest = hasher.hexdigest()
+        key = '{url}|{user}|{digest}'.format(
+            url=self.base_url, user=self.user.username, digest=digest
+        )
+        api_url = self.base_url + 'api/upload/chunked'
+        upload_id = self._read_journal().get(key, None)
+        offset = None
+        if upload_id is not None:
+            resp = self._response(*self._send(
+                self.session.get,
+                '{}/{}'.format(api_url, upload_id),
+                headers=self._headers(),
+                timeout=120,
+            ))
+            if resp['status_code'] == 200:
+                offset = resp['json']['offset']
+        if offset is None:
+            resp = self._response(*self._send(
+                self.session.post,
+                api_url,
+                data={'size': size, 'digest': digest},
+                headers=self._headers(),
+                timeout=120,
+            ))
+            if resp['status_code'] != 200:
+                return key, None, resp
+            upload_id = resp['json']['uploadId']
+            offset = resp['json'].get('offset', 0)
+            self._update_journal([key], upload_id)
+        while offset < size:
+            fileobj.seek(offset)
+            resp = self._response(*self._send(
+                self.session.put,
+                '{}/{}'.format(api_url, upload_id),
+                data={'offset': offset},
+                files={'chunk': ('chunk', fileobj.read(self.chunk_size))},
+                headers=self._headers(),
+                timeout=120,
+            ))
+            if resp['status_code'] not in (200, 409):
+                return key, upload_id, resp
+            if monitor is not None and resp['json']['offset'] > offset:
+                monitor(resp['json']['offset'] - offset)
+            offset = resp['json']['offset']
+        return key, upload_id, None
+
+    def _read_journal(self):
+        with self._journal_lock:
+            return self._load_journal()
+
+    def _load_journal(self):
+        if not path.isfile(self.journal_file):
+            return {}
+        try:
+            with open(self.journal_file, 'r') as journal:
+                return load(journal)
+        except ValueError:
+            return {}
+
+    def _update_journal(self, keys, upload_id):
+        """Record upload_id for keys, or remove keys if upload_id is None
+
+        The journal is read and written under one hold of the lock, and
+        written to a temporary file that replaces it, so it is never
+        read partially written.
+        """
+        with self._journal_lock:
+            journal = self._load_journal()
+            for key in keys:
+                if upload_id is None:
+                    journal.pop(key, None)
+                else:
+                    journal[key] = upload_id
+            directory = path.dirname(self.journal_file)
+            if not path.isdir(directory):
+                makedirs(directory)
+            partial = '{}.{}'.format(self.journal_file, uuid4().hex)
+            with open(partial, 'w') as journal_file:
+                dump(journal, journal_file)
+            replace(partial, self.journal_file)
+
+
+def _file_content(fileobj):
+    """Contents of a file-like object, in place if it has a buffer"""
+    if hasattr(fileobj, 'buffer'):
+        return fileobj.buffer
+    fileobj.seek(0)
+    return fileobj.read()
+
+
+def _file_size(fileobj):
+    """Number of bytes in a file-like object"""
+    if hasattr(fileobj, '__len__'):
+        return len(fileobj)
+    position = fileobj.tell()
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size
 
 
 Comms = _Comms()
@@ -13,7 +13,8 @@ import numpy as np
 import properties
 
 from .base import BaseData
-from .props import array_serializer, array_download
+from .props import (array_serializer, array_download, array_nbytes,
+                    array_stats, _array_version)
 
 
 class DataArray(BaseData):
@@ -58,7 +59,7 @@ class DataArray(BaseData):
         if arr is None or (isinstance(arr, string_types) and arr == 'array'):
             arr = self.array
         if isinstance(arr, np.ndarray):
-            return arr.astype('f4').nbytes
+            return array_nbytes(arr)
         raise ValueError('DataArray cannot calculate the number of '
                          'bytes of {}'.format(arr))
 
@@ -66,6 +67,30 @@ class DataArray(BaseData):
     def _reject_large_files(self, change):
         self._validate_file_size(change['name'], change['value'])
 
+    @properties.observer('array')
+    def _clear_summary(self, change):
+        if getattr(self, '_summary', None) is not None:
+            if self._summary[0] is not change['value']:
+                self._summary = None
+
+    def _array_summary(self, arr=None):
+        """Summary of the array, computed once per array version
+
+        Returns a dictionary with the 'min' and 'max' values, ignoring
+        NaN, or None if there are none, and the 'nan_count'. Validators
+        share the result until the array is replaced or changes shape
+        or buffer.
+        """
+        if arr is None:
+            arr = self.array
+        version = _array_version(arr)
+        cached = getattr(self, '_summary', None)
+        if cached is not None and cached[0] is arr and cached[1] == version:
+            return cached[2]
+        summary = array_stats(arr)
+        self._summary = (arr, version, summary)
+        return summary
+
     @properties.validator
     def _validate_array(self):
         self._validate_file_size('array', self.array)
@@ -84,7 +109,7 @@ class DataArray(BaseData):
         files = super(DataArray, self)._get_dirty_files(force)
         dirty = self._dirty_props
         if 'array' in dirty or force:
-            files['array'] = self._props['array'].serialize(self.array)
+            files['array'] = self._serialize_array('array')
         return files
 
     @classmethod
@@ -93,9 +118,11 @@ class DataArray(BaseData):
             title=kwargs['title'],
             description=kwargs['description'],
             order=json['order'],
-            array=cls._props['array'].deserialize(
-                json['array'], input_dtype=json.get('arrayType', None),
-            )
+        )
+        data._download(
+            'array', json['array'], kwargs,
+            input_dtype=json.get('arrayType', None),
+            encoding=json.get('arrayEncoding', None),
         )
         if json.get('colormap'):
             data.colormap = json['colormap']
@@ -202,6 +229,8 @@ class DataCategory(DataArray):
     If colormap is unspecified, colors will be randomized.
     """
     _resource_class = 'category'
+    # Indices are serialized as floats by index_serializer
+    _unprepared_arrays = ('array',)
     array = properties.Array(
         doc='Category index values at every point in the mesh',
         shape=('*',),
@@ -227,13 +256,16 @@ class DataCategory(DataArray):
 
     @properties.validator
     def _categories_and_array(self):
-        if min(self.array) < -1:
+        summary = self._array_summary()
+        if summary['min'] is None:
+            return
+        if summary['min'] < -1:
             raise ValueError('array indices must be >= -1')
-        if max(self.array) >= 256:
+        if summary['max'] >= 256:
             raise ValueError('array indices must be < 256')
-        if self.categories and max(self.array) >= len(self.categories):
+        if self.categories and summary['max'] >= len(self.categories):
             raise ValueError('array indices must be < len(categories)')
-        if self.colormap and max(self.array) >= len(self.colormap):
+        if self.colormap and summary['max'] >= len(self.colormap):
             raise ValueError('array indices must be < len(colormap)')
 
     @properties.validator
@@ -251,14 +283,22 @@ class DataCategory(DataArray):
         if self.categories:
             cat_len = len(self.categories)
         else:
-            cat_len = max(self.array) + 1
+            cat_len = self._num_indices()
         self.categories = ['']*cat_len
 
     @properties.validator('array')
     def _array_gt_zero(self, change):
-        if min(change['value']) < -1:
+        summary = self._array_summary(change['value'])
+        if summary['min'] is not None and summary['min'] < -1:
             raise ValueError('array indices must be >= -1')
 
+    def _num_indices(self):
+        """Number of categories the array indices refer to"""
+        summary = self._array_summary()
+        if summary['max'] is None:
+            return 0
+        return summary['max'] + 1
+
     def _get_dirty_data(self, force=False):
         datadict = super(DataCategory, self)._get_dirty_data(force)
         dirty = self._dirty_props
@@ -272,19 +312,21 @@ class DataCategory(DataArray):
             title=kwargs['title'],
             description=kwargs['description'],
             order=json['order'],
-            array=cls._props['array'].deserialize(
-                json['array'], input_dtype=json.get('arrayType', None),
-            ),
             colormap=json['colormap'],
             categories=json['categories'],
         )
+        data._download(
+            'array', json['array'], kwargs,
+            input_dtype=json.get('arrayType', None),
+            encoding=json.get('arrayEncoding', None),
+        )
         return data
 
     def _random_colormap(self):
         if self.categories:
             map_len = len(self.categories)
         elif self.array is not None:
-            map_len = max(self.array) + 1
+            map_len = self._num_indices()
         else:
             raise ValueError('categories or array indeces are required for '
                              'random colormap')
@@ -371,7 +413,7 @@ class DataDiscrete(DataArray):
 
     @properties.validator(['range_visibility', 'end_inclusive'])
     def _int_arrays_are_bools(self, change):
-        if not all([v in (0, 1) for v in change['value']]):
+        if not np.isin(change['value'], (0, 1)).all():
             raise ValueError('range_visibility and end_inclusive must be '
                              '1s or 0s')
 
@@ -409,14 +451,16 @@ class DataDiscrete(DataArray):
             title=kwargs['title'],
             description=kwargs['description'],
             order=json['order'],
-            array=cls._props['array'].deserialize(
-                json['array'], input_dtype=json.get('arrayType', None),
-            ),
             colormap=json['colormap'],
             end_values=json['end_values'],
             end_inclusive=json['end_inclusive'],
             range_visibility=json['range_visibility'],
         )
+        data._download(
+            'array', json['array'], kwargs,
+            input_dtype=json.get('arrayType', None),
+            encoding=json.get('arrayEncoding', None),
+        )
         return data
 
 __all__ = ['DataArray', 'DataCategory', 'DataDiscrete']
@@ -333,8 +333,8 @@ class Wolfpass(BaseExample):
 
     @classmethod
     def _add_points(self, proj):
-        Point(
-            project=proj,
+        proj.add_resources(Point(
+            project=[],
             mesh=Mesh0D(
                 vertices=self.drill_vertices
             ),
@@ -348,12 +348,12 @@ class Wolfpass(BaseExample):
                 ) for k in self.drill_data
             ],
             title='Borehole Drill Locations'
-        )
+        ))
 
     @classmethod
     def _add_lines(self, proj):
-        Line(
-            project=proj,
+        proj.add_resources(Line(
+            project=[],
             mesh=Mesh1D(
                 vertices=self.borehole_vertices,
                 segments=self.borehole_segments
@@ -368,22 +368,24 @@ class Wolfpass(BaseExample):
                 ) for k in self.borehole_data
             ],
             title='Boreholes'
-        )
+        ))
 
     @classmethod
     def _add_cu_surf(self, proj):
-        for i, prefix in enumerate(self.cu_names):
+        proj.add_resources([
             Surface(
-                project=proj,
+                project=[],
                 mesh=Mesh2D(
                     vertices=self.cu_vertices[i],
                     triangles=self.cu_triangles[i]
                 ),
                 title=prefix
-            )
+            ) for i, prefix in enumerate(self.cu_names)
+        ])
 
     @classmethod
     def _add_lith_surf(self, proj, include=None):
+        surfaces = []
         for i, prefix in enumerate(self.lith_names):
             if include is not None and prefix not in include:
                 continue
@@ -397,20 +399,21 @@ class Wolfpass(BaseExample):
                             )]
             else:
                 lith_data = []
-            Surface(
-                project=proj,
+            surfaces += [Surface(
+                project=[],
                 mesh=Mesh2D(
                     vertices=self.lith_vertices[i],
                     triangles=self.lith_triangles[i]
                 ),
                 data=lith_data,
                 title=prefix
-            )
+            )]
+        proj.add_resources(surfaces)
 
     @classmethod
     def _add_topo(self, proj):
-        Surface(
-            project=proj,
+        proj.add_resources(Surface(
+            project=[],
             mesh=Mesh2D(
                 vertices=self.topo_vertices,
                 triangles=self.topo_triangles
@@ -427,12 +430,12 @@ class Wolfpass(BaseExample):
                 **self.topo_image_orientation
             ),
             title='Topography Surface'
-        )
+        ))
 
     @classmethod
     def _add_xsect(self, proj):
-        Surface(
-            project=proj,
+        proj.add_resources(Surface(
+            project=[],
             mesh=Mesh2D(
                 vertices=self.xsect_vertices,
                 triangles=self.xsect_triangles
@@ -447,12 +450,12 @@ class Wolfpass(BaseExample):
                 ) for k in self.xsect_data
             ],
             title='Cross-Sections'
-        )
+        ))
 
     @classmethod
     def _add_lith_vol(self, proj):
-        Volume(
-            project=proj,
+        proj.add_resources(Volume(
+            project=[],
             mesh=Mesh3DGrid(
                 x0=self.lith_origin,
                 **self.lith_tensor
@@ -467,4 +470,4 @@ class Wolfpass(BaseExample):
                 ) for k in self.lith_data
             ],
             title='Lithology Volume'
-        )
+        ))
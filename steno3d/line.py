@@ -16,7 +16,8 @@ from .base import CompositeResource
 from .data import DataArray
 from .options import ColorOptions
 from .options import Options
-from .props import array_serializer, array_download, HasSteno3DProps
+from .props import (array_serializer, array_download, array_nbytes,
+                    HasSteno3DProps)
 
 
 class _Mesh1DOptions(Options):
@@ -74,7 +75,7 @@ class Mesh1D(BaseMesh):
         if isinstance(arr, string_types) and arr in ('segments', 'vertices'):
             arr = getattr(self, arr)
         if isinstance(arr, ndarray):
-            return arr.astype('f4').nbytes
+            return array_nbytes(arr)
         raise ValueError('Mesh1D cannot calculate the number of '
                          'bytes of {}'.format(arr))
 
@@ -84,10 +85,14 @@ class Mesh1D(BaseMesh):
 
     @properties.validator
     def _validate_seg(self):
-        if npmin(self.segments) < 0:
-            raise ValueError('Segments may only have positive integers')
-        if npmax(self.segments) >= len(self.vertices):
-            raise ValueError('Segments expects more vertices than provided')
+        def check_segments():
+            if npmin(self.segments) < 0:
+                raise ValueError('Segments may only have positive integers')
+            if npmax(self.segments) >= len(self.vertices):
+                raise ValueError('Segments expects more vertices than '
+                                 'provided')
+        self._cached_check('segments', ('segments', 'vertices'),
+                           check_segments)
         self._validate_file_size('segments', self.segments)
         self._validate_file_size('vertices', self.vertices)
         return True
@@ -96,11 +101,9 @@ class Mesh1D(BaseMesh):
         files = super(Mesh1D, self)._get_dirty_files(force)
         dirty = self._dirty_props
         if 'vertices' in dirty or force:
-            files['vertices'] = \
-                self._props['vertices'].serialize(self.vertices)
+            files['vertices'] = self._serialize_array('vertices')
         if 'segments' in dirty or force:
-            files['segments'] = \
-                self._props['segments'].serialize(self.segments)
+            files['segments'] = self._serialize_array('segments')
         return files
 
     @classmethod
@@ -108,14 +111,12 @@ class Mesh1D(BaseMesh):
         mesh = Mesh1D(
             title=kwargs['title'],
             description=kwargs['description'],
-            vertices=cls._props['vertices'].deserialize(
-                json['vertices'],
-            ),
-            segments=cls._props['segments'].deserialize(
-                json['segments'],
-            ),
             opts=json['meta']
         )
+        mesh._download('vertices', json['vertices'], kwargs,
+                       encoding=json.get('verticesEncoding', None))
+        mesh._download('segments', json['segments'], kwargs,
+                       encoding=json.get('segmentsEncoding', None))
         return mesh
 
     @classmethod
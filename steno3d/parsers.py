@@ -139,6 +139,10 @@ class BaseParser(_with_metaclass(_ParserMetaClass,
 
         Output:
             tuple of Steno3D project(s) parsed from file_name
+
+        Parsers that build many resources should construct them with
+        project=[] and attach them with project.add_resources(), which
+        updates the project once instead of once per resource.
         """
         raise NotImplementedError()
 
@@ -16,7 +16,8 @@ from .data import DataArray
 from .options import ColorOptions
 from .options import Options
 from .texture import Texture2DImage
-from .props import array_serializer, array_download, HasSteno3DProps
+from .props import (array_serializer, array_download, array_nbytes,
+                    HasSteno3DProps)
 
 
 class _Mesh0DOptions(Options):
@@ -52,7 +53,7 @@ class Mesh0D(BaseMesh):
                            arr == 'vertices'):
             arr = self.vertices
         if isinstance(arr, ndarray):
-            return arr.astype('f4').nbytes
+            return array_nbytes(arr)
         raise ValueError('Mesh0D cannot calculate the number of '
                          'bytes of {}'.format(arr))
 
@@ -70,8 +71,7 @@ class Mesh0D(BaseMesh):
         files = super(Mesh0D, self)._get_dirty_files(force)
         dirty = self._dirty_props
         if 'vertices' in dirty or force:
-            files['vertices'] = \
-                self._props['vertices'].serialize(self.vertices)
+            files['vertices'] = self._serialize_array('vertices')
         return files
 
     @classmethod
@@ -79,11 +79,10 @@ class Mesh0D(BaseMesh):
         mesh = Mesh0D(
             title=kwargs['title'],
             description=kwargs['description'],
-            vertices=cls._props['vertices'].deserialize(
-                json['vertices'],
-            ),
             opts=json['meta']
         )
+        mesh._download('vertices', json['vertices'], kwargs,
+                       encoding=json.get('verticesEncoding', None))
         return mesh
 
     @classmethod
@@ -153,6 +152,14 @@ class Point(CompositeResource):
                 sum(d.data._nbytes() for d in self.data) +
                 sum(t._nbytes() for t in self.textures))
 
+    def add_textures(self, textures):
+        """Add one or a list of textures in a single update"""
+        self._add_items('textures', textures)
+
+    def remove_textures(self, textures):
+        """Remove one or a list of textures in a single update"""
+        self._remove_items('textures', textures)
+
     @properties.validator
     def _validate_data(self):
         """Check if resource is built correctly"""
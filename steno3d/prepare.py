@@ -0,0 +1,193 @@
+"""prepare.py contains the parallel preparation of arrays for upload"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import properties
+
+from .client import Comms
+from .props import (ARRAY_ENCODINGS, BufferFile, FileProp, _array_version,
+                    array_serializer, block_digests, encode_buffer,
+                    serial_dtype)
+
+try:
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+PREPARE_MIN_SIZE = 1 << 16
+
+# Shared memory of prepared files that was still in use when released
+_IN_USE = []
+
+
+def prepare_files(leaves, workers, compression=None):
+    """Serialize the dirty arrays of meshes, data and textures on a pool
+    of worker processes
+
+    Arrays are copied into shared memory for the workers rather than
+    pickled. Each worker converts an array as array_serializer would,
+    in place in its shared memory, and computes its stats, its block
+    digests if it may be sent as a patch and, if compression is given,
+    its encoded buffer, so none of these are done once the upload
+    starts. The shared memory
+    then holds the prepared file without another copy. Arrays smaller
+    than PREPARE_MIN_SIZE values are left to serialize during the
+    upload. The prepared files are used by _serialize_array if the
+    arrays do not change before they are sent, and dropped by
+    release_prepared once the upload ends.
+
+    Returns the number of arrays prepared. Nothing is prepared if
+    shared memory is unavailable (Python < 3.8).
+    """
+    if shared_memory is None or not workers or workers < 1:
+        return 0
+    if (
+            compression not in ARRAY_ENCODINGS or
+            compression not in Comms.array_encodings
+    ):
+        compression = None
+    tasks = []
+    for leaf in leaves:
+        new = getattr(leaf, '_upload_data', None) is None or (
+            getattr(leaf, '_upload_cached', False) and len(leaf._dirty) > 0
+        )
+        for name, prop in leaf._props.items():
+            if not isinstance(prop, properties.Array):
+                continue
+            if name in getattr(leaf, '_unprepared_arrays', ()):
+                continue
+            if name not in leaf._dirty_props and not new:
+                continue
+            value = getattr(leaf, name)
+            if value is None or np.size(value) < PREPARE_MIN_SIZE:
+                continue
+            if np.asarray(value).dtype.kind not in 'fiu':
+                continue
+            tasks += [(leaf, name, value,
+                       Comms.array_patching and not new)]
+    if not tasks:
+        return 0
+
+    prepared = 0
+    running = {}
+    executor = ProcessPoolExecutor(workers)
+    try:
+        while tasks or running:
+            while tasks and len(running) < 2 * workers:
+                leaf, name, value, patching = tasks.pop(0)
+                block, offset = _share_array(value)
+                future = executor.submit(
+                    _prepare_shared, block.name, offset, value.shape,
+                    np.asarray(value).dtype.str, compression, patching,
+                )
+                running[future] = (leaf, name, value, block)
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                leaf, name, value, block = running.pop(future)
+                # Mappings stay valid after the name is removed
+                block.unlink()
+                if future.exception() is not None:
+                    # Serializing again during the upload raises the
+                    # error for this resource
+                    block.close()
+                    continue
+                _store_prepared(leaf, name, value, block, future.result(),
+                                compression)
+                prepared += 1
+    finally:
+        for leaf, name, value, block in running.values():
+            block.close()
+            block.unlink()
+        executor.shutdown()
+    return prepared
+
+
+def release_prepared(leaves):
+    """Drop the files prepared for leaves that were not uploaded, and
+    free their shared memory once it is no longer in use
+    """
+    for leaf in leaves:
+        if getattr(leaf, '_prepared_files', None):
+            leaf._prepared_files = {}
+        _IN_USE.extend(getattr(leaf, '_prepared_blocks', None) or [])
+        leaf._prepared_blocks = None
+    in_use = []
+    for block in _IN_USE:
+        try:
+            block.close()
+        except BufferError:
+            # Freed with the next release
+            in_use += [block]
+    _IN_USE[:] = in_use
+
+
+def _share_array(value):
+    """Copy an array into shared memory large enough for its
+    serialized values
+
+    The array is stored at the end of the block, so it can be
+    converted in place from the start of the block. Returns the block
+    and the offset of the array.
+    """
+    arr = np.asarray(value)
+    size = max(arr.nbytes, arr.size * 4, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    offset = size - arr.nbytes
+    copy = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf,
+                      offset=offset)
+    copy[...] = arr
+    del copy
+    return block, offset
+
+
+def _store_prepared(leaf, name, value, block, result, compression):
+    """Record the file prepared for an array on its resource"""
+    use_dtype, stats, digests, encoded = result
+    arr = np.asarray(value)
+    if arr.dtype.str == use_dtype and arr.flags['C_CONTIGUOUS']:
+        buf = arr.reshape(-1).view(np.uint8)
+        block.close()
+    else:
+        # The converted values in shared memory are used in place
+        buf = np.ndarray(arr.size * 4, dtype=np.uint8, buffer=block.buf)
+        if getattr(leaf, '_prepared_blocks', None) is None:
+            leaf._prepared_blocks = []
+        leaf._prepared_blocks += [block]
+    fileprop = FileProp(
+        BufferFile(buf, stats=stats, digests=digests,
+                   encoded={compression: encoded} if encoded else None),
+        use_dtype,
+    )
+    if getattr(leaf, '_prepared_files', None) is None:
+        leaf._prepared_files = {}
+    leaf._prepared_files[name] = (value, _array_version(value), fileprop)
+
+
+def _prepare_shared(name, offset, shape, dtype, compression,
+                    patching=False):
+    """Serialize an array in shared memory on a worker process"""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return _serialize_shared(block, offset, shape, dtype, compression,
+                                 patching)
+    finally:
+        block.close()
+
+
+def _serialize_shared(block, offset, shape, dtype, compression,
+                      patching=False):
+    arr = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+    output = np.ndarray(arr.size, dtype=serial_dtype(arr), buffer=block.buf)
+    fileprop = array_serializer(arr, output=output)
+    raw = fileprop.file
+    encoded = None
+    if compression is not None:
+        encoded = encode_buffer(raw.buffer, compression)
+    digests = block_digests(raw.buffer) if patching else None
+    return fileprop.dtype, raw.stats, digests, encoded
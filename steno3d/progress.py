@@ -0,0 +1,189 @@
+"""progress.py contains the progress tracking for steno3d uploads"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import deque
+from threading import Lock
+from time import time
+
+
+RATE_WINDOW = 2.
+REPORT_INTERVAL = .1
+
+
+class DownloadProgress(object):
+    """Progress of a single download session
+
+    Bytes are counted as arrays and images stream in. Sessions are safe
+    to update from several threads.
+
+    callback receives dictionaries with:
+        bytes_received - Bytes of arrays and images received so far
+        rate           - Bytes per second over the last few seconds
+        average_rate   - Bytes per second since the download started
+        elapsed        - Seconds since the download started
+    Updates are sent at most every 0.1 seconds, and once more when the
+    download finishes.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.bytes_received = 0
+        self.start_time = time()
+        self._samples = deque([(self.start_time, 0)])
+        self._last_report = self.start_time
+        self._lock = Lock()
+
+    def received(self, num):
+        """Record bytes received"""
+        with self._lock:
+            self.bytes_received += num
+            now = time()
+            self._samples.append((now, self.bytes_received))
+            if now - self._last_report < REPORT_INTERVAL:
+                return
+            self._last_report = now
+            status = self._status(now)
+        self.callback(status)
+
+    def finish(self):
+        """Report the final progress"""
+        with self._lock:
+            status = self._status(time())
+        self.callback(status)
+
+    def _status(self, now):
+        while (
+                len(self._samples) > 2 and
+                now - self._samples[1][0] > RATE_WINDOW
+        ):
+            self._samples.popleft()
+        then, received_then = self._samples[0]
+        elapsed = now - self.start_time
+        return {
+            'bytes_received': self.bytes_received,
+            'rate': ((self.bytes_received - received_then) /
+                     max(now - then, 1e-6)),
+            'average_rate': self.bytes_received / max(elapsed, 1e-6),
+            'elapsed': elapsed,
+        }
+
+
+class UploadProgress(object):
+    """Progress of a single upload session
+
+    Bytes are counted as request bodies stream, so progress advances
+    during long transfers, not only when a resource finishes. Sessions
+    are independent and safe to update from several threads.
+
+    callback receives dictionaries with:
+        progress     - Fraction of the upload complete
+        message      - Description of the resource being uploaded
+        bytes_sent   - Bytes sent so far, including form overhead
+        raw_bytes    - Serialized size of the files uploaded so far
+        wire_bytes   - Size of those files as sent, after compression
+        rate         - Bytes per second over the last few seconds
+        average_rate - Bytes per second since the upload started
+        elapsed      - Seconds since the upload started
+        eta          - Estimated seconds remaining, or None
+    When a resource finishes, the dictionary also has the 'resource',
+    its 'resource_time' in seconds, and the request 'attempts'.
+    Updates while bytes stream are sent at most every 0.1 seconds.
+
+    leaves are the meshes, data and textures to upload, and
+    num_composites the number of resources and projects that refer to
+    them.
+    """
+
+    def __init__(self, callback, leaves=(), num_composites=1):
+        self.callback = callback
+        self.total_size = sum(leaf._nbytes() for leaf in leaves) + 1
+        self.total_count = max(num_composites, 1)
+        self.size = 1
+        self.count = 0
+        self.bytes_sent = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.start_time = time()
+        self._counted = set()
+        self._active = {}
+        self._samples = deque([(self.start_time, 0)])
+        self._last_report = self.start_time
+        self._lock = Lock()
+
+    def monitor(self, res, request):
+        """Return a function that records bytes sent for a request"""
+        nbytes = res._nbytes() if res._is_leaf else 0
+        if id(res) in self._counted:
+            nbytes = 0
+        state = [nbytes, max(request['wire_bytes'], 1), 0]
+        with self._lock:
+            self._active[id(res)] = state
+
+        def sent(num):
+            with self._lock:
+                state[2] += num
+                self.bytes_sent += num
+                now = time()
+                self._samples.append((now, self.bytes_sent))
+                if now - self._last_report < REPORT_INTERVAL:
+                    return
+                self._last_report = now
+                status = self._status(now)
+            status['message'] = res._progress_message
+            self.callback(status)
+        return sent
+
+    def complete(self, res, request):
+        """Record a finished resource request and report progress"""
+        now = time()
+        with self._lock:
+            self._active.pop(id(res), None)
+            self.raw_bytes += request['raw_bytes']
+            self.wire_bytes += request['wire_bytes']
+            if res._is_leaf and id(res) not in self._counted:
+                self._counted.add(id(res))
+                self.size += res._nbytes()
+            elif not res._is_leaf:
+                self.count += 1
+            status = self._status(now)
+        status.update(
+            message=res._progress_message,
+            resource=res,
+            resource_time=now - request.get('start_time', now),
+            attempts=getattr(res, '_request_attempts', []),
+        )
+        self.callback(status)
+
+    def _status(self, now):
+        in_flight = sum(
+            nbytes * min(sent / wire, 1.)
+            for nbytes, wire, sent in self._active.values()
+        )
+        progress = 0.9 * (
+            (self.size + in_flight) / self.total_size
+        ) + 0.1 * (
+            self.count / self.total_count
+        )
+        progress = min(progress, 1.)
+        while (
+                len(self._samples) > 2 and
+                now - self._samples[1][0] > RATE_WINDOW
+        ):
+            self._samples.popleft()
+        then, sent_then = self._samples[0]
+        elapsed = now - self.start_time
+        return {
+            'progress': progress,
+            'bytes_sent': self.bytes_sent,
+            'raw_bytes': self.raw_bytes,
+            'wire_bytes': self.wire_bytes,
+            'rate': (self.bytes_sent - sent_then) / max(now - then, 1e-6),
+            'average_rate': self.bytes_sent / max(elapsed, 1e-6),
+            'elapsed': elapsed,
+            'eta': (elapsed * (1 - progress) / progress
+                    if progress > 0 else None),
+        }
@@ -7,13 +7,22 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from math import ceil
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
 import six
 import properties
 
-from .base import (CompositeResource, ProjectQuotaExceeded,
-                   ProjectResourceLimitExceeded,
-                   ProjectSizeLimitExceeded, UploadError, UserContent)
-from .client import Comms, needs_login, plot
+from .base import (SYNC_QUIET_PERIOD, CompositeResource,
+                   ProjectQuotaExceeded, ProjectResourceLimitExceeded,
+                   ProjectSizeLimitExceeded, SyncQueue, UploadError,
+                   UserContent)
+from .cache import CachedResponse, DownloadCache, UploadCache
+from .client import Comms, WorkerPool, needs_login, plot
+from .prepare import prepare_files, release_prepared
+from .progress import DownloadProgress, UploadProgress
+from .props import download_kwargs
 
 
 QUOTA_REACHED = """
@@ -46,6 +55,7 @@ class Project(UserContent):
     )
 
     _public_online = None
+    _resource_ids = frozenset()
 
     @classmethod
     def _url_view_from_uid(cls, uid):
@@ -58,7 +68,187 @@ class Project(UserContent):
 
     @needs_login
     def upload(self, **kwargs):
-        """Upload the project"""
+        """Upload the project
+
+        Optional arguments:
+            sync              - If True, changes to the project are
+                                uploaded as they are made (Default: False)
+            sync_delay        - Seconds without further changes to this
+                                project before synced changes are
+                                uploaded together (Default: 0.5)
+            verbose           - Print upload status (Default: True)
+            print_url         - Print the project url once the upload
+                                completes (Default: True)
+            progress_callback - Function that receives progress updates;
+                                see UploadProgress for their contents
+            workers           - Number of threads used to upload resources
+                                concurrently. If None (default), resources
+                                are uploaded one at a time
+            dedupe            - If True or an UploadCache, meshes, data and
+                                textures identical to ones uploaded before
+                                reference the existing server resource
+                                instead of being sent again (Default: False)
+            compression       - 'gzip' or 'zstd' to compress arrays in
+                                transit. Arrays are sent raw if the server
+                                does not support the codec (Default: None)
+            prepare_workers   - Number of processes used to serialize and
+                                compress large arrays before the upload
+                                starts. If None (default), arrays are
+                                serialized as they are uploaded
+        """
+        with Comms._reserve_pool(kwargs.get('workers', None)):
+            kwargs = self._start_upload(**kwargs)
+            try:
+                self._upload(**kwargs)
+            finally:
+                release_prepared(self._leaves())
+                if 'upload_cache' in kwargs:
+                    kwargs['upload_cache'].save()
+            self._trigger_ACL_fix()
+        return self._finish_upload(**kwargs)
+
+    def upload_async(self, **kwargs):
+        """Coroutine that uploads the project without blocking the
+        event loop (Python 3.6+)
+
+        Takes the same optional arguments as upload(), except workers and
+        sync, and additionally:
+            concurrency       - Maximum number of requests in flight
+                                (Default: 100)
+            transport         - AsyncTransport to share between calls
+        """
+        from .aio import upload_project
+        return upload_project(self, **kwargs)
+
+    def plan_upload(self, **kwargs):
+        """Plan the upload of the project without sending anything
+
+        Takes the same optional arguments as upload(); compression and
+        dedupe affect the plan. Returns a dictionary with:
+            requests     - Planned requests in upload order, each with the
+                           'resource', 'method' ('post', 'put', or
+                           'reference' for content already in the upload
+                           cache), 'url', 'files' mapping file names to
+                           their 'dtype', 'raw_bytes' and on-the-wire
+                           'bytes', and 'requests', the number of HTTP
+                           requests it takes. References take one request
+                           to check that the cached resource still exists
+            num_requests - Total number of HTTP requests, including the
+                           quota check and access update
+            posts, puts, references - Number of each kind of request
+            raw_bytes    - Total size of the serialized files
+            bytes        - Total size of the files as sent
+            changed_bytes - Total size of the array blocks that changed
+                           since they were last uploaded
+            violations   - Predicted file size, project size and resource
+                           count limit violations, each with the
+                           'resource', 'limit', 'size', 'max' and 'message'
+        """
+        dedupe = kwargs.pop('dedupe', False)
+        if dedupe:
+            if not isinstance(dedupe, UploadCache):
+                dedupe = UploadCache()
+            kwargs['upload_cache'] = dedupe
+        resources = []
+        if 'resources' in self._dirty:
+            seen = set()
+            for res in self.resources:
+                for child in res._dirty_children(mark=False):
+                    if id(child) not in seen:
+                        seen.add(id(child))
+                        resources += [child]
+                resources += [res]
+        resources += [self]
+        plan = {
+            'requests': [],
+            'num_requests': 1,
+            'posts': 0,
+            'puts': 1,
+            'references': 0,
+            'raw_bytes': 0,
+            'bytes': 0,
+            'changed_bytes': 0,
+            'violations': self._plan_violations(),
+        }
+        if getattr(self, '_upload_data', None) is None:
+            plan['num_requests'] += 1
+        for res in resources:
+            request = res._plan_request(**kwargs)
+            if request is None:
+                continue
+            request['requests'] = 1
+            if request['method'] != 'reference':
+                for info in request['files'].values():
+                    if (
+                            Comms.chunk_threshold is not None and
+                            info['bytes'] > Comms.chunk_threshold
+                    ):
+                        request['requests'] += 1 + int(
+                            ceil(info['bytes'] / Comms.chunk_size)
+                        )
+                    plan['raw_bytes'] += info['raw_bytes']
+                    plan['bytes'] += info['bytes']
+            plan['changed_bytes'] += request['changed_bytes']
+            plan[request['method'] + 's'] += 1
+            plan['num_requests'] += request['requests']
+            plan['requests'] += [request]
+        return plan
+
+    def _plan_violations(self):
+        """Limits of the logged in user that an upload would exceed"""
+        if not Comms.user.logged_in:
+            return []
+        violations = []
+        file_limit = Comms.user.file_size_limit
+        for leaf in self._leaves():
+            size = leaf._nbytes()
+            if size > file_limit:
+                violations += [{
+                    'resource': leaf,
+                    'limit': 'file_size_limit',
+                    'size': size,
+                    'max': file_limit,
+                    'message': '{name} size ({file} bytes) exceeds limit: '
+                               '{lim} bytes'.format(
+                                   name=leaf.__class__.__name__,
+                                   file=size,
+                                   lim=file_limit,
+                               ),
+                }]
+        res_limit = Comms.user.project_resource_limit
+        if len(self.resources) > res_limit:
+            violations += [{
+                'resource': self,
+                'limit': 'project_resource_limit',
+                'size': len(self.resources),
+                'max': res_limit,
+                'message': 'Total number of resources in project ({res}) '
+                           'exceeds limit: {lim}'.format(
+                               res=len(self.resources),
+                               lim=res_limit,
+                           ),
+            }]
+        size_limit = Comms.user.project_size_limit
+        size = self._total_nbytes()
+        if size > size_limit:
+            violations += [{
+                'resource': self,
+                'limit': 'project_size_limit',
+                'size': size,
+                'max': size_limit,
+                'message': 'Total project size ({file} bytes) exceeds '
+                           'limit: {lim} bytes'.format(
+                               file=size,
+                               lim=size_limit,
+                           ),
+            }]
+        return violations
+
+    def _start_upload(self, **kwargs):
+        """Check the project before upload and reset progress
+
+        Returns the keyword arguments for uploading the resources.
+        """
         verbose = kwargs.get('verbose', True)
         if getattr(self, '_upload_data', None) is None:
             assert self.validate()
@@ -71,23 +261,42 @@ class Project(UserContent):
                   'projects that are already uploaded. To make '
                   'these changes, please use the dashboard on '
                   '{base_url}'.format(base_url=Comms.base_url))
+        if kwargs.get('sync', False):
+            kwargs['sync_queue'] = SyncQueue(
+                kwargs.pop('sync_delay', SYNC_QUIET_PERIOD)
+            )
+        prepare_workers = kwargs.pop('prepare_workers', None)
         if verbose:
             print('\rStarting upload: {}'.format(self.title), end='')
-        UserContent._upload_size = 1
-        UserContent._upload_total_size = self._nbytes() + 1
-        UserContent._upload_count = 0
-        UserContent._upload_total_count = len(self.resources) + 1
-        self._upload(**kwargs)
-        self._trigger_ACL_fix()
+        progress_callback = kwargs.get('progress_callback', None)
+        if verbose and progress_callback is None:
+            progress_callback = self._progress_report
+        if progress_callback is not None:
+            kwargs['upload_progress'] = UploadProgress(
+                progress_callback, self._leaves(), len(self.resources) + 1
+            )
+        dedupe = kwargs.pop('dedupe', False)
+        if dedupe:
+            if not isinstance(dedupe, UploadCache):
+                dedupe = UploadCache()
+            kwargs['upload_cache'] = dedupe
+        if prepare_workers:
+            # Released when the upload ends, with release_prepared
+            prepare_files(self._leaves(), prepare_workers,
+                          kwargs.get('compression', None))
+        return kwargs
+
+    def _finish_upload(self, **kwargs):
+        verbose = kwargs.get('verbose', True)
         if verbose:
             print('\nComplete!')
         if verbose and kwargs.get('print_url', True):
             print(self._url)
         return self._upload_data['uid']
 
-    def _post(self, datadict=None, files=None):
+    def _post(self, datadict=None, files=None, monitor=None):
         try:
-            return super(Project, self)._post(datadict, files)
+            return super(Project, self)._post(datadict, files, monitor)
         except UploadError:
             if getattr(self, '_upload_data', None) is None:
                 self._check_project_quota(False)
@@ -108,7 +317,77 @@ class Project(UserContent):
         return True
 
     def _nbytes(self):
-        return sum(r._nbytes() for r in self.resources)
+        return sum(r._total_nbytes() for r in self.resources)
+
+    def add_resources(self, resources):
+        """Add one or an iterable of resources in a single update
+
+        Resources already in the project are skipped.
+        """
+        if isinstance(resources, CompositeResource):
+            resources = [resources]
+        seen = set(self._resource_ids)
+        added = []
+        for res in resources:
+            if id(res) not in seen:
+                seen.add(id(res))
+                added += [res]
+        if added:
+            self.resources = self.resources + added
+
+    def remove_resources(self, resources):
+        """Remove one or an iterable of resources in a single update"""
+        if isinstance(resources, CompositeResource):
+            resources = [resources]
+        removed = set(id(res) for res in resources)
+        if removed & self._resource_ids:
+            self.resources = [res for res in self.resources
+                              if id(res) not in removed]
+
+    def _contains_resource(self, res):
+        return id(res) in self._resource_ids
+
+    def prefetch(self, resources=None, workers=8):
+        """Download the arrays and images of resources in a project
+        downloaded with lazy=True, which are otherwise downloaded when
+        first accessed
+
+        Optional arguments:
+            resources - One or an iterable of resources
+                        (Default: all resources in the project)
+            workers   - Number of threads used to download concurrently
+                        (Default: 8)
+        """
+        if isinstance(resources, CompositeResource):
+            resources = [resources]
+        pending = []
+        for leaf in self._leaves(resources):
+            pending += [(leaf, name) for name in leaf._pending_downloads]
+        if not pending:
+            return
+        pool = ThreadPool(max(min(workers, len(pending)), 1))
+        try:
+            pool.map(lambda item: getattr(*item), pending)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _leaves(self, resources=None):
+        """Unique meshes, data and textures across resources, by default
+        all resources in the project
+        """
+        if resources is None:
+            resources = self.resources
+        leaves = []
+        seen = set()
+        for res in resources:
+            children = [res.mesh] + [d.data for d in res.data]
+            children += getattr(res, 'textures', None) or []
+            for child in children:
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    leaves += [child]
+        return leaves
 
     def _validate_project_size(self, res=None):
         if Comms.user.logged_in:
@@ -122,7 +401,7 @@ class Project(UserContent):
                                                   lim=res_limit)
                 )
             size_limit = Comms.user.project_size_limit
-            sz = self._nbytes()
+            sz = self._total_nbytes()
             if sz > size_limit:
                 raise ProjectSizeLimitExceeded(
                     'Total project size ({file} bytes) exceeds limit: '
@@ -139,25 +418,107 @@ class Project(UserContent):
             before = []
         if after in (None, properties.undefined):
             after = []
+        before_ids = set(id(res) for res in before)
+        after_ids = set(id(res) for res in after)
+        self._resource_ids = frozenset(after_ids)
         for res in after:
-            if res not in before and self not in res.project:
+            if id(res) not in before_ids and not any(
+                    proj is self for proj in res.project
+            ):
                 res.project += [self]
         for res in before:
-            if res not in after and self in res.project:
+            if id(res) not in after_ids and any(
+                    proj is self for proj in res.project
+            ):
                 res.project = [p for p in res.project
                                if p is not self]
-        if len(set(after)) != len(after):
+        if len(after_ids) != len(after):
             post_post = []
+            seen = set()
             for r in after:
-                if r not in post_post:
+                if id(r) not in seen:
+                    seen.add(id(r))
                     post_post += [r]
             self.resources = post_post
 
     def _upload_dirty(self, **kwargs):
         dirty = self._dirty
-        if 'resources' in dirty:
+        if 'resources' not in dirty:
+            return
+        if (kwargs.get('workers', None) or 1) > 1:
+            self._upload_concurrently(**kwargs)
+        else:
             [r._upload(**kwargs) for r in self.resources]
 
+    def _upload_concurrently(self, **kwargs):
+        """Upload resources on a bounded pool of worker threads
+
+        Meshes, data and textures are uploaded first; each composite
+        resource is uploaded as soon as all of its children exist on
+        the server. All failures are collected and raised together as
+        a single UploadError.
+        """
+        resources = self.resources
+        res_kwargs = dict(kwargs, children_uploaded=True)
+        leaves = []
+        waiting = {}
+        pending = []
+        for index, res in enumerate(resources):
+            children = set()
+            for child in res._dirty_children():
+                if id(child) in children:
+                    continue
+                children.add(id(child))
+                if id(child) not in waiting:
+                    leaves += [child]
+                    waiting[id(child)] = []
+                waiting[id(child)] += [index]
+            pending += [len(children)]
+
+        lock = Lock()
+        pool = WorkerPool(kwargs['workers'])
+
+        def upload_resource(res):
+            res._upload(**res_kwargs)
+
+        def upload_leaf(leaf):
+            leaf._upload(**kwargs)
+            ready = []
+            with lock:
+                for index in waiting[id(leaf)]:
+                    pending[index] -= 1
+                    if pending[index] == 0:
+                        ready += [resources[index]]
+            for res in ready:
+                pool.submit(upload_resource, res)
+
+        for index, res in enumerate(resources):
+            if pending[index] == 0:
+                pool.submit(upload_resource, res)
+        for leaf in leaves:
+            pool.submit(upload_leaf, leaf)
+        errors = pool.join()
+        if errors:
+            raise self._upload_error(errors)
+
+    @staticmethod
+    def _upload_error(errors):
+        """UploadError for a list of (resource, exception) failures"""
+        err = UploadError(
+            'Upload failed for {num} resource(s):\n{errs}'.format(
+                num=len(errors),
+                errs='\n'.join(
+                    '{cls} {title}: {err}'.format(
+                        cls=item._resource_class,
+                        title=item.title,
+                        err=error,
+                    ) for item, error in errors
+                )
+            )
+        )
+        err.errors = errors
+        return err
+
     def _get_dirty_data(self, force=False, initialize=False):
         datadict = super(Project, self)._get_dirty_data(force)
         dirty = self._dirty_props
@@ -236,10 +597,46 @@ class Project(UserContent):
         return plot(url)
 
     @classmethod
-    def _build(cls, uid, copy=True, tab_level='', verbose=True):
+    def _build(cls, uid, copy=True, tab_level='', verbose=True, workers=None,
+               progress_callback=None, cache=None, lazy=False,
+               prefetched=None):
+        """Download a project
+
+        The download cache, progress monitor and prefetched responses
+        of the build are passed down to its resources as keyword
+        arguments, so concurrent builds do not share them.
+        """
+        if cache and not isinstance(cache, DownloadCache):
+            cache = DownloadCache()
+        progress = None
+        if progress_callback is not None:
+            progress = DownloadProgress(progress_callback)
+        download = dict(
+            lazy=lazy,
+            cache=cache or None,
+            monitor=None if progress is None else progress.received,
+            prefetched=dict(prefetched or {}),
+        )
+        try:
+            if workers and workers > 1:
+                download['prefetched'].update(cls._prefetch(
+                    uid, workers, files=not lazy, cache=download['cache'],
+                    monitor=download['monitor'],
+                ))
+            return cls._build_project(uid, copy, tab_level, verbose,
+                                      **download)
+        finally:
+            if cache:
+                cache.save()
+            if progress is not None:
+                progress.finish()
+
+    @classmethod
+    def _build_project(cls, uid, copy, tab_level, verbose, **kwargs):
         if verbose:
             print('Downloading project', end=': ')
-        json = cls._json_from_uid(uid)
+        json = cls._json_from_uid(uid, prefetched=kwargs['prefetched'],
+                                  cache=kwargs['cache'])
         title = '' if json['title'] is None else json['title']
         desc = '' if json['description'] is None else json['description']
         if verbose:
@@ -275,16 +672,19 @@ class Project(UserContent):
             description=desc,
             resources=[]
         )
+        resources = []
         for longuid in json['resourceUids']:
             res_string = longuid.split('Resource')[-1].split(':')[0]
             res_class = UserContent._REGISTRY[res_string]
-            proj.resources += [res_class._build(
+            resources += [res_class._build(
                 src=longuid.split(':')[1],
                 copy=copy,
                 tab_level=tab_level + '    ',
-                project=proj,
+                project=[],
                 using='ProjectSteno3D:{}'.format(uid),
+                **download_kwargs(kwargs)
             )]
+        proj.add_resources(resources)
         if not copy:
             proj._public_online = pub
             proj._upload_data = json
@@ -293,6 +693,75 @@ class Project(UserContent):
             print('... Complete!')
         return proj
 
+    @staticmethod
+    def _prefetch(uid, workers, files=True, cache=None, monitor=None):
+        """Fetch the json of a project and its resources, and all arrays
+        and images unless files is False, on a pool of worker threads
+
+        Requests go through the DownloadCache if given, and monitor is
+        called with the size of newly downloaded files. Returns the
+        responses by url, to be passed to the build as prefetched.
+        Responses served from the cache are read into memory, since
+        later downloads may evict their files before the build.
+        Requests that fail are repeated, and their errors raised, when
+        the project is built.
+        """
+        prefetched = {}
+
+        def fetch(request):
+            url, headers = request
+            try:
+                resp, _ = Comms._send(Comms.session.get, url, cache=cache,
+                                      headers=headers, timeout=60)
+            except Exception:
+                return None
+            if isinstance(resp, CachedResponse):
+                resp.load()
+            prefetched[url] = resp
+            if (
+                    headers is None and
+                    monitor is not None and
+                    not getattr(resp, 'not_modified', False)
+            ):
+                monitor(len(resp.content))
+            return resp
+
+        def fetch_json(request):
+            cls, json_uid, using = request
+            url = Comms.base_url + cls._json_location(json_uid, using)
+            resp = fetch((url, Comms._headers()))
+            if resp is None or resp.status_code != 200:
+                return None
+            try:
+                return resp.json()
+            except ValueError:
+                return None
+
+        pool = ThreadPool(workers)
+        try:
+            proj_json = fetch_json((Project, uid, None))
+            if proj_json is not None:
+                using = 'ProjectSteno3D:{}'.format(uid)
+                res_jsons = pool.map(fetch_json, [
+                    _class_and_uid(long_uid) + (using,)
+                    for long_uid in proj_json.get('resourceUids', [])
+                ])
+                child_uids = _child_uids(res_jsons)
+                child_jsons = pool.map(fetch_json, [
+                    (child_cls, child_uid, using)
+                    for child_cls, child_uid in child_uids
+                ])
+                urls = set()
+                for (child_cls, _), child_json in zip(child_uids,
+                                                      child_jsons):
+                    if child_json is not None and files:
+                        urls.update(_file_urls(child_cls, child_json))
+                pool.map(fetch, [(url, None) for url in sorted(urls)])
+        finally:
+            pool.close()
+            pool.join()
+        return prefetched
+
     @classmethod
     def from_omf(cls, omf_input):
         if isinstance(omf_input, six.string_types):
@@ -315,13 +784,15 @@ class Project(UserContent):
             'SurfaceElement': 'Surface',
             'VolumeElement': 'Volume'
         }
+        resources = []
         for elem in omf_project.elements:
             res_class = UserContent._REGISTRY[
                 resource_map[elem.__class__.__name__]
             ]
-            proj.resources += [
-                res_class._build_from_omf(elem, omf_project, proj)
+            resources += [
+                res_class._build_from_omf(elem, omf_project, [])
             ]
+        proj.add_resources(resources)
         return proj
 
     try:
@@ -343,4 +814,36 @@ class Project(UserContent):
 CompositeResource._props['project'].prop.instance_class = Project
 
 
+def _class_and_uid(long_uid):
+    """Split a long uid into the resource class and uid"""
+    (class_string, uid) = long_uid.split('Resource')[-1].split(':')
+    return UserContent._REGISTRY[class_string], uid
+
+
+def _child_uids(res_jsons):
+    """Classes and uids of the unique meshes, textures and data
+    referenced by composite resource jsons
+    """
+    long_uids = []
+    for res_json in res_jsons:
+        if res_json is None:
+            continue
+        if 'mesh' in res_json:
+            long_uids += [res_json['mesh']['uid']]
+        long_uids += [tex['uid'] for tex in res_json.get('textures', [])]
+        long_uids += [dat['uid'] for dat in res_json.get('data', [])]
+    return [_class_and_uid(long_uid) for long_uid in sorted(set(long_uids))]
+
+
+def _file_urls(cls, json):
+    """Urls of the arrays and images referenced by a resource json"""
+    urls = []
+    for name, prop in cls._props.items():
+        if not isinstance(prop, (properties.Array, properties.ImagePNG)):
+            continue
+        if isinstance(json.get(name, None), six.string_types):
+            urls += [json[name]]
+    return urls
+
+
 __all__ = ['Project']
@@ -4,73 +4,351 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from collections import namedtuple, OrderedDict
+from hashlib import sha1
 from io import BytesIO
-from tempfile import NamedTemporaryFile
+from itertools import chain
+import threading
+import weakref
+import zlib
 
 import numpy as np
-from requests import get
 import properties
 
+from .client import Comms, _file_size
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class FrozenList(list):
+    """Read-only list stored for list properties
+
+    List properties return the stored list itself rather than a copy,
+    so changing it in place, which would bypass validation and change
+    notifications, raises a TypeError. Assign a new list instead;
+    `+=` and `*=` build a new list that is then assigned.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('List properties cannot be changed in place; '
+                        'assign a new list instead')
+
+    append = extend = insert = pop = remove = _read_only
+    reverse = sort = clear = _read_only
+    __setitem__ = __delitem__ = _read_only
+    __setslice__ = __delslice__ = _read_only
+
+    def __iadd__(self, other):
+        return list(self) + list(other)
+
+    def __imul__(self, num):
+        return list(self) * num
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+class LazyDownload(object):
+    """Binary property value of a lazily built resource that is
+    downloaded by the property deserializer when first accessed
+    """
+
+    def __init__(self, prop, url, **kwargs):
+        self.prop = prop
+        self.url = url
+        self.kwargs = kwargs
+
+    def load(self):
+        value = self.prop.deserialize(self.url, **self.kwargs)
+        if self.kwargs.get('cache', None) is not None:
+            self.kwargs['cache'].save()
+        return value
+
+
+def _unlinker(child, key):
+    """Weakref callback that removes the link to a collected parent"""
+    child_ref = weakref.ref(child)
+
+    def unlink(parent_ref):
+        child = child_ref()
+        if child is None:
+            return
+        link = child._parents.get(key, None)
+        if link is not None and link[0] is parent_ref:
+            del child._parents[key]
+
+    return unlink
+
+
+# Depth of property sets in progress on each thread, while lazy
+# downloads are not loaded
+_SETTING = threading.local()
+
 
 class HasSteno3DProps(properties.HasProperties):
+    """Base class for steno3d objects with dirty tracking
+
+    Each object records its own changed properties and the children
+    (instances or list items that are also HasSteno3DProps) that are
+    dirty. Children keep links to their parents and notify them only
+    when their dirty state flips, so reading _dirty never walks the
+    object tree. Properties listed in _backref_props point back up to
+    a parent and are not linked.
+
+    Validation of array properties, and checks run through
+    _cached_check, is remembered until the properties involved are set
+    again, so unchanged content is not revalidated.
+    """
 
     _REGISTRY = OrderedDict()
+    _backref_props = ()
 
     def __init__(self, **metadata):
         self._dirty_props = set()
+        self._dirty_links = dict()
+        self._parents = dict()
+        self._is_dirty = False
+        self._validation_cache = dict()
+        self._nbytes_total = None
+        # Defaults are set before __init__ without change notifications
+        for name in self._linked_props():
+            self._link_children(name, self._backend.get(name, None))
         super(HasSteno3DProps, self).__init__(**metadata)
 
     def _get(self, name):
         value = super(HasSteno3DProps, self)._get(name)
-        # Returning a copy of the list maintains backward compatibility
-        # until properties has better handling of lists.
-        if isinstance(value, list):
-            value = [val for val in value]
+        if isinstance(value, LazyDownload):
+            if getattr(_SETTING, 'depth', 0):
+                # Compared unloaded, so it is never equal to another value
+                return value
+            # Downloaded values are stored as built, without marking
+            # the property dirty
+            value = value.load()
+            self._backend[name] = value
+        # Lists are returned without copying, so they are stored as
+        # FrozenLists that cannot be changed in place.
+        if isinstance(value, list) and not isinstance(value, FrozenList):
+            value = FrozenList(value)
+            self._backend[name] = value
         return value
 
+    def _set(self, name, value):
+        # Setting a lazily built resource compares it with the previous
+        # value, which should not download its arrays
+        _SETTING.depth = getattr(_SETTING, 'depth', 0) + 1
+        try:
+            super(HasSteno3DProps, self)._set(name, value)
+        finally:
+            _SETTING.depth -= 1
+
     @properties.observer(properties.everything)
     def _mark_dirty(self, change):
-        self._dirty_props.add(change['name'])
+        name = change['name']
+        self._invalidate_nbytes()
+        for check, (names, _) in list(self._validation_cache.items()):
+            if name in names:
+                del self._validation_cache[check]
+        if isinstance(self._props.get(name, None), properties.Array):
+            # Arrays are validated as they are set
+            self._validation_cache['prop:' + name] = (
+                frozenset((name,)), self._check_version((name,))
+            )
+        if name in self._linked_props():
+            self._unlink_children(name, change['previous'])
+            self._link_children(name, change['value'])
+        self._add_dirty_prop(name)
+
+    def _add_dirty_prop(self, name):
+        self._dirty_props.add(name)
+        self._update_dirty()
 
     def _mark_clean(self, recurse=True):
         self._dirty_props = set()
-        if not recurse or getattr(self, '_inside_clean', False):
-            return
-        self._inside_clean = True
-        try:
-            props = self._dirty
-            for prop in props:
-                value = getattr(self, prop)
-                if isinstance(value, properties.HasProperties):
-                    value._mark_clean()
-                if isinstance(value, (list, tuple)):
-                    for v in value:
-                        if isinstance(v, properties.HasProperties):
-                            v._mark_clean()
-        finally:
-            self._inside_clean = False
+        if recurse and not getattr(self, '_inside_clean', False):
+            self._inside_clean = True
+            try:
+                for links in list(self._dirty_links.values()):
+                    for child in list(links.values()):
+                        child._mark_clean()
+            finally:
+                self._inside_clean = False
+        self._update_dirty()
+
+    def _total_nbytes(self):
+        """Size of the object, kept until it or its contents change"""
+        if self._nbytes_total is None:
+            self._nbytes_total = self._nbytes()
+        return self._nbytes_total
+
+    def _invalidate_nbytes(self):
+        self._nbytes_total = None
+        for ref, _ in list(self._parents.values()):
+            parent = ref()
+            if parent is not None:
+                parent._invalidate_nbytes()
 
     @property
     def _dirty(self):
-        if getattr(self, '_inside_dirty', False):
-            return set()
-        dirty_instances = set()
-        self._inside_dirty = True
-        try:
-            props = self._non_deprecated_props()
-            for prop in props:
-                value = getattr(self, prop)
-                if (isinstance(value, properties.HasProperties) and
-                        len(value._dirty) > 0):
-                    dirty_instances.add(prop)
-                if isinstance(value, (list, tuple)):
-                    for v in value:
-                        if (isinstance(v, properties.HasProperties) and
-                                len(v._dirty) > 0):
-                            dirty_instances.add(prop)
-        finally:
-            self._inside_dirty = False
-        return self._dirty_props.union(dirty_instances)
+        return self._dirty_props.union(self._dirty_links)
+
+    def _linked_props(self):
+        return [name for name in self._non_deprecated_props()
+                if name not in self._backref_props]
+
+    @staticmethod
+    def _children(value):
+        if isinstance(value, HasSteno3DProps):
+            return [value]
+        if isinstance(value, (list, tuple)):
+            return [v for v in value if isinstance(v, HasSteno3DProps)]
+        return []
+
+    def _link_children(self, name, value):
+        key = (id(self), name)
+        for child in self._children(value):
+            link = child._parents.get(key, None)
+            if link is None or link[0]() is not self:
+                # A link left by a collected parent with the same id is
+                # replaced rather than reused
+                child._parents[key] = [
+                    weakref.ref(self, _unlinker(child, key)), 0
+                ]
+            child._parents[key][1] += 1
+            if child._is_dirty:
+                self._child_dirty_changed(name, child, True)
+
+    def _unlink_children(self, name, value):
+        key = (id(self), name)
+        for child in self._children(value):
+            link = child._parents.get(key, None)
+            if link is None:
+                continue
+            link[1] -= 1
+            if link[1] > 0:
+                continue
+            del child._parents[key]
+            self._child_dirty_changed(name, child, False)
+
+    def _child_dirty_changed(self, name, child, dirty):
+        links = self._dirty_links.get(name, dict())
+        if dirty:
+            links[id(child)] = child
+            self._dirty_links[name] = links
+        else:
+            links.pop(id(child), None)
+            if not links:
+                self._dirty_links.pop(name, None)
+        self._update_dirty()
+
+    def _update_dirty(self):
+        """Notify parents if the dirty state of this object flipped"""
+        dirty = bool(self._dirty_props) or bool(self._dirty_links)
+        if dirty == self._is_dirty:
+            return
+        self._is_dirty = dirty
+        for key, (ref, _) in list(self._parents.items()):
+            parent = ref()
+            if parent is None:
+                self._parents.pop(key, None)
+                continue
+            parent._child_dirty_changed(key[1], self, dirty)
+
+    @properties.validator
+    def _validate_props(self):
+        """Assert that all the properties are valid on validate()
+
+        This matches properties.HasProperties, except array properties
+        that already passed are not validated again.
+        """
+        for key, prop in self._props.items():
+            try:
+                if isinstance(prop, properties.Array):
+                    self._cached_check(
+                        'prop:' + key, (key,),
+                        lambda: self._validate_prop(key, prop),
+                    )
+                else:
+                    self._validate_prop(key, prop)
+            except properties.ValidationError as val_err:
+                if getattr(self, '_validation_error_tuples', None) is None:
+                    raise
+                self._validation_error_tuples += val_err.error_tuples
+        return True
+
+    def _validate_prop(self, key, prop):
+        value = self._get(key)
+        if value is not None:
+            change = dict(name=key, previous=value, value=value,
+                          mode='validate')
+            self._notify(change)
+            if not prop.equal(value, change['value']):
+                self._invalid_prop(key, value)
+        if not prop.assert_valid(self):
+            self._invalid_prop(key, value)
+
+    def _invalid_prop(self, key, value):
+        raise properties.ValidationError(
+            'Invalid value for property {}: {}'.format(key, value),
+            'invalid', key, self
+        )
+
+    def _cached_check(self, check, names, func, key=None):
+        """Run the validation function func unless it already passed
+
+        The result is remembered until one of the properties in names is
+        set, an array among them changes shape, dtype or buffer, or key
+        changes; key holds anything else the check depends on, such as
+        the file size limit.
+        """
+        version = self._check_version(names, key)
+        cached = self._validation_cache.get(check, None)
+        if cached is not None and cached[1] == version:
+            return True
+        func()
+        self._validation_cache[check] = (frozenset(names), version)
+        return True
+
+    def _check_version(self, names, key=None):
+        return (key,) + tuple(
+            _array_version(self._backend.get(name, None)) for name in names
+        )
+
+    def _download(self, name, url, build_kwargs, **kwargs):
+        """Set a binary property from its download url, with the
+        download options found in the keyword arguments of the build
+
+        If the build is lazy, the download is deferred until the
+        property is first accessed. Only the download cache of the
+        build is kept for it; its progress monitor and prefetched
+        responses are not.
+        """
+        kwargs.update(download_kwargs(build_kwargs))
+        if not kwargs.pop('lazy', False):
+            setattr(self, name, self._props[name].deserialize(url, **kwargs))
+            return
+        kwargs.pop('monitor', None)
+        kwargs.pop('prefetched', None)
+        self._backend[name] = LazyDownload(self._props[name], url, **kwargs)
+
+    @property
+    def _pending_downloads(self):
+        """Names of binary properties that are not downloaded yet"""
+        return [name for name, value in self._backend.items()
+                if isinstance(value, LazyDownload)]
+
+    def _serialize_array(self, name):
+        """Serialize an Array property, reusing the file prepared ahead
+        of time by prepare_files if the array has not changed since
+        """
+        value = getattr(self, name)
+        prepared = getattr(self, '_prepared_files', None)
+        if prepared and name in prepared:
+            arr, version, fileprop = prepared.pop(name)
+            if arr is value and version == _array_version(value):
+                return fileprop
+        return self._props[name].serialize(value)
 
     def _non_deprecated_props(self):
         return {k: v for k, v in self._props.items()
@@ -82,56 +360,468 @@ class HasSteno3DProps(properties.HasProperties):
         ))
 
 
-def image_download(url, **kwargs):
-    im_resp = get(url, timeout=60)
+def array_nbytes(arr):
+    """Size of an array as uploaded, in 4-byte float32 or int32 values
+
+    The size is computed from the shape, without converting the array.
+    """
+    return arr.size * 4
+
+
+def _array_version(value):
+    """Identity, shape, dtype and buffer address of an array"""
+    if isinstance(value, np.ndarray):
+        return (id(value), value.shape, value.dtype.str,
+                value.__array_interface__['data'][0])
+    return id(value)
+
+
+DOWNLOAD_KWARGS = ('lazy', 'cache', 'monitor', 'prefetched')
+
+
+def download_kwargs(kwargs):
+    """Download options of a build, passed from _build through
+    _build_from_json to child resources and the deserializers of
+    arrays and images
+
+    These are 'lazy', the DownloadCache as 'cache', the 'monitor'
+    called with the number of bytes received, and the 'prefetched'
+    responses by url.
+    """
+    return {key: kwargs[key] for key in DOWNLOAD_KWARGS
+            if kwargs.get(key, None) is not None}
+
+
+def _download_response(url, cache=None, prefetched=None):
+    """Stream a GET request for a download url, returning the
+    prefetched response or going through cache if given
+    """
+    resp, _ = Comms._send(Comms.session.get, url, prefetched=prefetched,
+                          cache=cache, timeout=60, stream=True)
+    return resp
+
+
+def _download_monitor(url, resp, monitor=None, prefetched=None):
+    """Monitor for the bytes received of a download, if they are not
+    already counted when prefetched or served from the cache unchanged
+    """
+    if url in (prefetched or {}) or getattr(resp, 'not_modified', False):
+        return None
+    return monitor
+
+
+def image_download(url, cache=None, monitor=None, prefetched=None,
+                   **kwargs):
+    im_resp = _download_response(url, cache, prefetched)
     if im_resp.status_code != 200:
         raise IOError('Failed to download image.')
+    monitor = _download_monitor(url, im_resp, monitor, prefetched)
     output = BytesIO()
     output.name = 'texture.png'
-    for chunk in im_resp:
+    for chunk in im_resp.iter_content(DOWNLOAD_CHUNK_SIZE):
         output.write(chunk)
+        if monitor is not None:
+            monitor(len(chunk))
     output.seek(0)
     return output
 
 
 FileProp = namedtuple('FileProp', ['file', 'dtype'])
 
+ARRAY_ENCODINGS = ('gzip', 'zstd') if zstandard is not None else ('gzip',)
+SERIALIZE_CHUNK_SIZE = 1 << 20
+PATCH_BLOCK_SIZE = 64 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class BufferFile(object):
+    """Read-only file-like object over an in-memory buffer
+
+    read() returns memoryview slices of the buffer, so serialized
+    arrays reach the multipart encoder without a disk round trip or
+    intermediate copies. Compressed buffers record their
+    array_encoding and the raw_nbytes of the uncompressed array.
+    Patches record the (offset, length) byte ranges of the array
+    they replace. Serialized arrays record their stats: 'min', 'max'
+    and 'nan_count'. Arrays serialized ahead of time may also record
+    their block digests and their encoded buffers by codec.
+    """
+
+    def __init__(self, buf, name='array.dat', array_encoding=None,
+                 raw_nbytes=None, patch=None, stats=None, digests=None,
+                 encoded=None):
+        self.buffer = memoryview(buf)
+        self.name = name
+        self.array_encoding = array_encoding
+        self.patch = patch
+        self.stats = stats
+        self.digests = digests
+        self.encoded = encoded or {}
+        if raw_nbytes is None:
+            raw_nbytes = len(self.buffer)
+        self.raw_nbytes = raw_nbytes
+        self.closed = False
+        self._position = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def read(self, size=-1):
+        start = self._position
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + size, len(self.buffer))
+        self._position = end
+        return self.buffer[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += len(self.buffer)
+        self._position = max(0, min(offset, len(self.buffer)))
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self.closed = True
+
+
+def serial_dtype(data):
+    """Little-endian dtype that array_serializer writes data as"""
+    if data.dtype.kind == 'f':
+        return '<f4'
+    if data.dtype.kind in 'iu':
+        return '<i4'
+    raise TypeError('Must be a float or an int: {}'.format(data.dtype))
+
+
+def _chunk_rows(data):
+    """Number of values in each row of data, and of rows in each chunk
+    of about SERIALIZE_CHUNK_SIZE values
+    """
+    row_size = data.size // data.shape[0] if data.shape[0] else 1
+    return row_size, max(SERIALIZE_CHUNK_SIZE // max(row_size, 1), 1)
+
+
+def _add_stats(stats, values, valid=None):
+    """Add the min and max values, ignoring NaN, and the NaN count of
+    values to stats
 
-def array_serializer(data, **kwargs):
-    """Convert the array data to a serialized binary format"""
-    if isinstance(data.flatten()[0], np.floating):
-        use_dtype = '<f4'
-        nan_mask = ~np.isnan(data)
-        assert np.allclose(
-                data.astype(use_dtype)[nan_mask], data[nan_mask]), \
-            'Converting the type should not screw things up.'
-    elif isinstance(data.flatten()[0], np.integer):
-        use_dtype = '<i4'
-        assert (data.astype(use_dtype) == data).all(), \
-            'Converting the type should not screw things up.'
+    valid may be given as the mask of values that are not NaN.
+    """
+    if values.dtype.kind == 'f':
+        if valid is None:
+            valid = ~np.isnan(values)
+        stats['nan_count'] += int(values.size - np.count_nonzero(valid))
+        values = values[valid]
+    if values.size:
+        low, high = values.min().item(), values.max().item()
+        if stats['min'] is None or low < stats['min']:
+            stats['min'] = low
+        if stats['max'] is None or high > stats['max']:
+            stats['max'] = high
+    return stats
+
+
+def array_stats(data):
+    """Min and max values, ignoring NaN, or None if there are none, and
+    NaN count of an array, gathered a chunk at a time as
+    array_serializer gathers them
+    """
+    data = np.asarray(data)
+    if data.ndim == 0:
+        data = data.reshape(1)
+    stats = {'min': None, 'max': None, 'nan_count': 0}
+    _, num_rows = _chunk_rows(data)
+    for start in range(0, data.shape[0], num_rows):
+        _add_stats(stats, data[start:start + num_rows])
+    return stats
+
+
+def array_serializer(data, output=None, **kwargs):
+    """Convert the array data to a serialized binary format
+
+    Arrays are converted in memory to little-endian float32 or int32.
+    Arrays that already have that type and are contiguous are
+    serialized without a copy. Others are converted into the output
+    buffer SERIALIZE_CHUNK_SIZE values at a time, checking that no
+    precision is lost, so the only full-size allocation is the output.
+    The min, max and NaN count are gathered in the same pass, as by
+    array_stats, and recorded as the stats of the file.
+
+    A flat output array of the serialized dtype may be given. It may
+    overlap data if it never runs ahead of the values still to be
+    converted, as when data is stored at the end of the output buffer.
+    """
+    data = np.asarray(data)
+    use_dtype = serial_dtype(data)
+    if data.ndim == 0:
+        data = data.reshape(1)
+    convert = data.dtype != use_dtype or not data.flags['C_CONTIGUOUS']
+    if convert and output is not None:
+        converted = output
+    elif convert:
+        converted = np.empty(data.size, dtype=use_dtype)
     else:
-        raise TypeError('Must be a float or an int: {}'.format(data.dtype))
+        converted = data.reshape(-1)
 
-    data_file = NamedTemporaryFile('rb+', suffix='.dat')
-    data.astype(use_dtype).tofile(data_file.file)
-    data_file.seek(0)
+    stats = {'min': None, 'max': None, 'nan_count': 0}
+    row_size, num_rows = _chunk_rows(data)
+    for start in range(0, data.shape[0], num_rows):
+        chunk = data[start:start + num_rows]
+        out = converted[
+            start * row_size:(start + len(chunk)) * row_size
+        ].reshape(chunk.shape)
+        if convert and np.may_share_memory(out, chunk):
+            chunk = chunk.copy()
+        if convert:
+            np.copyto(out, chunk, casting='unsafe')
+        valid = None
+        if use_dtype == '<f4':
+            valid = ~np.isnan(out)
+            if convert:
+                assert np.allclose(out[valid], chunk[valid]), \
+                    'Converting the type should not screw things up.'
+        elif convert:
+            assert (out == chunk).all(), \
+                'Converting the type should not screw things up.'
+        _add_stats(stats, out, valid)
+
+    data_file = BufferFile(converted.view(np.uint8), stats=stats)
     return FileProp(data_file, use_dtype)
 
 
+def encode_buffer(buf, encoding):
+    """Compress a buffer with the 'gzip' or 'zstd' codec"""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(buf) + compressor.flush()
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(buf)
+    raise ValueError('Unsupported array encoding: {}'.format(encoding))
+
+
+def decode_buffer(buf, encoding):
+    """Decompress a buffer encoded with encode_buffer"""
+    decoder = buffer_decoder(encoding)
+    return decoder.decompress(buf) + decoder.flush()
+
+
+def buffer_decoder(encoding):
+    """Incremental decompressor for buffers encoded with encode_buffer"""
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('Unsupported array encoding: {}'.format(encoding))
+
+
+def encode_files(files, encoding):
+    """Compress the serialized arrays in files for transport
+
+    Arrays are only compressed if the codec is available locally and
+    advertised by the server in Comms.array_encodings, and if
+    compression actually makes them smaller; otherwise they are sent
+    raw. Returns a new dictionary of files.
+    """
+    if encoding is None:
+        return files
+    if encoding not in ('gzip', 'zstd'):
+        raise ValueError('Unsupported array encoding: {}'.format(encoding))
+    if (
+            encoding not in ARRAY_ENCODINGS or
+            encoding not in Comms.array_encodings
+    ):
+        return files
+    encoded = dict(files)
+    for name, fileprop in files.items():
+        if fileprop.dtype not in ('<f4', '<i4'):
+            continue
+        if not isinstance(fileprop.file, BufferFile):
+            continue
+        raw = fileprop.file
+        compressed = raw.encoded.get(encoding, None)
+        if compressed is None:
+            compressed = encode_buffer(raw.buffer, encoding)
+        if len(compressed) >= len(raw):
+            continue
+        encoded[name] = FileProp(
+            BufferFile(compressed, name=raw.name, array_encoding=encoding,
+                       raw_nbytes=raw.raw_nbytes, patch=raw.patch,
+                       stats=raw.stats),
+            fileprop.dtype,
+        )
+        raw.close()
+    return encoded
+
+
+def block_digests(buf, block_size=PATCH_BLOCK_SIZE):
+    """Checksums of consecutive blocks of a serialized array"""
+    buf = memoryview(buf)
+    return [sha1(buf[start:start + block_size]).digest()
+            for start in range(0, len(buf), block_size)]
+
+
+def changed_ranges(digests, previous, nbytes, block_size=PATCH_BLOCK_SIZE):
+    """Merge the blocks whose checksums differ into (offset, length)
+    byte ranges
+    """
+    ranges = []
+    for index, digest in enumerate(digests):
+        if digest == previous[index]:
+            continue
+        start = index * block_size
+        stop = min(start + block_size, nbytes)
+        if ranges and ranges[-1][0] + ranges[-1][1] == start:
+            ranges[-1][1] += stop - start
+        else:
+            ranges += [[start, stop - start]]
+    return ranges
+
+
+def patch_files(files, previous=None, patching=False):
+    """Compare serialized arrays to the blocks last uploaded
+
+    previous maps file names to the (dtype, nbytes, digests) recorded
+    when they were last uploaded. Block digests are only computed if
+    patching is True, unless the array was prepared with them. Then
+    arrays where only some blocks changed are replaced by a patch of
+    those blocks, and unchanged arrays are dropped. Returns the files,
+    the new records, and the number of bytes that changed, which is
+    the whole array if it cannot be compared.
+    """
+    previous = previous or {}
+    patched = dict(files)
+    records = {}
+    changed_nbytes = 0
+    for name, fileprop in files.items():
+        if fileprop.dtype not in ('<f4', '<i4'):
+            continue
+        if not isinstance(fileprop.file, BufferFile):
+            continue
+        raw = fileprop.file
+        nbytes = len(raw)
+        digests = raw.digests
+        if digests is None and patching:
+            digests = block_digests(raw.buffer)
+        records[name] = (fileprop.dtype, nbytes, digests)
+        dtype, last_nbytes, last_digests = previous.get(
+            name, (None, None, None)
+        )
+        if (
+                not patching or
+                last_digests is None or
+                dtype != fileprop.dtype or
+                last_nbytes != nbytes
+        ):
+            changed_nbytes += nbytes
+            continue
+        ranges = changed_ranges(digests, last_digests, nbytes)
+        size = sum(length for _, length in ranges)
+        changed_nbytes += size
+        if size == 0:
+            # The server already has this array
+            del patched[name]
+            raw.close()
+            continue
+        if size == nbytes:
+            continue
+        patch = b''.join(
+            raw.buffer[start:start + length].tobytes()
+            for start, length in ranges
+        )
+        patched[name] = FileProp(
+            BufferFile(patch, name=raw.name, raw_nbytes=len(patch),
+                       patch=ranges),
+            fileprop.dtype,
+        )
+        raw.close()
+    return patched, records, changed_nbytes
+
+
+def transfer_nbytes(files):
+    """Return the raw and on-the-wire sizes of serialized files"""
+    raw_nbytes = 0
+    wire_nbytes = 0
+    for fileprop in files.values():
+        fileobj = getattr(fileprop, 'file', fileprop)
+        size = _file_size(fileobj)
+        wire_nbytes += size
+        raw_nbytes += getattr(fileobj, 'raw_nbytes', size)
+    return raw_nbytes, wire_nbytes
+
+def download_buffer(resp, encoding=None, monitor=None):
+    """Stream the body of a response into a numpy byte array
+
+    The array is preallocated from the Content-Length header and
+    filled in place as chunks arrive. Bodies encoded with encode_buffer
+    are decompressed chunk by chunk; their array grows as needed and is
+    trimmed once complete. If given, monitor is called with the number
+    of bytes received as each chunk arrives.
+    """
+    try:
+        capacity = int(resp.headers.get('Content-Length', 0))
+    except (AttributeError, TypeError, ValueError):
+        capacity = 0
+    decoder = None
+    if encoding:
+        decoder = buffer_decoder(encoding)
+        capacity *= 4
+    buf = np.empty(capacity or DOWNLOAD_CHUNK_SIZE, dtype=np.uint8)
+    size = 0
+    chunks = resp.iter_content(DOWNLOAD_CHUNK_SIZE)
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            if decoder is None:
+                break
+            chunk = decoder.flush()
+        elif monitor is not None:
+            monitor(len(chunk))
+        if decoder is not None and chunk:
+            chunk = decoder.decompress(chunk)
+        if size + len(chunk) > len(buf):
+            grown = np.empty(max(2 * len(buf), size + len(chunk)),
+                             dtype=np.uint8)
+            grown[:size] = buf[:size]
+            buf = grown
+        buf[size:size + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        size += len(chunk)
+    if size == len(buf):
+        return buf
+    if size >= len(buf) // 2:
+        return buf[:size]
+    return buf[:size].copy()
+
+
 class array_download(object):
+    """Deserializer that downloads an array of the given shape, where
+    '*' is the unknown dimension, and dtype
+
+    The array is streamed into a buffer by download_buffer and
+    reshaped in place. Arrays served from a DownloadCache are read
+    from the cached file in one pass instead.
+    """
 
     def __init__(self, shape, dtype):
         self.shape = shape
         self.dtype = dtype
 
-    def __call__(self, url, input_dtype=None, **kwargs):
-        arr_resp = get(url, timeout=60)
+    def __call__(self, url, input_dtype=None, encoding=None, cache=None,
+                 monitor=None, prefetched=None, **kwargs):
+        arr_resp = _download_response(url, cache, prefetched)
         if arr_resp.status_code != 200:
             raise IOError('Failed to download array.')
-        data_file = NamedTemporaryFile()
-        for chunk in arr_resp:
-            data_file.write(chunk)
-        data_file.seek(0)
+        monitor = _download_monitor(url, arr_resp, monitor, prefetched)
+        if hasattr(arr_resp, 'read_buffer') and not encoding:
+            buf = arr_resp.read_buffer()
+            if monitor is not None:
+                monitor(len(buf))
+        else:
+            buf = download_buffer(arr_resp, encoding, monitor)
         if input_dtype:
             dtype = input_dtype
         elif self.dtype[0] is int:
@@ -140,7 +830,7 @@ class array_download(object):
             dtype = '<f4'
         else:
             raise ValueError('Invalid dtype {}'.format(self.dtype))
-        arr = np.fromfile(data_file.file, dtype)
+        arr = buf.view(dtype)
         unknown_dim = len(arr)
         for dim in self.shape:
             if dim == '*':
@@ -154,6 +844,4 @@ class array_download(object):
         else:
             assert abs(unknown_dim) < 1e-9, 'bad shape'
             shape = self.shape
-        arr = arr.reshape(shape)
-        data_file.close()
-        return arr
+        return arr.reshape(shape)
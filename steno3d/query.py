@@ -3,6 +3,9 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from multiprocessing.pool import ThreadPool
+import time
+
 from six import integer_types
 
 from .client import Comms, needs_login
@@ -12,22 +15,53 @@ from .project import Project
 MINE = 'api/project/steno3ds/mine'
 
 
-def _query(url, queue=10, verbose=True):
-    cursor = ''
-    more = True
+def _query_page(url, queue, cursor):
+    resp = Comms.get('{url}?brief=True&num={n}&cursor={c}'.format(
+        url=url, n=queue, c=cursor
+    ))
+    return resp['json']
+
+
+def _query(url, queue=10, verbose=True, prefetch=False):
+    """Iterate over the projects returned by a query
+
+    Pages of `queue` projects are requested as they are needed. If
+    prefetch is True, the next page is requested on a background
+    thread while the projects of the current page are consumed.
+    """
     if verbose:
         print('Fetching projects from the database ...')
-    while more:
-        resp = Comms.get('{url}?brief=True&num={n}&cursor={c}'.format(
-            url=url, n=queue, c=cursor
-        ))
-        rjson = resp['json']
-        cursor = rjson['cursor']
-        more = rjson['more']
-        for proj in rjson['data']:
-            yield proj
-        if verbose:
-            print('Fetching more projects from the database ...')
+    pool = ThreadPool(1) if prefetch else None
+    try:
+        rjson = _query_page(url, queue, '')
+        while True:
+            pending = None
+            if rjson['more'] and pool is not None:
+                pending = pool.apply_async(
+                    _query_page, (url, queue, rjson['cursor'])
+                )
+            for proj in rjson['data']:
+                yield proj
+            if not rjson['more']:
+                return
+            if verbose:
+                print('Fetching more projects from the database ...')
+            if pending is None:
+                rjson = _query_page(url, queue, rjson['cursor'])
+            else:
+                rjson = pending.get()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _query_async(url, queue=10, verbose=True, transport=None):
+    """Async iterator over the projects returned by a query
+    (Python 3.6+)
+    """
+    from .aio import query
+    return query(url, queue, verbose, transport)
 
 
 def _short_json(proj_json):
@@ -37,18 +71,107 @@ def _short_json(proj_json):
             'created': proj_json['date']}
 
 
+class ProjectCache(object):
+    """Your projects as listed by my_projects, kept between calls
+
+    Within ttl seconds of the last listing, the cached projects are
+    returned without any requests. After that, pages are fetched from
+    your most recent project until one already in the cache is
+    reached, so only new projects are downloaded. Changes to projects
+    that are already cached, including deletions, are only seen after
+    clear().
+
+    Optional arguments:
+        ttl - Seconds a listing is used without requests (Default: 300)
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.clear()
+
+    @property
+    def fresh(self):
+        """True if the listing was updated less than ttl seconds ago"""
+        return (
+            self.updated is not None and
+            self.username == Comms.user.username and
+            time.time() - self.updated < self.ttl
+        )
+
+    def refresh(self, queue=100, verbose=True):
+        """Add the projects created since the last listing"""
+        if self.username != Comms.user.username:
+            self.clear()
+        known = set(proj['uid'] for proj in self.projects)
+        new = []
+        # Pages are only fetched ahead when listing all projects, since
+        # a refresh usually stops on its first page
+        projit = _query(MINE, queue, verbose, prefetch=not known)
+        for proj in projit:
+            if proj['uid'] in known:
+                break
+            new += [_short_json(proj)]
+        projit.close()
+        self.projects = new + self.projects
+        self.username = Comms.user.username
+        self.updated = time.time()
+        return new
+
+    def clear(self):
+        """Forget all cached projects"""
+        self.projects = []
+        self.username = None
+        self.updated = None
+
+
+_MY_PROJECTS = ProjectCache()
+
+
+@needs_login
+def iter_my_projects(queue=100, verbose=True, prefetch=True):
+    """Iterate over your projects, most recent first
+
+    Optional arguments:
+        queue    - Number of projects requested per page (Default: 100)
+        verbose  - Print query status (Default: True)
+        prefetch - Request the next page in the background while the
+                   current page is consumed (Default: True)
+    """
+    for proj in _query(MINE, queue, verbose, prefetch):
+        yield _short_json(proj)
+
+
 @needs_login
-def my_projects(n=None, queue=100, verbose=True):
+def my_projects(n=None, queue=100, verbose=True, cache=None):
+    """List your projects, most recent first
+
+    Optional arguments:
+        n       - Number of projects to list (Default: all projects)
+        queue   - Number of projects requested per page (Default: 100)
+        verbose - Print query status (Default: True)
+        cache   - If True or a ProjectCache, projects are listed from
+                  the cache, which is refreshed with only the projects
+                  created since it was last updated once its ttl has
+                  passed (Default: None)
+    """
+    if n is not None and not isinstance(n, integer_types):
+        raise ValueError('{}: n must be int'.format(n))
+    if cache:
+        if not isinstance(cache, ProjectCache):
+            cache = _MY_PROJECTS
+        if not cache.fresh:
+            if verbose:
+                print('Querying your new projects ...')
+            cache.refresh(queue, verbose)
+        return list(cache.projects if n is None else cache.projects[:n])
     if n is None:
         if verbose:
             print('Querying all your projects ...')
-        return [_short_json(p) for p in _query(MINE, queue)]
-    if not isinstance(n, integer_types):
-        raise ValueError('{}: n must be int'.format(n))
+        return [_short_json(p) for p in _query(MINE, queue, prefetch=True)]
     if verbose:
         print('Querying your most recent {} project(s) ...'.format(n))
     projs = []
-    projit = _query(MINE, min(n, queue))
+    projit = _query(MINE, min(n, queue), prefetch=n > queue)
     for _ in range(n):
         try:
             projs += [_short_json(next(projit))]
@@ -58,20 +181,60 @@ def my_projects(n=None, queue=100, verbose=True):
                     n=n, p=len(projs)
                 ))
             break
+    projit.close()
     if verbose:
         print('...Complete!')
     return projs
 
 
 @needs_login
-def project_by_uid(uid, copy=None, verbose=True):
-    return Project._build(uid, copy, verbose=verbose)
+def project_by_uid(uid, copy=None, verbose=True, workers=None,
+                   progress_callback=None, cache=None, lazy=False):
+    """Download a project
+
+    Optional arguments:
+        copy              - If True, the project is downloaded as a copy
+                            (Default: True unless you own the project)
+        verbose           - Print download status (Default: True)
+        workers           - Number of threads used to fetch the json of
+                            the resources and their arrays concurrently
+                            before the project is built. If None
+                            (default), everything is fetched one request
+                            at a time
+        progress_callback - Function that receives progress updates as
+                            arrays and images arrive; see
+                            DownloadProgress for their contents
+        cache             - If True or a DownloadCache, resource json,
+                            arrays and images are kept on disk and only
+                            downloaded again if they changed on the
+                            server (Default: None)
+        lazy              - If True, arrays and images are downloaded
+                            when first accessed or with
+                            Project.prefetch, rather than before the
+                            project is returned (Default: False)
+    """
+    return Project._build(uid, copy, verbose=verbose, workers=workers,
+                          progress_callback=progress_callback, cache=cache,
+                          lazy=lazy)
+
+
+def project_by_uid_async(uid, copy=None, verbose=True, **kwargs):
+    """Coroutine that downloads a project without blocking the event
+    loop (Python 3.6+)
+
+    Optional arguments:
+        concurrency - Maximum number of requests in flight (Default: 100)
+        transport   - AsyncTransport to share between calls
+    """
+    from .aio import project_by_uid
+    return project_by_uid(uid, copy, verbose, **kwargs)
 
 
 @needs_login
-def last_project(copy=None, verbose=True):
+def last_project(copy=None, verbose=True, cache=None):
     try:
-        return project_by_uid(next(_query(MINE, 1))['uid'], copy)
+        return project_by_uid(next(_query(MINE, 1))['uid'], copy,
+                              cache=cache)
     except StopIteration:
         if verbose:
             print('No projects available!')
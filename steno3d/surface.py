@@ -19,7 +19,8 @@ from .data import DataArray
 from .options import ColorOptions
 from .options import MeshOptions
 from .texture import Texture2DImage
-from .props import array_serializer, array_download, HasSteno3DProps
+from .props import (array_serializer, array_download, array_nbytes,
+                    HasSteno3DProps)
 
 
 class _Mesh2DOptions(MeshOptions):
@@ -72,7 +73,7 @@ class Mesh2D(BaseMesh):
         if isinstance(arr, string_types) and arr in ('vertices', 'triangles'):
             arr = getattr(self, arr)
         if isinstance(arr, ndarray):
-            return arr.astype('f4').nbytes
+            return array_nbytes(arr)
         raise ValueError('Mesh2D cannot calculate the number of '
                          'bytes of {}'.format(arr))
 
@@ -82,10 +83,14 @@ class Mesh2D(BaseMesh):
 
     @properties.validator
     def _validate_tri(self):
-        if npmin(self.triangles) < 0:
-            raise ValueError('Triangles may only have positive integers')
-        if npmax(self.triangles) >= len(self.vertices):
-            raise ValueError('Triangles expects more vertices than provided')
+        def check_triangles():
+            if npmin(self.triangles) < 0:
+                raise ValueError('Triangles may only have positive integers')
+            if npmax(self.triangles) >= len(self.vertices):
+                raise ValueError('Triangles expects more vertices than '
+                                 'provided')
+        self._cached_check('triangles', ('triangles', 'vertices'),
+                           check_triangles)
         self._validate_file_size('triangles', self.triangles)
         self._validate_file_size('vertices', self.vertices)
         return True
@@ -94,11 +99,9 @@ class Mesh2D(BaseMesh):
         files = {}
         dirty = self._dirty_props
         if 'vertices' in dirty or force:
-            files['vertices'] = \
-                self._props['vertices'].serialize(self.vertices)
+            files['vertices'] = self._serialize_array('vertices')
         if 'triangles' in dirty or force:
-            files['triangles'] = \
-                self._props['triangles'].serialize(self.triangles)
+            files['triangles'] = self._serialize_array('triangles')
         return files
 
     @classmethod
@@ -106,14 +109,12 @@ class Mesh2D(BaseMesh):
         mesh = Mesh2D(
             title=kwargs['title'],
             description=kwargs['description'],
-            vertices=cls._props['vertices'].deserialize(
-                json['vertices'],
-            ),
-            triangles=cls._props['triangles'].deserialize(
-                json['triangles'],
-            ),
             opts=json['meta']
         )
+        mesh._download('vertices', json['vertices'], kwargs,
+                       encoding=json.get('verticesEncoding', None))
+        mesh._download('triangles', json['triangles'], kwargs,
+                       encoding=json.get('trianglesEncoding', None))
         return mesh
 
     @classmethod
@@ -199,7 +200,7 @@ class Mesh2DGrid(BaseMesh):
                 return 0
             arr = getattr(self, arr)
         if isinstance(arr, ndarray):
-            return arr.astype('f4').nbytes
+            return array_nbytes(arr)
         raise ValueError('Mesh2DGrid cannot calculate the number of '
                          'bytes of {}'.format(arr))
 
@@ -243,7 +244,7 @@ class Mesh2DGrid(BaseMesh):
         files = super(Mesh2DGrid, self)._get_dirty_files(force)
         dirty = self._dirty_props
         if self.Z is not None and len(self.Z) > 0 and  ('Z' in dirty or force):
-            files['Z'] = self._props['Z'].serialize(self.Z)
+            files['Z'] = self._serialize_array('Z')
         return files
 
     @classmethod
@@ -259,9 +260,8 @@ class Mesh2DGrid(BaseMesh):
             opts=json['meta']
         )
         try:
-            mesh.Z = cls._props['Z'].deserialize(
-                json['Z'],
-            )
+            mesh._download('Z', json['Z'], kwargs,
+                           encoding=json.get('ZEncoding', None))
         except:
             mesh.Z = []
 
@@ -345,6 +345,14 @@ class Surface(CompositeResource):
                 sum(d.data._nbytes() for d in self.data) +
                 sum(t._nbytes() for t in self.textures))
 
+    def add_textures(self, textures):
+        """Add one or a list of textures in a single update"""
+        self._add_items('textures', textures)
+
+    def remove_textures(self, textures):
+        """Remove one or a list of textures in a single update"""
+        self._remove_items('textures', textures)
+
     @properties.validator
     def _validate_data(self):
         """Check if resource is built correctly"""
@@ -12,6 +12,7 @@ from six import string_types
 import properties
 
 from .base import BaseTexture2D
+from .client import _file_size
 from .props import image_download
 
 
@@ -41,8 +42,7 @@ class Texture2DImage(BaseTexture2D):
         if img is None or (isinstance(img, string_types) and img == 'image'):
             img = self.image
         try:
-            img.seek(0)
-            return len(img.read())
+            return _file_size(img)
         except:
             raise ValueError('Texture2DImage cannot calculate the number of '
                              'bytes of {}'.format(img))
@@ -94,8 +94,8 @@ class Texture2DImage(BaseTexture2D):
             O=json['OUV']['O'],
             U=json['OUV']['U'],
             V=json['OUV']['V'],
-            image=cls._props['image'].deserialize(json['image'])
         )
+        tex._download('image', json['image'], kwargs)
         return tex
 
     @classmethod
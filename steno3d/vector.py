@@ -10,7 +10,7 @@ from .base import CompositeResource
 from .options import ColorOptions
 
 from .point import Mesh0D, _PointBinder
-from .props import array_serializer, array_download
+from .props import array_serializer, array_download, array_nbytes
 
 
 class _VectorOptions(ColorOptions):
@@ -48,7 +48,7 @@ class Vector(CompositeResource):
     )
 
     def _nbytes(self):
-        return (self.mesh._nbytes() + self.vectors.astype('f4').nbytes +
+        return (self.mesh._nbytes() + array_nbytes(self.vectors) +
                 sum(d.data._nbytes() for d in self.data))
 
     @properties.validator
@@ -87,16 +87,14 @@ class Vector(CompositeResource):
         files = {}
         dirty = self._dirty_props
         if 'vectors' in dirty or force:
-            files['vectors'] = \
-                self._props['vectors'].serialize(self.vectors)
+            files['vectors'] = self._serialize_array('vectors')
         return files
 
     @classmethod
     def _build_from_json(cls, json, **kwargs):
         vec = super(Vector, cls)._build_from_json(json, **kwargs)
-        vec.vectors = cls._props['vectors'].deserialize(
-            json['vectors'],
-        )
+        vec._download('vectors', json['vectors'], kwargs,
+                      encoding=json.get('vectorsEncoding', None))
         return vec
 
 
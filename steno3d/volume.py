@@ -15,7 +15,7 @@ from .base import CompositeResource
 from .data import DataArray
 from .options import ColorOptions
 from .options import MeshOptions
-from .props import HasSteno3DProps
+from .props import HasSteno3DProps, array_nbytes
 
 
 class _Mesh3DOptions(MeshOptions):
@@ -86,7 +86,7 @@ class Mesh3DGrid(BaseMesh):
                 return 0
             arr = getattr(self, arr)
         if isinstance(arr, ndarray):
-            return arr.astype('f4').nbytes
+            return array_nbytes(arr)
         raise ValueError('Mesh3DGrid cannot calculate the number of '
                          'bytes of {}'.format(arr))
 
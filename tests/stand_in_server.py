@@ -0,0 +1,349 @@
+"""stand_in_server.py provides a minimal local stand-in for the steno3d
+web API so upload and download paths can be exercised without network
+access
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from email.parser import BytesParser
+from hashlib import sha1
+import json
+import random
+import string
+from threading import Lock, Thread
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qsl
+
+from steno3d.client import Comms, DEFAULT_POOL_SIZE
+from steno3d.props import HasSteno3DProps, decode_buffer
+
+
+USER_JSON = {
+    'uid': 'tester',
+    'email': 'tester@example.com',
+    'name': 'Tester',
+    'url': '',
+    'affiliation': '',
+    'location': '',
+}
+
+
+def _new_uid():
+    return ''.join(random.choice(string.ascii_letters) for _ in range(20))
+
+
+def _parse_form(content_type, body):
+    """Return the fields and files of a form-encoded request body"""
+    fields = {}
+    files = {}
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        fields.update(parse_qsl(body.decode('utf-8')))
+        return fields, files
+    if not content_type.startswith('multipart/form-data'):
+        return fields, files
+    message = BytesParser().parsebytes(
+        b'Content-Type: ' + content_type.encode('ascii') + b'\r\n\r\n' + body
+    )
+    for part in message.get_payload():
+        name = part.get_param('name', header='content-disposition')
+        payload = part.get_payload(decode=True)
+        if part.get_param('filename', header='content-disposition'):
+            files[name] = payload
+        else:
+            fields[name] = payload.decode('utf-8')
+    return fields, files
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _respond(self, status, payload=None, raw=None, headers=None):
+        if raw is None:
+            raw = json.dumps(payload if payload is not None else {}).encode()
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _respond_cacheable(self, payload=None, raw=None):
+        """Respond with an ETag, or 304 if the client has this version"""
+        if raw is None:
+            raw = json.dumps(payload).encode()
+        etag = '"{}"'.format(sha1(raw).hexdigest())
+        if self.headers.get('If-None-Match', None) == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        return self._respond(200, raw=raw, headers={'ETag': etag})
+
+    def _dispatch(self, method):
+        body = self._body() if method in ('POST', 'PUT') else b''
+        fields, files = _parse_form(
+            self.headers.get('Content-Type', ''), body
+        )
+        path = self.path.split('?')[0].strip('/')
+        server = self.server
+        with server.lock:
+            server.requests += [dict(
+                method=method,
+                path=path,
+                query=self.path.split('?')[1] if '?' in self.path else '',
+                headers=dict(self.headers),
+                fields=fields,
+                files=files,
+            )]
+        handler = server.hooks.get((method, path))
+        if handler is None:
+            for (hmethod, prefix), func in server.prefix_hooks.items():
+                if hmethod == method and path.startswith(prefix):
+                    handler = func
+                    break
+        if handler is not None:
+            result = handler(self, fields, files)
+            if result is not None:
+                return self._respond(*result)
+        if path.startswith('api/upload/chunked'):
+            return self._chunked(method, path, fields, files)
+        for name in list(fields):
+            if name.endswith('Upload') and fields[name] in server.chunked:
+                files[name[:-len('Upload')]] = bytes(
+                    server.chunked[fields.pop(name)]
+                )
+        if path.startswith('binary/'):
+            if path in server.binaries:
+                return self._respond_cacheable(raw=server.binaries[path])
+            return self._respond(404)
+        if not path.startswith('api/'):
+            return self._respond(404)
+        location = path[4:]
+        if method == 'POST' and location in server.api_classes:
+            if location in server.fail_classes:
+                return self._respond(500, {'reason': 'failure requested'})
+            key = self.headers.get('Idempotency-Key', None)
+            if key in server.idempotent:
+                return self._respond(200, server.objects[server.idempotent[key]])
+            uid = _new_uid()
+            record = dict(fields)
+            record.update(
+                uid=uid,
+                longUid='Resource{cls}:{uid}'.format(
+                    cls=server.api_classes[location], uid=uid
+                ),
+            )
+            with server.lock:
+                server.objects[uid] = record
+                server.files[uid] = files
+                if key is not None:
+                    server.idempotent[key] = uid
+            if server.drop_responses > 0:
+                with server.lock:
+                    server.drop_responses -= 1
+                return self._respond(502, {'reason': 'response dropped'})
+            return self._respond(200, record)
+        if location == 'project/steno3ds/mine' and method == 'GET':
+            return self._respond(200, server.project_page(
+                dict(parse_qsl(self.path.split('?')[1]))
+            ))
+        uid = location.split('/')[-1]
+        if uid in server.objects and method == 'PUT':
+            files = dict(files)
+            for name in [name for name in files if name.endswith('Patch')]:
+                files[name[:-len('Patch')]] = server.apply_patch(
+                    uid, name[:-len('Patch')], files.pop(name), files
+                )
+            with server.lock:
+                server.objects[uid].update(fields)
+                server.files[uid].update(files)
+            return self._respond(200, server.objects[uid])
+        if uid in server.objects and method == 'GET':
+            return self._respond_cacheable(server.resource_json(uid))
+        if location.startswith('check/quota'):
+            return self._respond(200, {})
+        return self._respond(404, {'reason': 'not found'})
+
+    def _chunked(self, method, path, fields, files):
+        server = self.server
+        upload_id = path.split('/')[-1]
+        if method == 'POST':
+            upload_id = _new_uid()
+            with server.lock:
+                server.chunked[upload_id] = bytearray()
+            return self._respond(200, {'uploadId': upload_id, 'offset': 0})
+        if upload_id not in server.chunked:
+            return self._respond(404, {'reason': 'unknown upload'})
+        received = server.chunked[upload_id]
+        if method == 'GET':
+            return self._respond(200, {'offset': len(received)})
+        with server.lock:
+            if server.fail_after_chunks is not None:
+                if server.fail_after_chunks == 0:
+                    server.fail_after_chunks = None
+                    return self._respond(500, {'reason': 'dropped'})
+                server.fail_after_chunks -= 1
+            if int(fields['offset']) != len(received):
+                return self._respond(409, {'offset': len(received)})
+            received.extend(files['chunk'])
+        return self._respond(200, {'offset': len(received)})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Threaded local server imitating the parts of the steno3d API the
+    client uses
+
+    Created resources are recorded in `objects` and `files`; every
+    request is recorded in `requests`. `hooks` and `prefix_hooks` map
+    (method, path) to functions that override the default behaviour
+    unless they return None.
+    Chunked uploads are assembled in `chunked`; setting
+    `fail_after_chunks` drops the chunk after that many succeed.
+    Created resources are remembered by Idempotency-Key; setting
+    `drop_responses` answers that many successful POSTs with an error.
+    Array patches sent with PUT are spliced into the stored files.
+    Resource json and files are served with ETags and answered with
+    304 if requested with a matching If-None-Match header.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.lock = Lock()
+        self.requests = []
+        self.objects = {}
+        self.files = {}
+        self.binaries = {}
+        self.hooks = {}
+        self.prefix_hooks = {}
+        self.fail_classes = set()
+        self.chunked = {}
+        self.fail_after_chunks = None
+        self.idempotent = {}
+        self.drop_responses = 0
+        self.api_classes = {}
+        for name, cls in HasSteno3DProps._REGISTRY.items():
+            location = getattr(cls, '_model_api_location', None)
+            if location:
+                self.api_classes[location] = name
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def resource_json(self, uid):
+        """Return the json of a created resource as sent for downloads
+
+        Uploaded files are served from binary/ urls and json fields are
+        decoded.
+        """
+        with self.lock:
+            record = dict(self.objects[uid])
+            files = dict(self.files.get(uid, {}))
+        for name, payload in files.items():
+            if name.endswith('Type') or name.endswith('Encoding'):
+                record[name] = payload.decode('utf-8')
+                continue
+            location = 'binary/{uid}/{name}'.format(uid=uid, name=name)
+            self.binaries[location] = payload
+            record[name] = self.url + location
+        for name in ('mesh', 'data', 'textures', 'meta', 'colormap',
+                     'categories'):
+            try:
+                record[name] = json.loads(record[name])
+            except (KeyError, TypeError, ValueError):
+                pass
+        record.setdefault('title', '')
+        record.setdefault('description', '')
+        record.setdefault('meta', {})
+        if record['longUid'].startswith('ResourceProject'):
+            record['resourceUids'] = [
+                long_uid for long_uid in
+                record.get('resourceUids', '').split(',') if long_uid
+            ]
+            record.update(
+                access=[],
+                owner={'uid': USER_JSON['uid']},
+                perspectiveUids=[],
+                date='2018-01-01T00:00:00',
+            )
+        return record
+
+    def project_page(self, params):
+        """Return a page of the projects query, most recent first"""
+        uids = [uid for uid, record in self.objects.items()
+                if record['longUid'].startswith('ResourceProject')][::-1]
+        start = int(params.get('cursor') or 0)
+        stop = start + int(params.get('num', 10))
+        return {
+            'data': [self.resource_json(uid) for uid in uids[start:stop]],
+            'cursor': str(stop),
+            'more': stop < len(uids),
+        }
+
+    def apply_patch(self, uid, name, ranges, files):
+        """Splice the changed ranges of a patch into a stored file"""
+        patch = files[name]
+        encoding = files.pop(name + 'Encoding', None)
+        if encoding is not None:
+            patch = decode_buffer(patch, encoding.decode('utf-8'))
+        with self.lock:
+            stored = bytearray(self.files[uid][name])
+        position = 0
+        for start, length in json.loads(ranges.decode('utf-8')):
+            stored[start:start + length] = patch[position:position + length]
+            position += length
+        return bytes(stored)
+
+    def posted(self, location=None):
+        """List the POST requests, optionally for one api location"""
+        return [
+            req for req in self.requests if req['method'] == 'POST' and (
+                location is None or req['path'] == 'api/' + location
+            )
+        ]
+
+
+def login(server):
+    """Point steno3d at the stand-in server with a logged in user"""
+    Comms.base_url = server.url
+    Comms.user.login_with_json(USER_JSON)
+    Comms.user.set_key('tester//' + 'x'*36)
+
+
+def logout():
+    Comms.user.logout()
+    Comms._close_session()
+    Comms._pool_size = DEFAULT_POOL_SIZE
+    Comms._base_url = 'https://steno3d.com/'
@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import unittest
+
+import numpy as np
+import steno3d
+
+from steno3d import aio
+from steno3d.aio import AsyncTransport
+from steno3d.client import Comms, DEFAULT_POOL_SIZE
+from steno3d.query import MINE, _query_async, project_by_uid_async
+from stand_in_server import StandInServer, login, logout
+from test_upload import _build_project
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncTests(object):
+    """Tests run with aiohttp and with requests on threads"""
+
+    user_agent = None
+
+    def setUp(self):
+        self.server = StandInServer().start()
+        login(self.server)
+
+    def tearDown(self):
+        logout()
+        self.server.stop()
+
+    def test_upload_async(self):
+        proj = _build_project()
+        progress = []
+        uid = _run(proj.upload_async(verbose=False, concurrency=50,
+                                     progress_callback=progress.append))
+        progress = [status for status in progress if 'resource' in status]
+        assert uid == proj._json['uid']
+        assert all(self.user_agent in req['headers']['User-Agent']
+                   for req in self.server.posted())
+        assert Comms.pool_size == DEFAULT_POOL_SIZE
+        assert len(self.server.posted('resource/mesh2d')) == 4
+        assert len(self.server.posted('resource/data/array')) == 12
+        assert len(self.server.posted('resource/surface')) == 6
+        assert len(progress) == 1 + 4 + 12 + 6
+        assert abs(progress[-1]['progress'] - 1) < 1e-6
+        for res in proj.resources:
+            record = self.server.objects[res._json['uid']]
+            assert res.mesh._json['longUid'] in record['mesh']
+            for dat in res.data:
+                uploaded = self.server.files[dat.data._json['uid']]
+                assert uploaded['array'] == dat.data.array.astype(
+                    '<f4'
+                ).tobytes()
+        record = self.server.objects[uid]
+        assert record['resourceUids'] == ','.join(
+            r._json['longUid'] for r in proj.resources
+        )
+
+        self.server.fail_classes.add('resource/data/array')
+        proj = _build_project(num_surfaces=2)
+        try:
+            _run(proj.upload_async(verbose=False))
+        except steno3d.UploadError as err:
+            assert len(err.errors) == 4
+        else:
+            raise AssertionError('upload should fail')
+
+    def test_shared_transport(self):
+        projects = [_build_project(num_surfaces=2) for _ in range(5)]
+
+        async def upload_all():
+            async with AsyncTransport(4) as transport:
+                return await asyncio.gather(*[
+                    proj.upload_async(verbose=False, transport=transport)
+                    for proj in projects
+                ])
+
+        uids = _run(upload_all())
+        assert len(set(uids)) == 5
+        assert len(self.server.posted('project/steno3d')) == 5
+
+        async def collect():
+            return [proj async for proj in _query_async(MINE, 2,
+                                                        verbose=False)]
+        listed = _run(collect())
+        assert sorted(proj['uid'] for proj in listed) == sorted(uids)
+
+    def test_download_async(self):
+        proj = _build_project(num_surfaces=2)
+        uid = proj.upload(verbose=False)
+        self.server.requests = []
+        copy = _run(project_by_uid_async(uid, verbose=False))
+        gets = [req for req in self.server.requests if req['method'] == 'GET']
+        # project, 2 surfaces, 2 meshes, 4 data, 4 vertex and triangle
+        # arrays and 4 data arrays
+        assert len(gets) == 17
+        assert len(copy.resources) == 2
+        for original, res in zip(proj.resources, copy.resources):
+            assert np.allclose(res.mesh.vertices, original.mesh.vertices)
+            assert np.array_equal(res.mesh.triangles,
+                                  original.mesh.triangles)
+            for orig_data, data in zip(original.data, res.data):
+                assert data.location == orig_data.location
+                assert np.allclose(data.data.array, orig_data.data.array)
+
+
+@unittest.skipIf(aio.aiohttp is None, 'aiohttp is not installed')
+class TestAsync(AsyncTests, unittest.TestCase):
+
+    user_agent = 'aiohttp'
+
+
+class TestAsyncThreads(AsyncTests, unittest.TestCase):
+
+    user_agent = 'python-requests'
+
+    def setUp(self):
+        self.aiohttp = aio.aiohttp
+        aio.aiohttp = None
+        super(TestAsyncThreads, self).setUp()
+
+    def tearDown(self):
+        super(TestAsyncThreads, self).tearDown()
+        aio.aiohttp = self.aiohttp
+
+
+if __name__ == '__main__':
+    unittest.main()
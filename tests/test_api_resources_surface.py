@@ -168,12 +168,15 @@ class TestResourceSurface(unittest.TestCase):
         S.mesh.triangles = myTriangles
         S.mesh.vertices = myVerts
         S.data = {'data': [0], 'location': 'face'}
-        assert type(S.data) is list
+        assert isinstance(S.data, list)
         S.data = [{'data': [0], 'location': 'face'}]
-        assert type(S.data) is list
+        assert isinstance(S.data, list)
+        assert S.data is S.data
         d0 = S.data[0]
-        # copying the list and appending to it (not the same list!)
-        S.data.append({'data': [2], 'location': 'vertex'})
+        # lists cannot be changed in place
+        self.assertRaises(TypeError, lambda: S.data.append(
+            {'data': [2], 'location': 'vertex'}
+        ))
         assert len(S.data) == 1
         # iadd is resetting the list and doing validation
         S.data += [{'data': [2], 'location': 'vertex'}]
@@ -187,6 +190,13 @@ class TestResourceSurface(unittest.TestCase):
         assert S.data[1].data.description == ''
         assert np.all(S.data[1].data.array == [0, 1, 2])
         S.validate()
+        d1 = S.data[1]
+        S.remove_data(d0.data)
+        assert S.data == [d1]
+        S.add_data([d0, {'data': [3], 'location': 'face'}])
+        assert S.data[:2] == [d1, d0]
+        S.remove_data(S.data[1:])
+        assert S.data == [d1]
 
     def test_surface_mesh2dgrid(self):
         myh1 = [5., 4., 3., 2., 1., 1., 1., 1., 2., 3., 4., 5.]
@@ -300,6 +310,22 @@ class TestResourceSurface(unittest.TestCase):
         p4.validate()
         p5.validate()
 
+        p6 = steno3d.Project()
+        p6.add_resources(iter([s0, s1, s0]))
+        assert p6.resources == [s0, s1]
+        assert s0.project[-1] is p6 and s1.project[-1] is p6
+        s3 = steno3d.Surface([], mesh=m)
+        p6.add_resources(s3)
+        assert p6.resources == [s0, s1, s3]
+        assert s3.project == [p6]
+        p6.remove_resources([s0, s3])
+        assert p6.resources == [s1]
+        assert p6 not in s0.project
+        assert s3.project == []
+        s1.project = []
+        assert p6.resources == []
+        p6.validate()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,204 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import unittest
+import weakref
+
+import numpy as np
+import steno3d
+
+from steno3d import props
+from steno3d.props import array_serializer
+
+
+class TestArraySerializer(unittest.TestCase):
+
+    def test_in_memory_serialization(self):
+        arr = np.random.rand(100, 3).astype('<f4')
+        serial = array_serializer(arr)
+        assert serial.dtype == '<f4'
+        assert np.shares_memory(np.frombuffer(serial.file.buffer, '<f4'), arr)
+        assert len(serial.file) == arr.nbytes
+        assert bytes(serial.file.read(8)) == arr.tobytes()[:8]
+        assert bytes(serial.file.read()) == arr.tobytes()[8:]
+        serial.file.seek(0)
+        assert bytes(serial.file.read()) == arr.tobytes()
+
+    def test_converted_serialization(self):
+        arr = np.arange(12, dtype='>i8').reshape(4, 3)
+        serial = array_serializer(arr)
+        assert serial.dtype == '<i4'
+        assert bytes(serial.file.read()) == arr.astype('<i4').tobytes()
+
+        arr = np.array([1.5, np.nan, 3.])
+        serial = array_serializer(arr)
+        assert serial.dtype == '<f4'
+        out = np.frombuffer(serial.file.read(), '<f4')
+        assert np.isnan(out[1]) and out[0] == 1.5 and out[2] == 3.
+
+        self.assertRaises(AssertionError, array_serializer,
+                          np.array([2**40]))
+        self.assertRaises(TypeError, array_serializer, np.array(['a']))
+
+    def test_chunked_serialization(self):
+        chunk_size = props.SERIALIZE_CHUNK_SIZE
+        props.SERIALIZE_CHUNK_SIZE = 7
+        try:
+            arr = np.asfortranarray(np.random.rand(20, 3))
+            arr[4, 1] = np.nan
+            serial = array_serializer(arr)
+            out = np.frombuffer(serial.file.read(), '<f4').reshape(20, 3)
+            assert np.allclose(out, arr, equal_nan=True)
+            stats = serial.file.stats
+            assert stats['nan_count'] == 1
+            assert np.isclose(stats['min'], np.nanmin(arr))
+            assert np.isclose(stats['max'], np.nanmax(arr))
+
+            arr = np.arange(50, dtype='i8')
+            arr[30] = 2**40
+            self.assertRaises(AssertionError, array_serializer, arr)
+            serial = array_serializer(arr[::2][:10])
+            assert bytes(serial.file.read()) == np.arange(
+                0, 20, 2, dtype='<i4'
+            ).tobytes()
+            assert serial.file.stats == {'min': 0, 'max': 18,
+                                         'nan_count': 0}
+        finally:
+            props.SERIALIZE_CHUNK_SIZE = chunk_size
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestValidationCache(unittest.TestCase):
+
+    def test_unchanged_arrays_skip_validation(self):
+        mesh = steno3d.Mesh2D(
+            vertices=np.random.rand(10, 3),
+            triangles=np.random.randint(0, 10, (20, 3)),
+        )
+        assert 'prop:triangles' in mesh._validation_cache
+        calls = []
+        check = mesh._validate_prop
+        mesh._validate_prop = lambda *args: calls.append(args[0]) or check(
+            *args
+        )
+        mesh.validate()
+        assert 'triangles' in mesh._validation_cache
+        assert 'vertices' not in calls and 'triangles' not in calls
+        cached = dict(mesh._validation_cache)
+        mesh.title = 'changed'
+        mesh.validate()
+        assert mesh._validation_cache == cached
+
+        mesh.vertices = np.random.rand(5, 3)
+        assert 'triangles' not in mesh._validation_cache
+        self.assertRaises(ValueError, mesh.validate)
+        mesh.triangles = np.random.randint(0, 5, (20, 3))
+        mesh.validate()
+
+
+class TestSizeLedger(unittest.TestCase):
+
+    def test_project_size_rolls_up(self):
+        proj = steno3d.Project()
+        mesh = steno3d.Mesh2D(
+            vertices=np.random.rand(10, 3),
+            triangles=np.random.randint(0, 10, (20, 3)).astype('i8'),
+        )
+        steno3d.Surface(proj, mesh=mesh,
+                        data=[dict(location='N', data=np.random.rand(10))])
+        steno3d.Surface(proj, mesh=mesh)
+        assert mesh._nbytes() == (30 + 60) * 4
+        assert proj._total_nbytes() == 2 * (30 + 60) * 4 + 40
+        mesh.vertices = np.random.rand(12, 3)
+        assert proj._total_nbytes() == 2 * (36 + 60) * 4 + 40
+        proj.resources[0].data[0].data.array = np.random.rand(12)
+        assert proj._total_nbytes() == 2 * (36 + 60) * 4 + 48
+        proj.remove_resources(proj.resources[1])
+        assert proj._total_nbytes() == (36 + 60) * 4 + 48
+
+
+class TestDirtyLinks(unittest.TestCase):
+
+    def _mesh(self):
+        return steno3d.Mesh2D(
+            vertices=np.random.rand(10, 3),
+            triangles=np.random.randint(0, 10, (20, 3)),
+        )
+
+    def test_collected_parents_are_unlinked(self):
+        mesh = self._mesh()
+        for _ in range(10):
+            steno3d.Surface(steno3d.Project(), mesh=mesh)
+        gc.collect()
+        assert mesh._parents == {}
+
+    def test_reused_parent_id(self):
+        mesh = self._mesh()
+        surf = steno3d.Surface(steno3d.Project())
+        dead = steno3d.Surface(steno3d.Project())
+        dead_ref = weakref.ref(dead)
+        del dead
+        gc.collect()
+        # Link left by a collected parent that had the id of surf
+        mesh._parents[(id(surf), 'mesh')] = [dead_ref, 1]
+        surf.mesh = mesh
+        surf._mark_clean()
+        assert surf._dirty == set()
+        mesh.vertices = np.random.rand(10, 3)
+        assert surf._dirty == {'mesh'}
+
+
+class TestDataSummary(unittest.TestCase):
+
+    def test_category_summary_is_shared(self):
+        data = steno3d.DataCategory(array=[0, 2, -1, 2])
+        summary = data._array_summary()
+        assert summary['min'] == -1 and summary['max'] == 2
+        data.validate()
+        assert data.categories == ['', '', '']
+        assert len(data.colormap) == 3
+        assert data._array_summary() is summary
+
+        data.array = [0, 1]
+        assert data._array_summary()['max'] == 1
+        self.assertRaises(ValueError, setattr, data, 'array', [-2, 0])
+
+        data = steno3d.DataArray(array=[1., np.nan, -3.])
+        summary = data._array_summary()
+        assert summary['min'] == -3 and summary['max'] == 1
+        assert summary['nan_count'] == 1
+        assert summary == array_serializer(data.array).file.stats
+
+
+class TestDownloadBuffer(unittest.TestCase):
+
+    class _Response(object):
+
+        def __init__(self, content, headers):
+            self.content = content
+            self.headers = headers
+
+        def iter_content(self, chunk_size):
+            for start in range(0, len(self.content), chunk_size):
+                yield self.content[start:start + chunk_size]
+
+    def test_stream_into_buffer(self):
+        arr = np.random.rand(100000).astype('<f4')
+        raw = arr.tobytes()
+        received = []
+        resp = self._Response(raw, {'Content-Length': str(len(raw))})
+        buf = props.download_buffer(resp, monitor=received.append)
+        assert buf.base is None
+        assert np.array_equal(buf.view('<f4'), arr)
+        assert sum(received) == len(raw)
+
+        encoded = props.encode_buffer(raw, 'gzip')
+        resp = self._Response(encoded, {})
+        buf = props.download_buffer(resp, 'gzip')
+        assert np.array_equal(buf.view('<f4'), arr)
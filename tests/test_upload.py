@@ -0,0 +1,836 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from os import path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import steno3d
+
+from steno3d import progress
+from steno3d.base import SYNC_QUIET_PERIOD, UserContent
+from steno3d.cache import DownloadCache, UploadCache
+from steno3d.client import (Comms, CHUNK_SIZE, DEFAULT_POOL_SIZE, RetryPolicy,
+                            UPLOAD_JOURNAL)
+from steno3d.prepare import prepare_files
+from steno3d.props import PATCH_BLOCK_SIZE, decode_buffer
+from steno3d.query import (ProjectCache, iter_my_projects, my_projects,
+                           project_by_uid)
+from stand_in_server import StandInServer, login, logout
+
+
+def _build_project(num_surfaces=6, seed=None):
+    if seed is not None:
+        np.random.seed(seed)
+    proj = steno3d.Project(title='Test project')
+    shared_mesh = steno3d.Mesh2D(
+        vertices=np.random.rand(10, 3),
+        triangles=np.random.randint(0, 10, (8, 3)),
+    )
+    for i in range(num_surfaces):
+        steno3d.Surface(
+            project=proj,
+            title='Surface {}'.format(i),
+            mesh=shared_mesh if i % 2 else dict(
+                vertices=np.random.rand(6, 3),
+                triangles=np.random.randint(0, 6, (4, 3)),
+            ),
+            data=[
+                dict(location='N', data=np.random.rand(
+                    10 if i % 2 else 6
+                )),
+                dict(location='CC', data=np.random.rand(
+                    8 if i % 2 else 4
+                )),
+            ],
+        )
+    return proj
+
+
+class TestUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer().start()
+        login(self.server)
+        self.synced = []
+
+    def tearDown(self):
+        for proj in self.synced:
+            with proj._sync_queue._lock:
+                proj._sync_queue._cancel_timer()
+            for res in [proj] + proj.resources + proj._leaves():
+                res._sync = False
+        logout()
+        self.server.stop()
+
+    def _summary(self):
+        counts = {}
+        for req in self.server.posted():
+            counts[req['path']] = counts.get(req['path'], 0) + 1
+        return counts
+
+    def test_concurrent_upload_matches_serial(self):
+        proj = _build_project()
+        proj.upload(verbose=False)
+        serial = self._summary()
+        self.server.requests = []
+
+        proj = _build_project()
+        progress = []
+        proj.upload(verbose=False, workers=4, progress_callback=progress.append)
+        progress = [status for status in progress if 'resource' in status]
+        assert self._summary() == serial
+        assert serial['api/resource/mesh2d'] == 4
+        assert serial['api/resource/surface'] == 6
+        assert serial['api/resource/data/array'] == 12
+
+        assert len(progress) == 1 + 4 + 12 + 6
+        assert abs(progress[-1]['progress'] - 1) < 1e-6
+        for res in proj.resources:
+            record = self.server.objects[res._json['uid']]
+            assert res.mesh._json['longUid'] in record['mesh']
+            for dat in res.data:
+                assert dat.data._json['longUid'] in record['data']
+                uploaded = self.server.files[dat.data._json['uid']]
+                assert uploaded['array'] == dat.data.array.astype(
+                    '<f4'
+                ).tobytes()
+        record = self.server.objects[proj._json['uid']]
+        assert record['resourceUids'] == ','.join(
+            r._json['longUid'] for r in proj.resources
+        )
+
+    def test_concurrent_upload_collects_errors(self):
+        self.server.fail_classes.add('resource/data/array')
+        proj = _build_project(num_surfaces=3)
+        try:
+            proj.upload(verbose=False, workers=4)
+        except steno3d.UploadError as err:
+            assert len(err.errors) == 6
+        else:
+            raise AssertionError('upload should fail')
+        assert len(self.server.posted('resource/surface')) == 0
+        assert len(self.server.posted('project/steno3d')) == 0
+
+    def test_session_cookies_and_pool(self):
+        adapters = []
+
+        def set_cookie(handler, fields, files):
+            adapters.append(Comms.session.adapters['http://'])
+            return 200, {}, None, {'Set-Cookie': 'session=abc; Path=/'}
+        self.server.hooks[('GET', 'api/check/quota')] = set_cookie
+        session = Comms.session
+        proj = _build_project(num_surfaces=2)
+        proj.upload(verbose=False, workers=16)
+        assert Comms.session is session
+        # The pool is only enlarged for the upload
+        assert Comms._mounted_pool_size == Comms.pool_size
+        assert Comms.pool_size == DEFAULT_POOL_SIZE
+        assert adapters[0]._pool_maxsize == 16
+        assert Comms.session.adapters['http://'] is not adapters[0]
+        assert len(adapters[0].poolmanager.pools) == 0
+        posts = self.server.posted()
+        assert all('session=abc' in req['headers'].get('Cookie', '')
+                   for req in posts)
+        logout()
+        assert Comms._session is None
+
+    def test_dedupe_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = path.join(directory, 'upload_cache.json')
+            proj = _build_project(num_surfaces=2, seed=0)
+            proj.upload(verbose=False, dedupe=UploadCache(cache_file))
+            assert len(self.server.posted('resource/data/array')) == 4
+            assert path.isfile(cache_file)
+
+            self.server.requests = []
+            proj = _build_project(num_surfaces=2, seed=0)
+            plan = proj.plan_upload(dedupe=UploadCache(cache_file))
+            assert plan['references'] == 2 + 4
+            proj.upload(verbose=False, dedupe=UploadCache(cache_file))
+            # References check that the cached resources still exist
+            assert plan['num_requests'] == len(self.server.requests)
+            assert len(self.server.posted('resource/mesh2d')) == 0
+            assert len(self.server.posted('resource/data/array')) == 0
+            assert len(self.server.posted('resource/surface')) == 2
+
+            # Changing a cached resource posts a new one instead of
+            # modifying the shared resource
+            old_uid = proj.resources[0].data[0].data._json['longUid']
+            proj.resources[0].data[0].data.array = np.random.rand(6)
+            plan = proj.plan_upload(dedupe=UploadCache(cache_file))
+            # Planning does not mark the reference to the data dirty
+            assert proj.resources[0]._dirty_props == set()
+            self.server.requests = []
+            proj.upload(verbose=False, dedupe=UploadCache(cache_file))
+            assert [req['method'] for req in plan['requests']] == [
+                'post', 'put'
+            ]
+            assert plan['num_requests'] == len(self.server.requests)
+            assert len(self.server.posted('resource/data/array')) == 1
+            new_uid = proj.resources[0].data[0].data._json['longUid']
+            assert new_uid != old_uid
+            record = self.server.objects[proj.resources[0]._json['uid']]
+            assert new_uid in record['data']
+
+            # Cached resources deleted on the server are uploaded again
+            mesh_uid = proj.resources[0].mesh._json['uid']
+            del self.server.objects[mesh_uid]
+            self.server.requests = []
+            proj = _build_project(num_surfaces=2, seed=0)
+            proj.upload(verbose=False, dedupe=UploadCache(cache_file))
+            assert len(self.server.posted('resource/mesh2d')) == 1
+            assert proj.resources[0].mesh._json['uid'] != mesh_uid
+            assert mesh_uid not in str(UploadCache(cache_file).entries)
+
+            # Caches are namespaced per user
+            Comms.user._backend['username'] = 'other'
+            self.server.requests = []
+            proj = _build_project(num_surfaces=2, seed=0)
+            proj.upload(verbose=False, dedupe=UploadCache(cache_file))
+            assert len(self.server.posted('resource/data/array')) == 4
+
+            cache = UploadCache(cache_file, max_entries=3)
+            cache.put('a', {'uid': 'a', 'longUid': 'a'})
+            assert len(cache.entries) == 3
+            assert cache.get('a') == {'uid': 'a', 'longUid': 'a'}
+        finally:
+            shutil.rmtree(directory)
+
+    def test_chunked_resumable_upload(self):
+        directory = tempfile.mkdtemp()
+        try:
+            Comms.journal_file = path.join(directory, 'journal.json')
+            Comms.chunk_threshold = 1000
+            Comms.chunk_size = 400
+            Comms.retry_policy = RetryPolicy(max_retries=0)
+            proj = steno3d.Project()
+            arr = np.random.rand(1000)
+            steno3d.Point(
+                project=proj,
+                mesh=dict(vertices=np.random.rand(1000, 3)),
+                data=[dict(location='N', data=arr)],
+            )
+            self.server.fail_after_chunks = 12
+            self.assertRaises(steno3d.UploadError, proj.upload,
+                              verbose=False)
+            assert len(Comms._read_journal()) == 1
+            self.server.requests = []
+            proj.upload(verbose=False)
+            chunk_puts = [req for req in self.server.requests
+                          if req['method'] == 'PUT' and
+                          req['path'].startswith('api/upload/chunked')]
+            # 30 vertex and 10 data chunks, 12 sent before the failure
+            assert len(chunk_puts) == 40 - 12
+            assert int(chunk_puts[0]['fields']['offset']) > 0
+            assert Comms._read_journal() == {}
+            data = proj.resources[0].data[0].data
+            uploaded = self.server.files[data._json['uid']]
+            assert uploaded['array'] == arr.astype('<f4').tobytes()
+            assert 'arrayUpload' not in self.server.objects[data._json['uid']]
+        finally:
+            Comms.chunk_threshold = None
+            Comms.retry_policy = RetryPolicy()
+            Comms.journal_file = UPLOAD_JOURNAL
+            shutil.rmtree(directory)
+
+    def test_concurrent_journal_updates(self):
+        directory = tempfile.mkdtemp()
+        try:
+            Comms.journal_file = path.join(directory, 'a', 'b', 'journal')
+            keys = ['key{}'.format(i) for i in range(50)]
+            threads = [
+                threading.Thread(target=Comms._update_journal,
+                                 args=([key], key))
+                for key in keys
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert Comms._read_journal() == {key: key for key in keys}
+        finally:
+            Comms.journal_file = UPLOAD_JOURNAL
+            shutil.rmtree(directory)
+
+    def test_compressed_upload(self):
+        proj = _build_project(num_surfaces=2)
+        proj.upload(verbose=False, compression='gzip')
+        # Server did not advertise gzip, so arrays are sent raw
+        assert all('arrayEncoding' not in req['files']
+                   for req in self.server.posted('resource/data/array'))
+
+        Comms.array_encodings = {'gzip'}
+        try:
+            proj = steno3d.Project()
+            steno3d.Point(
+                project=proj,
+                mesh=dict(vertices=np.random.rand(50, 3)),
+                data=[dict(location='N', data=np.zeros(50))],
+            )
+            progress = []
+            proj.upload(verbose=False, compression='gzip',
+                        progress_callback=progress.append)
+            assert progress[-1]['wire_bytes'] < progress[-1]['raw_bytes']
+            data = proj.resources[0].data[0].data
+            uploaded = self.server.files[data._json['uid']]
+            assert uploaded['arrayEncoding'] == b'gzip'
+            assert decode_buffer(uploaded['array'], 'gzip') == np.zeros(
+                50, '<f4'
+            ).tobytes()
+            # Random vertices do not compress so they are sent raw
+            mesh = proj.resources[0].mesh
+            assert 'verticesEncoding' not in self.server.files[
+                mesh._json['uid']
+            ]
+        finally:
+            Comms.array_encodings = set()
+
+    def test_retry_policy(self):
+        failures = {'count': 2}
+
+        def flaky(handler, fields, files):
+            if failures['count'] > 0:
+                failures['count'] -= 1
+                return 503, {'reason': 'busy'}, None, {'Retry-After': '0'}
+        self.server.hooks[('POST', 'api/resource/mesh2d')] = flaky
+        Comms.retry_policy = RetryPolicy(backoff=0)
+        try:
+            # POSTs are not retried unless the server recognizes
+            # Idempotency-Key headers
+            proj = _build_project(num_surfaces=1)
+            self.assertRaises(steno3d.UploadError, proj.upload,
+                              verbose=False)
+            assert len(self.server.posted('resource/mesh2d')) == 1
+            assert failures['count'] == 1
+
+            Comms.idempotency_keys = True
+            failures['count'] = 2
+            self.server.requests = []
+            proj = _build_project(num_surfaces=1)
+            self.server.drop_responses = 1
+            statuses = []
+            proj.upload(verbose=False, progress_callback=statuses.append)
+            statuses = [status for status in statuses
+                        if 'resource' in status]
+            # Dropped responses are retried with the same key and do
+            # not create duplicates
+            assert len(self.server.posted('resource/mesh2d')) == 4
+            assert len(self.server.objects) == 5
+            attempts = [len(status['attempts']) for status in statuses]
+            assert attempts[:3] == [4, 1, 1]
+            assert statuses[0]['attempts'][0]['status_code'] == 503
+            assert all(att['elapsed'] >= 0
+                       for status in statuses
+                       for att in status['attempts'])
+
+            self.server.fail_classes.add('resource/data/array')
+            proj = _build_project(num_surfaces=1)
+            self.server.requests = []
+            self.assertRaises(steno3d.UploadError, proj.upload,
+                              verbose=False)
+            assert len(self.server.posted('resource/data/array')) == 4
+
+            Comms.retry_policy = RetryPolicy(max_retries=0)
+            self.server.requests = []
+            self.assertRaises(steno3d.UploadError, proj.upload,
+                              verbose=False)
+            assert len(self.server.posted('resource/data/array')) == 1
+        finally:
+            Comms.idempotency_keys = False
+            Comms.retry_policy = RetryPolicy()
+
+        policy = RetryPolicy(backoff=1, max_backoff=3)
+        assert all(0 <= policy.delay(n) <= min(3, 2**n) for n in range(5))
+        self.assertRaises(ValueError, RetryPolicy, max_retries=-1)
+
+    def _puts(self, location):
+        return [req for req in self.server.requests
+                if req['method'] == 'PUT' and
+                req['path'].startswith('api/' + location)]
+
+    def test_batched_sync(self):
+        proj = _build_project(num_surfaces=3)
+        self.synced += [proj]
+        proj.upload(verbose=False, sync=True, sync_delay=60)
+        other = _build_project(num_surfaces=1)
+        self.synced += [other]
+        other.upload(verbose=False, sync=True, sync_delay=0)
+        queue = proj._sync_queue
+        assert queue.quiet_period == 60
+        assert UserContent._sync_queue.quiet_period == SYNC_QUIET_PERIOD
+        self.server.requests = []
+        data = [d.data for res in proj.resources for d in res.data]
+        for dat in data:
+            dat.title = 'changed'
+            dat.array = np.random.rand(len(dat.array))
+        assert self._puts('resource/data/array') == []
+        assert queue._timer is not None
+        queue.flush()
+        assert queue._timer is None
+        assert len(self._puts('resource/data/array')) == len(data)
+
+        self.server.requests = []
+        with proj.batch():
+            for res in proj.resources:
+                res.title = 'changed'
+                res.data[0].data.title = 'changed again'
+                res.opts.opacity = 0.5
+            assert self.server.requests == []
+            # Other projects are not deferred by the batch
+            other.resources[0].title = 'changed'
+            assert len(self._puts('resource/surface')) == 1
+            self.server.requests = []
+        assert len(self._puts('resource/data/array')) == 3
+        assert len(self._puts('resource/surface')) == 3
+        uid = proj.resources[0].data[0].data._json['uid']
+        assert self.server.objects[uid]['title'] == 'changed again'
+        assert queue._timer is None and len(queue._pending) == 0
+
+    def test_sync_change_in_flight(self):
+        proj = _build_project(num_surfaces=1)
+        self.synced += [proj]
+        proj.upload(verbose=False, sync=True, sync_delay=60)
+        res = proj.resources[0]
+        in_flight = threading.Event()
+        proceed = threading.Event()
+
+        def hold(handler, fields, files):
+            in_flight.set()
+            proceed.wait(5)
+
+        self.server.prefix_hooks[('PUT', 'api/resource/surface')] = hold
+        res.title = 'changed'
+        flush = threading.Thread(target=proj._sync_queue.flush)
+        flush.start()
+        assert in_flight.wait(5)
+        res.description = 'changed during upload'
+        proceed.set()
+        flush.join()
+        record = self.server.objects[res._json['uid']]
+        assert record['title'] == 'changed'
+        assert record.get('description', '') == ''
+        # The change is kept and queued again rather than marked clean
+        assert res._dirty == {'description'}
+        proj._sync_queue.flush()
+        assert record['description'] == 'changed during upload'
+        assert res._dirty == set()
+
+        # Changes of failed requests are kept
+        self.server.prefix_hooks[('PUT', 'api/resource/surface')] = (
+            lambda handler, fields, files: (500, {'reason': 'failure'})
+        )
+        Comms.retry_policy = RetryPolicy(max_retries=0)
+        try:
+            proj.resources[0].title = 'failed'
+            proj._sync_queue.flush()
+        finally:
+            Comms.retry_policy = RetryPolicy()
+        assert res._dirty == {'title'}
+        assert res._sync is False
+
+    def test_plan_upload(self):
+        proj = _build_project()
+        plan = proj.plan_upload()
+        assert plan['posts'] == 4 + 12 + 6 + 1
+        assert plan['puts'] == 1
+        assert plan['violations'] == []
+        assert plan['requests'][0]['resource'] is proj.resources[0].mesh
+        assert plan['requests'][-1]['resource'] is proj
+        assert self.server.requests == []
+        proj.upload(verbose=False)
+        assert plan['num_requests'] == len(self.server.requests)
+        uploaded = sum(len(payload) for files in self.server.files.values()
+                       for name, payload in files.items()
+                       if not name.endswith('Type'))
+        assert plan['bytes'] == plan['raw_bytes'] == uploaded
+
+        self.server.requests = []
+        proj.resources[0].data[0].data.array = np.random.rand(6)
+        plan = proj.plan_upload()
+        assert [req['method'] for req in plan['requests']] == ['put']
+        assert plan['requests'][0]['files']['array']['bytes'] == 24
+        assert plan['num_requests'] == 2
+
+        Comms.chunk_threshold = 20
+        Comms.chunk_size = 10
+        try:
+            plan = proj.plan_upload()
+            proj.upload(verbose=False)
+        finally:
+            Comms.chunk_threshold = None
+            Comms.chunk_size = CHUNK_SIZE
+        assert plan['num_requests'] == len(self.server.requests) == 6
+
+        proj = _build_project(num_surfaces=2)
+        Comms.user._backend['file_size_limit'] = 200
+        violations = proj.plan_upload()['violations']
+        assert [vio['limit'] for vio in violations] == ['file_size_limit']
+        assert violations[0]['resource'] is proj.resources[1].mesh
+
+    def test_streaming_progress(self):
+        proj = steno3d.Project()
+        arr = np.random.rand(200000)
+        steno3d.Point(
+            project=proj,
+            mesh=dict(vertices=np.random.rand(200000, 3)),
+            data=[dict(location='N', data=arr)],
+        )
+        statuses = []
+        interval = progress.REPORT_INTERVAL
+        progress.REPORT_INTERVAL = 0
+        try:
+            proj.upload(verbose=False, progress_callback=statuses.append)
+        finally:
+            progress.REPORT_INTERVAL = interval
+        streaming = [status for status in statuses
+                     if 'resource' not in status]
+        finished = [status for status in statuses if 'resource' in status]
+        assert len(streaming) > 10
+        sent = [status['bytes_sent'] for status in streaming]
+        assert sent == sorted(sent)
+        fractions = [status['progress'] for status in statuses]
+        assert fractions == sorted(fractions)
+        assert 0 < streaming[len(streaming) // 2]['progress'] < 1
+        assert [status['resource'] for status in finished] == [
+            proj.resources[0].mesh, proj.resources[0].data[0].data,
+            proj.resources[0], proj,
+        ]
+        assert finished[-1]['progress'] == 1
+        assert finished[-1]['bytes_sent'] > arr.nbytes // 2
+        assert finished[-1]['eta'] == 0
+        for status in finished:
+            assert status['resource_time'] >= 0
+            assert status['rate'] >= 0 and status['average_rate'] > 0
+
+    def test_incremental_dirty_tracking(self):
+        proj = _build_project(num_surfaces=4)
+        proj.upload(verbose=False)
+        assert proj._dirty == set()
+        self.server.requests = []
+        shared = proj.resources[1].mesh
+        shared.vertices = np.random.rand(10, 3)
+        assert proj._dirty == {'resources'}
+        assert set(proj._dirty_links['resources']) == {
+            id(proj.resources[1]), id(proj.resources[3])
+        }
+        assert proj.resources[0]._dirty == set()
+        proj.upload(verbose=False)
+        assert proj._dirty == set()
+        assert shared._dirty == set()
+        assert len(self._puts('resource/mesh2d')) == 1
+
+        dat = proj.resources[2].data[1].data
+        dat.title = 'changed'
+        assert proj.resources[2]._dirty == {'data'}
+        assert proj._dirty == {'resources'}
+        dat.title = 'changed again'
+        proj.resources[2].data = proj.resources[2].data[:1]
+        dat.title = 'removed'
+        proj._mark_clean()
+        assert proj._dirty == set()
+        assert dat._dirty == {'title'}
+
+        res = proj.resources[0]
+        res.opts.opacity = 0.5
+        assert res._dirty == {'opts'}
+        assert proj._dirty == {'resources'}
+        proj.title = 'changed'
+        assert res._dirty == {'opts'}
+        res._mark_clean()
+        assert proj._dirty == {'title'}
+
+    def test_array_patches(self):
+        proj = steno3d.Project()
+        arr = np.random.rand(100000)
+        steno3d.Point(
+            project=proj,
+            mesh=dict(vertices=np.random.rand(100000, 3)),
+            data=[dict(location='N', data=arr)],
+        )
+        data = proj.resources[0].data[0].data
+        proj.upload(verbose=False)
+        uid = data._json['uid']
+
+        # Without patches, arrays are not compared to the last upload
+        arr = arr.copy()
+        arr[10] = -1.
+        data.array = arr
+        plan = proj.plan_upload()
+        assert plan['changed_bytes'] == plan['bytes'] == arr.size * 4
+        self.server.requests = []
+        proj.upload(verbose=False)
+        put = self._puts('resource/data/array')[0]
+        assert len(put['files']['array']) == arr.size * 4
+        assert data._block_digests['array'][2] is None
+
+        Comms.array_patching = True
+        try:
+            # The first upload with patches records the blocks sent
+            arr = arr.copy()
+            arr[20] = -1.
+            data.array = arr
+            self.server.requests = []
+            proj.upload(verbose=False)
+            put = self._puts('resource/data/array')[0]
+            assert len(put['files']['array']) == arr.size * 4
+            assert data._block_digests['array'][2] is not None
+
+            arr = arr.copy()
+            arr[[10, 90000]] = -2.
+            data.array = arr
+            plan = proj.plan_upload()
+            assert plan['changed_bytes'] == 2 * PATCH_BLOCK_SIZE
+            assert plan['bytes'] == 2 * PATCH_BLOCK_SIZE
+            self.server.requests = []
+            proj.upload(verbose=False)
+            put = self._puts('resource/data/array')[0]
+            assert len(put['files']['array']) == 2 * PATCH_BLOCK_SIZE
+            assert 'arrayPatch' in put['files']
+            stored = np.frombuffer(self.server.files[uid]['array'], '<f4')
+            assert np.array_equal(stored, arr.astype('<f4'))
+
+            data.array = arr.copy()
+            self.server.requests = []
+            proj.upload(verbose=False)
+            assert self._puts('resource/data/array') == []
+        finally:
+            Comms.array_patching = False
+
+    def test_prepared_upload(self):
+        proj = steno3d.Project()
+        vertices = np.random.rand(100000, 3)
+        steno3d.Point(
+            project=proj,
+            mesh=dict(vertices=vertices),
+            data=[dict(location='N', data=np.zeros(100000, 'f8'))],
+        )
+        steno3d.Point(project=proj, mesh=dict(vertices=np.random.rand(10, 3)))
+        data = proj.resources[0].data[0].data
+        Comms.array_encodings = {'gzip'}
+        try:
+            prepared = prepare_files(proj._leaves(), 2, 'gzip')
+            assert prepared == 2
+            fileprop = data._prepared_files['array'][2]
+            assert fileprop.file.stats == {'min': 0, 'max': 0,
+                                           'nan_count': 0}
+            assert 'gzip' in fileprop.file.encoded
+            # Converted arrays are used in place in shared memory
+            assert len(data._prepared_blocks) == 1
+            proj.upload(verbose=False, compression='gzip',
+                        prepare_workers=2)
+            assert data._prepared_files == {}
+            assert data._prepared_blocks is None
+        finally:
+            Comms.array_encodings = set()
+        uploaded = self.server.files[data._json['uid']]
+        assert decode_buffer(uploaded['array'], 'gzip') == np.zeros(
+            100000, '<f4'
+        ).tobytes()
+        uploaded = self.server.files[proj.resources[0].mesh._json['uid']]
+        stored = uploaded['vertices']
+        if 'verticesEncoding' in uploaded:
+            stored = decode_buffer(stored, 'gzip')
+        assert stored == vertices.astype('<f4').tobytes()
+
+        # Files prepared for an upload that fails are released
+        mesh = proj.resources[0].mesh
+        mesh.vertices = np.random.rand(100000, 3)
+        data.array = (np.arange(100000) % 30000).astype('i2')
+        self.server.prefix_hooks[('PUT', 'api/resource/mesh0d')] = (
+            lambda handler, fields, files: (500, {'reason': 'failure'})
+        )
+        self.assertRaises(steno3d.UploadError, proj.upload, verbose=False,
+                          prepare_workers=2)
+        assert data._prepared_files == {}
+        assert data._prepared_blocks is None
+        self.server.prefix_hooks = {}
+        proj.upload(verbose=False, prepare_workers=2)
+        uploaded = self.server.files[data._json['uid']]
+        assert uploaded['array'] == data.array.astype('<i4').tobytes()
+
+    def test_parallel_download(self):
+        proj = _build_project(num_surfaces=4)
+        uid = proj.upload(verbose=False)
+
+        def gets():
+            return sorted(req['path'] for req in self.server.requests
+                          if req['method'] == 'GET')
+
+        self.server.requests = []
+        progress = []
+        serial = project_by_uid(uid, verbose=False,
+                                progress_callback=progress.append)
+        serial_gets = gets()
+        assert progress[-1]['bytes_received'] == 4 * sum(
+            res.mesh.vertices.size + res.mesh.triangles.size +
+            sum(d.data.array.size for d in res.data)
+            for res in serial.resources
+        )
+        self.server.requests = []
+        copy = project_by_uid(uid, verbose=False, workers=4)
+        # The shared mesh and its arrays are only fetched once
+        assert sorted(set(gets())) == sorted(set(serial_gets))
+        assert len(gets()) == len(serial_gets) - 3
+        assert [res.title for res in copy.resources] == [
+            res.title for res in serial.resources
+        ]
+        for original, res in zip(proj.resources, copy.resources):
+            assert np.allclose(res.mesh.vertices, original.mesh.vertices)
+            for orig_data, data in zip(original.data, res.data):
+                assert data.location == orig_data.location
+                assert np.allclose(data.data.array, orig_data.data.array)
+
+    def test_download_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            proj = _build_project(num_surfaces=2)
+            uid = proj.upload(verbose=False)
+            cache = DownloadCache(directory)
+            progress = []
+            project_by_uid(uid, verbose=False, cache=cache,
+                           progress_callback=progress.append)
+            first_bytes = progress[-1]['bytes_received']
+            assert first_bytes > 0
+            assert path.isfile(path.join(directory, 'index.json'))
+            assert cache.nbytes > first_bytes
+
+            self.server.requests = []
+            progress = []
+            copy = project_by_uid(uid, verbose=False,
+                                  cache=DownloadCache(directory),
+                                  progress_callback=progress.append)
+            assert progress[-1]['bytes_received'] == 0
+            gets = [req for req in self.server.requests
+                    if req['method'] == 'GET']
+            assert gets and all('If-None-Match' in req['headers']
+                                for req in gets)
+            for original, res in zip(proj.resources, copy.resources):
+                assert np.allclose(res.mesh.vertices, original.mesh.vertices)
+                res.mesh.vertices[0] = 5.
+
+            # Changed arrays are downloaded again
+            mesh = proj.resources[0].mesh
+            mesh.vertices = mesh.vertices + 1.
+            proj.upload(verbose=False)
+            copy = project_by_uid(uid, verbose=False,
+                                  cache=DownloadCache(directory))
+            assert np.allclose(copy.resources[0].mesh.vertices,
+                               mesh.vertices)
+
+            # Concurrent builds keep their own cache and progress
+            cached = [True, False, True, False]
+            progress = [[] for _ in cached]
+            threads = [
+                threading.Thread(target=project_by_uid, args=(uid,), kwargs={
+                    'verbose': False,
+                    'cache': DownloadCache(directory) if use_cache else None,
+                    'progress_callback': updates.append,
+                })
+                for use_cache, updates in zip(cached, progress)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            received = [updates[-1]['bytes_received'] for updates in progress]
+            assert received[1] > 0
+            assert received == [0, received[1], 0, received[1]]
+
+            cache = DownloadCache(directory, max_bytes=1)
+            project_by_uid(uid, verbose=False, cache=cache)
+            assert len(cache.entries) == 1
+            # Prefetched files evicted before the build are still used
+            cache = DownloadCache(directory, max_bytes=200)
+            copy = project_by_uid(uid, verbose=False, workers=4, cache=cache)
+            assert np.allclose(copy.resources[0].mesh.vertices,
+                               mesh.vertices)
+            cache.clear()
+            assert cache.nbytes == 0
+        finally:
+            shutil.rmtree(directory)
+
+    def test_lazy_download(self):
+        proj = _build_project(num_surfaces=2)
+        uid = proj.upload(verbose=False)
+
+        def binary_gets():
+            return [req for req in self.server.requests
+                    if req['method'] == 'GET' and 'binary/' in req['path']]
+
+        self.server.requests = []
+        copy = project_by_uid(uid, verbose=False, lazy=True)
+        assert binary_gets() == []
+        leaves = copy._leaves()
+        assert all(leaf._pending_downloads for leaf in leaves)
+        assert [res.title for res in copy.resources] == [
+            res.title for res in proj.resources
+        ]
+
+        mesh = copy.resources[0].mesh
+        assert np.allclose(mesh.vertices, proj.resources[0].mesh.vertices)
+        assert len(binary_gets()) == 1
+        assert mesh._pending_downloads == ['triangles']
+        assert len(mesh._dirty_props) == 0
+        mesh.vertices
+        assert len(binary_gets()) == 1
+
+        copy.prefetch(copy.resources[0])
+        assert all(leaf._pending_downloads == []
+                   for leaf in copy._leaves([copy.resources[0]]))
+        copy.prefetch()
+        assert all(leaf._pending_downloads == [] for leaf in leaves)
+        for original, res in zip(proj.resources, copy.resources):
+            assert np.allclose(res.mesh.triangles, original.mesh.triangles)
+            for orig_data, data in zip(original.data, res.data):
+                assert np.allclose(data.data.array, orig_data.data.array)
+        num_gets = len(binary_gets())
+        copy.prefetch()
+        assert len(binary_gets()) == num_gets
+
+    def test_project_listing(self):
+        uids = [_build_project(num_surfaces=1).upload(verbose=False)
+                for _ in range(5)]
+        second_page = threading.Event()
+
+        def page(handler, fields, files):
+            if 'cursor=2' in handler.path:
+                second_page.set()
+
+        self.server.hooks[('GET', 'api/project/steno3ds/mine')] = page
+        projit = iter_my_projects(queue=2, verbose=False)
+        assert next(projit)['uid'] == uids[-1]
+        # The next page is requested while the first is consumed
+        assert second_page.wait(5)
+        assert [proj['uid'] for proj in projit] == uids[-2::-1]
+
+        def pages():
+            return [req for req in self.server.requests
+                    if req['path'] == 'api/project/steno3ds/mine']
+
+        cache = ProjectCache()
+        self.server.requests = []
+        listed = my_projects(queue=2, verbose=False, cache=cache)
+        assert [proj['uid'] for proj in listed] == uids[::-1]
+        assert len(pages()) == 3
+        self.server.requests = []
+        assert my_projects(2, verbose=False, cache=cache) == listed[:2]
+        assert pages() == []
+
+        uids += [_build_project(num_surfaces=1).upload(verbose=False)]
+        cache.ttl = 0
+        self.server.requests = []
+        listed = my_projects(queue=2, verbose=False, cache=cache)
+        assert [proj['uid'] for proj in listed] == uids[::-1]
+        assert len(pages()) == 1
+        assert my_projects(verbose=False) == listed
+
+
+if __name__ == '__main__':
+    unittest.main()